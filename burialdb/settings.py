@@ -152,6 +152,56 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 MEDIA_URL = '/media/'
 
+IMPORT_CACHE_DIR = os.path.join(BASE_DIR, 'import_cache')
+
+# Export files are not in MEDIA_ROOT, which is served without authentication
+EXPORT_DIR = os.path.join(BASE_DIR, 'exports')
+
+# Running jobs without a heartbeat for this number of seconds were left by a stopped worker and are run again
+JOB_TIMEOUT = 30 * 60
+
+# Person lists larger than the planner estimate show the estimate instead of an exact COUNT(*)
+COUNT_ESTIMATE_THRESHOLD = 100000
+
+COUNT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Saved searches with at most this many results keep the ordered ids of the result in the cache
+SEARCH_RESULT_CACHE_LIMIT = 10000
+
+SEARCH_RESULT_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Size of the per process LRU of saved search ids by hash
+SEARCH_ID_CACHE_SIZE = 1000
+
+# Saved searches not used for this number of days, or beyond the most recently used rows, are evicted
+# by the evict_searches command
+SEARCH_DATA_TTL_DAYS = 90
+
+SEARCH_DATA_MAX_ROWS = 100000
+
+# Pairs of imported and existing persons scored at least this are shown as possible duplicates
+DUPLICATE_SCORE_THRESHOLD = 0.8
+
+# Persons without a birth year are compared with all persons of the same surname in blocks up to this size
+DUPLICATE_MAX_BLOCK_SIZE = 1000
+
+# Log the number and time of SQL queries of every request, duplicated queries, queries repeated at least
+# QUERY_REPEAT_THRESHOLD times and views exceeding their query_budget (development only)
+QUERY_STATS = False
+
+QUERY_REPEAT_THRESHOLD = 5
+
+# Record request latency, SQL queries, response size and template render time by URL name. Every process
+# writes its metrics to METRICS_DIR at most every METRICS_FLUSH_INTERVAL seconds, /metrics/ sums them
+# for staff users or with the "Authorization: Bearer <METRICS_TOKEN>" header
+METRICS = False
+
+METRICS_DIR = os.path.join(BASE_DIR, 'metrics')
+
+METRICS_FLUSH_INTERVAL = 10
+
+METRICS_TOKEN = ''
+
 RECAPTCHA_ENABLED = False
 
 NOCAPTCHA = True
@@ -180,3 +230,9 @@ except ImportError:
 if PROFILE:
     INSTALLED_APPS += ['debug_toolbar']
     MIDDLEWARE = ['debug_toolbar.middleware.DebugToolbarMiddleware'] + MIDDLEWARE
+
+if QUERY_STATS:
+    MIDDLEWARE = ['website.querystats.QueryStatsMiddleware'] + MIDDLEWARE
+
+if METRICS:
+    MIDDLEWARE = ['website.metrics.MetricsMiddleware'] + MIDDLEWARE
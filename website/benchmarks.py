@@ -0,0 +1,317 @@
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from openpyxl import Workbook
+
+from website.importer import XLSXImporter, ImporterFactory, PersonImportPipeline, CopyPersonImportPipeline
+from website.jobs import run_export, run_import
+from website.models import Cemetery, DataVersion, Export, Hospital, Import, Person, Place
+from website.synthetic import SURNAMES, create_corpus, get_import_mapping, write_import_file
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def write_xlsx(path, rows, cols):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(['#'] + ['Колонка %s' % col for col in range(cols)])
+    for row in range(rows):
+        ws.append([row + 1] + ['Значение %s-%s' % (row, col) for col in range(cols)])
+    wb.save(path)
+
+
+def max_rss():
+    """
+    Peak resident memory of the process in bytes, None without the resource module (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(func):
+    """
+    Runs func and returns its result, wall time in seconds and the peak of Python allocations of it in bytes traced
+    by tracemalloc. Growth of max_rss is no measure of a benchmark, it stays 0 once an earlier one raised the peak.
+    Times include the overhead of tracing.
+    """
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        return result, elapsed, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark('xlsx_import')
+def xlsx_import(rows, cols=20, **kwargs):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'benchmark.xlsx')
+        write_xlsx(path, rows, cols)
+        import_object = SimpleNamespace(file=SimpleNamespace(path=path), header=1, numbering=1)
+        importer = XLSXImporter(import_object)
+
+        def consume():
+            count = 0
+            for _ in importer.iter_data():
+                count += 1
+            return count
+
+        count, elapsed, peak = measure(consume)
+
+    result = OrderedDict([
+        ('rows', count),
+        ('seconds', elapsed),
+        ('rows_per_second', count / elapsed if elapsed else 0),
+        ('peak_memory', peak),
+    ])
+    if max_rss() is not None:
+        result['max_rss'] = max_rss()
+    return result
+
+
+@contextmanager
+def rolled_back():
+    """
+    Runs the block in a transaction which is rolled back. Data versions are moved past the versions used inside,
+    so cache entries made from the rolled back data are never read.
+    """
+    versions = {}
+    with transaction.atomic():
+        try:
+            yield
+            versions = dict(DataVersion.objects.values_list('name', 'version'))
+        finally:
+            transaction.set_rollback(True)
+    for name, version in versions.items():
+        DataVersion.objects.update_or_create(name=name, defaults={'version': version + 1})
+
+
+def make_csv(rows):
+    lines = ['N,ФИО,Год рождения,Категория,Место призыва,Дата смерти']
+    for row in range(rows):
+        lines.append('%s,иванов иван %s,19%02d,%s,г. Москва,%02d.05.1942' % (row + 1, row, row % 100, row % 5, row % 28 + 1))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def run_person_import(pipeline_class, content):
+    """
+    Imports generated rows with pipeline_class inside a transaction which is rolled back afterwards
+    """
+    with rolled_back():
+        obj = Import.objects.create(file=ContentFile(content, name='benchmark.csv'))
+        try:
+            # Parse once beforehand, only the apply step is measured
+            ImporterFactory(obj).get_importer().scan(0)
+            mapping = {'fio': 0, 'year': 1, 'state': 2, 'conscription_place': 3, 'death_date': 4}
+            count, elapsed, peak = measure(lambda: pipeline_class(obj, mapping).run())
+        finally:
+            obj.delete()
+    return count, elapsed, peak
+
+
+@benchmark('person_import')
+def person_import(rows, **kwargs):
+    content = make_csv(rows)
+    result = OrderedDict()
+    pipelines = [('orm', PersonImportPipeline)]
+    if connection.vendor == 'postgresql':
+        pipelines.append(('copy', CopyPersonImportPipeline))
+
+    for name, pipeline_class in pipelines:
+        count, elapsed, peak = run_person_import(pipeline_class, content)
+        result['%s_seconds' % name] = elapsed
+        result['%s_rows_per_second' % name] = count / elapsed if elapsed else 0
+        result['%s_peak_memory' % name] = peak
+
+    result['rows'] = rows
+    if 'copy_seconds' in result and result['copy_seconds']:
+        result['copy_speedup'] = result['orm_seconds'] / result['copy_seconds']
+    result['peak_memory'] = max(v for k, v in result.items() if k.endswith('_peak_memory'))
+    return result
+
+
+_shared = SimpleNamespace(active=False)
+
+
+@contextmanager
+def shared_corpus():
+    """
+    Runs the benchmarks of the block in one rolled back transaction, so the corpus generated by the first
+    benchmark_client is reused by the following ones instead of being generated for every benchmark
+    """
+    with rolled_back():
+        _shared.active = True
+        try:
+            yield
+        finally:
+            _shared.active = False
+
+
+def ensure_corpus(rows, seed):
+    if not Person.objects.filter(active_import=None).exists():
+        create_corpus(rows, cemeteries=max(1, rows // 5000), hospitals=max(1, rows // 1000), seed=seed)
+
+
+@contextmanager
+def benchmark_client(rows, seed=0):
+    """
+    Logged in test client working on the current data inside a rolled back transaction, media files go to
+    a temporary directory. A corpus of rows persons is generated if there are no persons, once for all
+    benchmarks inside shared_corpus.
+    """
+    if _shared.active:
+        ensure_corpus(rows, seed)
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            override_settings(ALLOWED_HOSTS=['*'], MEDIA_ROOT=tmp_dir, IMPORT_CACHE_DIR=tmp_dir,
+                              EXPORT_DIR=tmp_dir), rolled_back():
+        ensure_corpus(rows, seed)
+        client = Client()
+        client.force_login(get_user_model().objects.create_user('benchmark'))
+        yield client
+
+
+def check_response(response):
+    if response.status_code not in (200, 302):
+        raise RuntimeError('%s %s returned %s' % (response.request['REQUEST_METHOD'], response.request['PATH_INFO'],
+                                                  response.status_code))
+    return response
+
+
+def time_calls(func, repeat):
+    """
+    Calls func repeat times, returns timings of the first (cold caches) and the following calls and the number of
+    database queries of the last call
+    """
+    times = []
+    queries = 0
+    for _ in range(max(repeat, 1)):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - started)
+        queries = len(context.captured_queries)
+    if len(times) == 1:
+        return OrderedDict([('seconds', times[0]), ('queries', queries)])
+    return OrderedDict([
+        ('first_seconds', times[0]),
+        ('median_seconds', statistics.median(times)),
+        ('min_seconds', min(times)),
+        ('max_seconds', max(times)),
+        ('queries', queries),
+    ])
+
+
+def prefixed(prefix, result):
+    return OrderedDict(('%s_%s' % (prefix, k), v) for k, v in result.items())
+
+
+def get_search_queries():
+    region = Place.objects.filter(name='Тверская область').values_list('id', flat=True).first()
+    return OrderedDict([
+        ('fio', {'fio': SURNAMES[0]}),
+        ('quick', {'quick': '%s 1942' % SURNAMES[0]}),
+        ('sounds_like', {'fio': SURNAMES[0], 'fio_sounds_like': 'on'}),
+        ('death_date_range', {'death_date_from': '01.1942', 'death_date_to': '03.1942'}),
+        ('region', {'region': str(region) if region else ''}),
+    ])
+
+
+@benchmark('persons_search')
+def persons_search(rows, repeat=5, seed=0, **kwargs):
+    result = OrderedDict()
+    with benchmark_client(rows, seed) as client:
+        for name, data in get_search_queries().items():
+            response = check_response(client.post(reverse('persons'), dict(data, advanced_search=1)))
+            result.update(prefixed(name, time_calls(lambda: check_response(client.get(response.url)), repeat)))
+    return result
+
+
+def largest(field):
+    return Person.objects.filter(active_import=None).exclude(**{field: None}).order_by() \
+        .values_list(field).annotate(count=Count('id')).order_by('-count').values_list(field, flat=True).first()
+
+
+@benchmark('cemetery_detail')
+def cemetery_detail(rows, repeat=5, seed=0, **kwargs):
+    with benchmark_client(rows, seed) as client:
+        url = reverse('cemetery_detail', args=[largest('cemetery') or Cemetery.objects.create(name='Benchmark').pk])
+        return time_calls(lambda: check_response(client.get(url)), repeat)
+
+
+@benchmark('hospital_detail')
+def hospital_detail(rows, repeat=5, seed=0, **kwargs):
+    with benchmark_client(rows, seed) as client:
+        url = reverse('hospital_detail', args=[largest('hospital_linked') or Hospital.objects.create(name='ЭГ 1').pk])
+        return time_calls(lambda: check_response(client.get(url)), repeat)
+
+
+def create_import(rows, seed, tmp_dir):
+    path = os.path.join(tmp_dir, 'benchmark.csv')
+    write_import_file(path, rows, seed)
+    with open(path, 'rb') as f:
+        return Import.objects.create(file=File(f, name='benchmark.csv'))
+
+
+@benchmark('import_preview')
+def import_preview(rows, repeat=5, seed=0, **kwargs):
+    with benchmark_client(rows, seed) as client, tempfile.TemporaryDirectory() as tmp_dir:
+        obj = create_import(rows, seed, tmp_dir)
+        url = reverse('import_view', args=[obj.pk])
+        result = time_calls(lambda: check_response(client.get(url)), repeat)
+        result['rows'] = rows
+        return result
+
+
+@benchmark('import_apply')
+def import_apply(rows, seed=0, **kwargs):
+    with benchmark_client(rows, seed) as client, tempfile.TemporaryDirectory() as tmp_dir:
+        obj = create_import(rows, seed, tmp_dir)
+        data = {'column_%s' % col: field for field, col in get_import_mapping().items()}
+        result = prefixed('map', time_calls(
+            lambda: check_response(client.post(reverse('import_do_cancel', args=[obj.pk]), data)), 1))
+        obj.refresh_from_db()
+        result.update(prefixed('job', time_calls(lambda: run_import(obj), 1)))
+        result.update(prefixed('apply', time_calls(
+            lambda: check_response(client.post(reverse('import_apply_or_undo', args=[obj.pk]), {'action': 'apply'})),
+            1)))
+        result['rows'] = rows
+        return result
+
+
+@benchmark('cemetery_export')
+def cemetery_export(rows, seed=0, **kwargs):
+    with benchmark_client(rows, seed) as client:
+        cemetery = largest('cemetery') or Cemetery.objects.create(name='Benchmark').pk
+        result = prefixed('request', time_calls(
+            lambda: check_response(client.get(reverse('cemetery_export', args=[cemetery]))), 1))
+        obj = Export.objects.filter(cemetery=cemetery).latest('id')
+        result.update(prefixed('job', time_calls(lambda: run_export(obj), 1)))
+        obj.refresh_from_db()
+        result['rows'] = obj.rows
+        return result
@@ -0,0 +1,61 @@
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from website.models import DataVersion
+
+
+class ListCount:
+    def __init__(self, value, estimated=False):
+        self.value = value
+        self.estimated = estimated
+
+    def __str__(self):
+        return '~%s' % self.value if self.estimated else str(self.value)
+
+    def __int__(self):
+        return self.value
+
+
+def estimate_count(queryset):
+    """
+    Planner estimate of the number of rows of queryset on PostgreSQL, None if it is not available
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            # reltuples is -1 (0 before PostgreSQL 14) for tables never vacuumed or analyzed
+            return int(row[0]) if row and row[0] > 0 else None
+
+        sql, params = queryset.order_by().query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_count(queryset, key):
+    """
+    Number of persons in queryset. Exact counts are cached under key until persons change, lists estimated by
+    the planner to be larger than COUNT_ESTIMATE_THRESHOLD return the estimate without counting.
+    """
+    cache_key = 'count:%s:%s' % (DataVersion.get(DataVersion.PERSONS), key)
+    value = cache.get(cache_key)
+    if value is not None:
+        return ListCount(value)
+
+    estimate = estimate_count(queryset)
+    if estimate is not None and estimate > settings.COUNT_ESTIMATE_THRESHOLD:
+        return ListCount(estimate, estimated=True)
+
+    value = queryset.count()
+    cache.set(cache_key, value, settings.COUNT_CACHE_TIMEOUT)
+    return ListCount(value)
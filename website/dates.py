@@ -0,0 +1,105 @@
+import calendar
+import datetime
+import re
+from collections import namedtuple
+
+# Period of time denoted by a possibly partial date, both ends included
+DateRange = namedtuple('DateRange', ['start', 'end'])
+
+# Month names by their first three letters, in any case form (января, январь, янв.)
+MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'май': 5, 'мая': 5, 'июн': 6,
+    'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12,
+}
+
+_ISO_RE = re.compile(r'(?<!\d)(\d{4})-(\d{1,2})-(\d{1,2})(?!\d)')
+# dd.mm.yyyy as written in lists and emitted by XLSXImporter.format_value, also with / or - and two digit years
+_DAY_MONTH_YEAR_RE = re.compile(r'(?<!\d)(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})(?!\d)')
+_MONTH_YEAR_RE = re.compile(r'(?<![\d.])(\d{1,2})[./](\d{4})(?!\d)')
+_DAY_MONTH_NAME_YEAR_RE = re.compile(r'(?<!\d)(\d{1,2})\s*([а-я]{3,})\.?\s*(\d{4})(?!\d)')
+_MONTH_NAME_YEAR_RE = re.compile(r'(?<![а-я])([а-я]{3,})\.?\s*(\d{4})(?!\d)')
+_YEAR_RE = re.compile(r'(?<!\d)(1[89]\d\d|20\d\d)(?!\d)')
+
+
+def _year(value):
+    year = int(value)
+    return year + 1900 if len(value) == 2 else year
+
+
+def _day(year, month, day):
+    try:
+        date = datetime.date(year, month, day)
+    except ValueError:
+        return None
+    return DateRange(date, date)
+
+
+def _month(year, month):
+    if not 1 <= month <= 12 or not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+        return None
+    return DateRange(datetime.date(year, month, 1), datetime.date(year, month, calendar.monthrange(year, month)[1]))
+
+
+def _month_name(name):
+    return MONTHS.get(name[:3])
+
+
+def parse_date(value):
+    """
+    Period denoted by a free text date: a day (12.01.1942, 1942-01-12, 12 января 1942 г.), a month (01.1942,
+    январь 1942) or a year (1942, в 1942 г.). The first date found in the text is used, None if there is none.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return DateRange(value, value)
+    if isinstance(value, int):
+        value = str(value)
+
+    text = value.lower().replace('ё', 'е')
+
+    match = _ISO_RE.search(text)
+    if match:
+        result = _day(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        if result:
+            return result
+
+    match = _DAY_MONTH_YEAR_RE.search(text)
+    if match:
+        result = _day(_year(match.group(3)), int(match.group(2)), int(match.group(1)))
+        if result:
+            return result
+
+    match = _DAY_MONTH_NAME_YEAR_RE.search(text)
+    if match and _month_name(match.group(2)):
+        result = _day(int(match.group(3)), _month_name(match.group(2)), int(match.group(1)))
+        if result:
+            return result
+
+    match = _MONTH_YEAR_RE.search(text)
+    if match:
+        result = _month(int(match.group(2)), int(match.group(1)))
+        if result:
+            return result
+
+    for match in _MONTH_NAME_YEAR_RE.finditer(text):
+        if _month_name(match.group(1)):
+            return _month(int(match.group(2)), _month_name(match.group(1)))
+
+    match = _YEAR_RE.search(text)
+    if match:
+        year = int(match.group(1))
+        return DateRange(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+    return None
+
+
+def parse_year(value):
+    """
+    Year of a free text date or year, None if it is not known exactly
+    """
+    period = parse_date(value)
+    if period is None or period.start.year != period.end.year:
+        return None
+    return period.start.year
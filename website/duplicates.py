@@ -0,0 +1,147 @@
+import logging
+import time
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.db.models import Q
+
+from website.lookups import search_text
+from website.models import DuplicateCandidate, Person
+
+logger = logging.getLogger(__name__)
+
+# Compared fields with their weights and whether close values count as partially equal. A field is compared by
+# the best matching pair of its primary and actual values. Names are compared by phonetic keys, so transliterated
+# and misspelled names are close.
+MATCH_FIELDS = [
+    (['fio_actual_phonetic', 'fio_phonetic', 'ontombstone_phonetic'], 4, True),
+    (['death_date_actual', 'death_date'], 2, False),
+    (['born_region_actual', 'born_region'], 1, True),
+    (['born_address_actual', 'born_address'], 1, True),
+    (['conscription_place_actual', 'conscription_place'], 1, True),
+    (['military_unit_actual', 'military_unit'], 1, True),
+    (['grave_actual', 'grave'], 1, True),
+    (['cemetery_actual_id', 'cemetery_id'], 1, False),
+    (['rank_actual', 'rank'], 0.5, True),
+]
+
+YEAR_WEIGHT = 2
+
+# Keys of surnames are compared in chunks of this size
+KEYS_CHUNK_SIZE = 200
+
+
+def normalize(value):
+    if isinstance(value, str):
+        return ' '.join(search_text(value).split())
+    return str(value)
+
+
+def similarity(values, other_values, fuzzy):
+    best = 0
+    for value in values:
+        for other_value in other_values:
+            if value == other_value:
+                return 1
+            if fuzzy:
+                best = max(best, SequenceMatcher(None, value, other_value).ratio())
+    return best
+
+
+class Record:
+    """
+    Normalized values of the person compared by score
+    """
+    __slots__ = ['id', 'active_import_id', 'year', 'values']
+
+    def __init__(self, person):
+        self.id = person.id
+        self.active_import_id = person.active_import_id
+        self.year = person.birth_year
+        self.values = [[normalize(getattr(person, f)) for f in fields if getattr(person, f)]
+                       for fields, _, _ in MATCH_FIELDS]
+
+
+def score(record, other):
+    """
+    Weighted similarity of two records from 0 to 1. Fields known in one record only count half of their weight,
+    so sparse records need closer matches.
+    """
+    total = 0
+    weights = 0
+    for (_, weight, fuzzy), values, other_values in zip(MATCH_FIELDS, record.values, other.values):
+        if values and other_values:
+            total += weight * similarity(values, other_values, fuzzy)
+            weights += weight
+        elif values or other_values:
+            weights += weight / 2
+    if record.year and other.year:
+        total += YEAR_WEIGHT if record.year == other.year else 0
+        weights += YEAR_WEIGHT
+    return total / weights if weights else 0
+
+
+def get_record_fields():
+    fields = ['id', 'active_import', 'surname_key', 'birth_year']
+    for names, _, _ in MATCH_FIELDS:
+        fields += [name[:-3] if name.endswith('_id') else name for name in names]
+    return fields
+
+
+def iter_block_pairs(records, import_id, max_block_size):
+    """
+    Pairs of a person of the import and another person of the block to compare. Persons with different known
+    birth years are not compared, persons without a year are compared with all only in small blocks.
+    """
+    by_year = defaultdict(list)
+    for record in records:
+        by_year[record.year].append(record)
+    small = len(records) <= max_block_size
+
+    for record in records:
+        if record.active_import_id != import_id:
+            continue
+        if record.year is None:
+            others = records if small else by_year[None]
+        else:
+            others = by_year[record.year] + by_year[None]
+        for other in others:
+            # Pairs within the import are compared once
+            if other.id == record.id or (other.active_import_id == import_id and other.id > record.id):
+                continue
+            yield record, other
+
+
+def find_import_duplicates(import_object):
+    """
+    Finds persons of the import which may duplicate existing persons or other persons of the import. Candidates
+    are blocked by surname_key and birth year, so only persons of the import are compared and only with persons
+    of the same surname. Returns the number of found pairs.
+    """
+    started = time.perf_counter()
+    DuplicateCandidate.objects.filter(source_import=import_object).delete()
+    keys = list(Person.objects.filter(active_import=import_object).exclude(surname_key='')
+                .order_by('surname_key').values_list('surname_key', flat=True).distinct())
+    persons = Person.objects.select_related(None).only(*get_record_fields())
+    persons = persons.filter(Q(active_import=None) | Q(active_import=import_object))
+
+    found = 0
+    for i in range(0, len(keys), KEYS_CHUNK_SIZE):
+        blocks = defaultdict(list)
+        for person in persons.filter(surname_key__in=keys[i:i + KEYS_CHUNK_SIZE]).iterator():
+            blocks[person.surname_key].append(Record(person))
+
+        candidates = []
+        for records in blocks.values():
+            for record, other in iter_block_pairs(records, import_object.pk, settings.DUPLICATE_MAX_BLOCK_SIZE):
+                value = score(record, other)
+                if value >= settings.DUPLICATE_SCORE_THRESHOLD:
+                    candidates.append(DuplicateCandidate(source_import=import_object, person_id=record.id,
+                                                         duplicate_id=other.id, score=value))
+        DuplicateCandidate.objects.bulk_create(candidates)
+        found += len(candidates)
+
+    logger.info('Import %s: %s duplicate candidates in %.1f s', import_object.pk, found,
+                time.perf_counter() - started)
+    return found
@@ -0,0 +1,73 @@
+import csv
+import io
+
+from openpyxl import Workbook
+
+from website.models import Export, Person
+
+EXPORT_CHUNK_SIZE = 2000
+
+XLSX = Export.XLSX
+CSV = Export.CSV
+
+
+def get_export_fields():
+    """
+    Primary data fields of the person exported to files, as (attname, caption) pairs
+    """
+    def cond(f):
+        return f.attname in ('id', 'active_import_id', 'cemetery_id', 'cemetery_actual_id') \
+               or f.attname.endswith('_actual') or not f.editable
+    return [(f.attname, f.verbose_name) for f in Person._meta.fields if not cond(f)]
+
+
+def iter_export_rows(queryset):
+    """
+    Yields the header and rows of persons, reading only the exported columns in chunks
+    """
+    fields = get_export_fields()
+    yield [caption for _, caption in fields]
+
+    states = dict(Person.STATES)
+    state_index = [f for f, _ in fields].index('state')
+    rows = queryset.order_by('id').values_list(*[f for f, _ in fields])
+    for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        row = list(row)
+        row[state_index] = states.get(row[state_index], '')
+        yield row
+
+
+def write_xlsx(rows, file):
+    """
+    Writes rows to the binary file, returns the number of rows
+    """
+    # Write-only workbook keeps only the current row in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    count = 0
+    for row in rows:
+        ws.append(row)
+        count += 1
+    wb.save(file)
+    return count
+
+
+def write_csv(rows, file):
+    """
+    Writes rows to the binary file, returns the number of rows
+    """
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+
+WRITERS = {
+    XLSX: write_xlsx,
+    CSV: write_csv,
+}
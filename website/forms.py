@@ -1,9 +1,13 @@
+import codecs
+
 from django import forms
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Div, Layout, Submit, Button, HTML, ButtonHolder, Hidden
 
-from website.models import Person, Import, Hospital, Cemetery
+from website.dates import parse_date
+from website.models import Person, Import, Hospital, Cemetery, Place
+from website.search import get_range_search_fields
 
 from django.utils.translation import ugettext_lazy as _
 
@@ -70,6 +74,12 @@ class PersonCreateEditForm(forms.ModelForm):
             )
             i += 1
 
+        # Both cemetery fields list the same cemeteries, they are read once. The choices are iterated, as len()
+        # of model choices runs a COUNT query.
+        cemeteries = list(iter(self.fields['cemetery'].choices))
+        self.fields['cemetery'].choices = cemeteries
+        self.fields['cemetery_actual'].choices = cemeteries
+
         self.fields['notes'].widget.attrs['tabindex'] = 3
         layout.append(Div(Div('notes', css_class='col-12'), css_class='row'))
         layout.append(Div(Submit('submit', _('Сохранить'), css_class='btn btn-primary', tabindex=4), css_class='fixed-submit-button'))
@@ -130,12 +140,25 @@ class ImportEditForm(forms.ModelForm):
                 Div('quotechar', css_class='col-md-6'),
                 css_class='row'
             ),
+            Div(
+                Div('encoding', css_class='col-md-6'),
+                css_class='row'
+            ),
             Submit('submit', 'Сохранить', css_class='btn btn-primary'),
         )
 
+    def clean_encoding(self):
+        encoding = self.cleaned_data['encoding']
+        if encoding:
+            try:
+                codecs.lookup(encoding)
+            except LookupError:
+                raise forms.ValidationError('Неизвестная кодировка')
+        return encoding
+
     class Meta:
         model = Import
-        fields = ['cemetery', 'header', 'numbering', 'delimiter', 'quotechar']
+        fields = ['cemetery', 'header', 'numbering', 'delimiter', 'quotechar', 'encoding']
 
 
 class ImportDoForm(forms.Form):
@@ -187,18 +210,28 @@ class CemeteryCreateEditForm(forms.ModelForm):
         fields = ['name']
 
 
+def get_region_choices():
+    return [(None, '')] + [(str(pk), name) for pk, name in Place.objects.values_list('pk', 'name')]
+
+
 class PersonSearchForm(forms.Form):
     def __init__(self, *args, **kwargs):
         super(PersonSearchForm, self).__init__(*args, **kwargs)
 
         fields = (
+            ('quick', forms.CharField(required=False), 'Быстрый поиск'),
             ('fio', forms.CharField(required=False), 'ФИО'),
+            ('fio_sounds_like', forms.BooleanField(required=False), 'Похожие по звучанию'),
             ('born_year', forms.CharField(required=False), 'Год рождения'),
+            ('born_year_from', forms.CharField(required=False), 'Год рождения с'),
+            ('born_year_to', forms.CharField(required=False), 'Год рождения по'),
             # -1 value - hack for searching rows with is null, see views.PersonsView.get_queryset
             ('state', forms.ChoiceField(choices=((None, ''), (-1, 'Без категории')) + Person.STATES, required=False), 'Категория'),
+            ('status', forms.ChoiceField(choices=((None, ''),) + Person.STATUSES, required=False), 'Полнота данных'),
             ('cemetery', forms.CharField(required=False), 'Захоронение'),
             ('hospital', forms.CharField(required=False), 'Госпиталь'),
             ('born_region', forms.CharField(required=False), 'Регион (страна) рождения'),
+            ('region', forms.ChoiceField(choices=get_region_choices(), required=False), 'Регион (справочник)'),
             ('born_address', forms.CharField(required=False), 'Адрес рождения'),
             ('conscription_place', forms.CharField(required=False), 'Место призыва'),
             ('military_unit', forms.CharField(required=False), 'Часть'),
@@ -207,15 +240,23 @@ class PersonSearchForm(forms.Form):
             ('address', forms.CharField(required=False), 'Место жительства'),
             ('relatives', forms.CharField(required=False), 'Родственники'),
             ('receipt_date', forms.CharField(required=False), 'Дата поступления'),
+            ('receipt_date_from', forms.CharField(required=False), 'Дата поступления с'),
+            ('receipt_date_to', forms.CharField(required=False), 'Дата поступления по'),
             ('receipt_cause', forms.CharField(required=False), 'Причина поступления'),
             ('death_date', forms.CharField(required=False), 'Дата смерти'),
+            ('death_date_from', forms.CharField(required=False), 'Дата смерти с'),
+            ('death_date_to', forms.CharField(required=False), 'Дата смерти по'),
             ('death_cause', forms.CharField(required=False), 'Причина смерти'),
             ('grave', forms.CharField(required=False), 'Расположение могилы'),
             ('date_of_captivity', forms.CharField(required=False), 'Дата пленения'),
+            ('date_of_captivity_from', forms.CharField(required=False), 'Дата пленения с'),
+            ('date_of_captivity_to', forms.CharField(required=False), 'Дата пленения по'),
             ('place_of_captivity', forms.CharField(required=False), 'Место пленения'),
             ('camp', forms.CharField(required=False), 'Лагерь'),
             ('camp_number', forms.CharField(required=False), 'Лагерный номер'),
             ('lost_date', forms.CharField(required=False), 'Связь прекращена'),
+            ('lost_date_from', forms.CharField(required=False), 'Связь прекращена с'),
+            ('lost_date_to', forms.CharField(required=False), 'Связь прекращена по'),
             ('field_post', forms.CharField(required=False), 'Полевая почта'),
             ('notes', forms.CharField(required=False), 'Примечания'),
             ('advanced_search', forms.IntegerField(widget=forms.HiddenInput(), initial=0), '')
@@ -229,16 +270,25 @@ class PersonSearchForm(forms.Form):
 
         self.helper.layout = Layout(
             Div(
-                Div('fio', css_class='col-md-4'),
+                Div('quick', css_class='col-12'),
+                css_class='row'
+            ),
+
+            Div(
+                Div('fio', 'fio_sounds_like', css_class='col-md-4'),
                 Div('born_year', css_class='col-md-4'),
                 Div('state', css_class='col-md-4'),
                 css_class='row'
             ),
 
             Div(
+                Div('born_year_from', css_class='col-md-2'),
+                Div('born_year_to', css_class='col-md-2'),
+                Div('status', css_class='col-md-4'),
                 Div('cemetery', css_class='col-md-4'),
                 Div('hospital', css_class='col-md-4'),
                 Div('born_region', css_class='col-md-4'),
+                Div('region', css_class='col-md-4'),
                 Div('born_address', css_class='col-md-4'),
                 Div('conscription_place', css_class='col-md-4'),
                 Div('military_unit', css_class='col-md-4'),
@@ -247,15 +297,23 @@ class PersonSearchForm(forms.Form):
                 Div('address', css_class='col-md-4'),
                 Div('relatives', css_class='col-md-4'),
                 Div('receipt_date', css_class='col-md-4'),
+                Div('receipt_date_from', css_class='col-md-2'),
+                Div('receipt_date_to', css_class='col-md-2'),
                 Div('receipt_cause', css_class='col-md-4'),
                 Div('death_date', css_class='col-md-4'),
+                Div('death_date_from', css_class='col-md-2'),
+                Div('death_date_to', css_class='col-md-2'),
                 Div('death_cause', css_class='col-md-4'),
                 Div('grave', css_class='col-md-4'),
                 Div('date_of_captivity', css_class='col-md-4'),
+                Div('date_of_captivity_from', css_class='col-md-2'),
+                Div('date_of_captivity_to', css_class='col-md-2'),
                 Div('place_of_captivity', css_class='col-md-4'),
                 Div('camp', css_class='col-md-4'),
                 Div('camp_number', css_class='col-md-4'),
                 Div('lost_date', css_class='col-md-4'),
+                Div('lost_date_from', css_class='col-md-2'),
+                Div('lost_date_to', css_class='col-md-2'),
                 Div('field_post', css_class='col-md-4'),
                 Div('notes', css_class='col-md-4'),
                 css_class='row d-none', css_id='advanced-search-fields'
@@ -274,3 +332,10 @@ class PersonSearchForm(forms.Form):
                 css_class='mt-3'
             )
         )
+
+    def clean(self):
+        cleaned_data = super(PersonSearchForm, self).clean()
+        for f in get_range_search_fields():
+            if cleaned_data.get(f) and parse_date(cleaned_data[f]) is None:
+                self.add_error(f, 'Неизвестный формат даты')
+        return cleaned_data
@@ -0,0 +1,118 @@
+import logging
+import re
+import time
+from collections import defaultdict
+
+from website.lookups import search_text
+
+logger = logging.getLogger(__name__)
+
+# Hospital types with the word sequences naming them, longer sequences first. Words of 5 and more letters match
+# as prefixes, so case forms ("эвакогоспиталя") match too, shorter words must be equal.
+HOSPITAL_TYPES = [
+    ('ХППГ', [['ХИРУРГ', 'ПОЛЕВ', 'ПОДВИЖН', 'ГОСПИТАЛ'], ['ХИРУРГ', 'ППГ'], ['ХППГ']]),
+    ('ТППГ', [['ТЕРАПЕВТ', 'ПОЛЕВ', 'ПОДВИЖН', 'ГОСПИТАЛ'], ['ТЕРАПЕВТ', 'ППГ'], ['ТППГ']]),
+    ('ППГ', [['ПОЛЕВ', 'ПОДВИЖН', 'ГОСПИТАЛ'], ['ППГ']]),
+    ('СЭГ', [['СОРТИРОВОЧН', 'ЭВАКОГОСПИТАЛ'], ['СОРТИРОВОЧН', 'ЭГ'], ['СЭГ']]),
+    ('ЭГ', [['ЭВАКУАЦИОН', 'ГОСПИТАЛ'], ['ЭВАКОГОСПИТАЛ'], ['ЭГ']]),
+    ('ГЛР', [['ГОСПИТАЛ', 'ДЛЯ', 'ЛЕГКОРАНЕН'], ['ГЛР']]),
+    ('ИГ', [['ИНФЕКЦИОН', 'ГОСПИТАЛ'], ['ИГ']]),
+    ('МСБ', [['МЕДИКО', 'САНИТАРН', 'БАТАЛЬОН'], ['МЕДСАНБАТ'], ['МСБ']]),
+    ('ГОСПИТАЛЬ', [['ГОСПИТАЛ']]),
+]
+
+# Type of numbered hospitals named without one ("госпиталь 1234", "1234"), most of them are evacuation hospitals
+DEFAULT_TYPE = 'ЭГ'
+
+# Words not significant for the name
+NOISE_WORDS = {'N', 'НОМЕР', 'НОМ'}
+
+_WORD_RE = re.compile('[А-ЯA-Z]+|[0-9]+')
+
+KEY_MAX_LENGTH = 255
+
+LINK_CHUNK_SIZE = 500
+
+
+def _word_matches(word, pattern):
+    return word == pattern or (len(pattern) >= 5 and word.startswith(pattern))
+
+
+def _match_type(words, i):
+    for type, sequences in HOSPITAL_TYPES:
+        for sequence in sequences:
+            if len(sequence) <= len(words) - i and \
+                    all(_word_matches(word, pattern) for word, pattern in zip(words[i:], sequence)):
+                return type, len(sequence)
+    return None, 1
+
+
+def hospital_key(value):
+    """
+    Normalized hospital name. Numbered hospitals get their type and number ("Эвакогоспиталь № 1234 г. Калинин",
+    "ЭГ-1234" are "ЭГ 1234"), other names the words with types abbreviated. Empty for empty values.
+    """
+    if not value:
+        return ''
+    words = [word for word in _WORD_RE.findall(search_text(value).replace('Ё', 'Е')) if word not in NOISE_WORDS]
+    tokens = []
+    types = []
+    number = None
+    i = 0
+    while i < len(words):
+        type, length = _match_type(words, i)
+        if type:
+            tokens.append(type)
+            types.append(type)
+        else:
+            tokens.append(words[i])
+            if number is None and words[i].isdigit():
+                number = str(int(words[i]))
+        i += length
+
+    if number is not None:
+        types = [type for type in types if type != 'ГОСПИТАЛЬ']
+        return '%s %s' % (types[0] if types else DEFAULT_TYPE, number)
+    return ' '.join(tokens)[:KEY_MAX_LENGTH]
+
+
+def resolve_hospital_keys(keys):
+    """
+    Hospital ids by normalized keys. Keys of several hospitals are ambiguous and are not resolved.
+    """
+    from website.models import Hospital
+
+    ids = defaultdict(list)
+    for key, id in Hospital.objects.filter(key__in=keys).values_list('key', 'id'):
+        ids[key].append(id)
+    return {key: key_ids[0] for key, key_ids in ids.items() if len(key_ids) == 1}
+
+
+def link_hospitals(persons):
+    """
+    Links persons of the queryset to the hospitals named in their hospital text by the indexed hospital_key,
+    persons of unknown and ambiguous hospitals are unlinked. Returns the number of changed persons.
+    """
+    started = time.perf_counter()
+    persons = persons.order_by()
+    keys = sorted(set(persons.exclude(hospital_key='').values_list('hospital_key', flat=True).distinct()))
+
+    changed = 0
+    resolved_keys = set()
+    for i in range(0, len(keys), LINK_CHUNK_SIZE):
+        hospital_keys = defaultdict(list)
+        for key, id in resolve_hospital_keys(keys[i:i + LINK_CHUNK_SIZE]).items():
+            hospital_keys[id].append(key)
+            resolved_keys.add(key)
+        for id, id_keys in hospital_keys.items():
+            changed += persons.filter(hospital_key__in=id_keys).exclude(hospital_linked=id) \
+                .update(hospital_linked=id)
+
+    linked = persons.exclude(hospital_linked=None)
+    changed += linked.filter(hospital_key='').update(hospital_linked=None)
+    unresolved = [key for key in keys if key not in resolved_keys]
+    for i in range(0, len(unresolved), LINK_CHUNK_SIZE):
+        changed += linked.filter(hospital_key__in=unresolved[i:i + LINK_CHUNK_SIZE]).update(hospital_linked=None)
+
+    logger.info('Linked hospitals of %s persons in %.1f s', changed, time.perf_counter() - started)
+    return changed
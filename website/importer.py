@@ -1,12 +1,30 @@
+import codecs
 import csv
 import datetime
+import glob
+import hashlib
+import io
+import logging
 import os
 import mimetypes
+import pickle
+import struct
+import tempfile
+import time
 
 from mimetypes import MimeTypes
 from chardet import UniversalDetector
 
 import openpyxl
+from django.conf import settings
+from django.db import connection, transaction
+
+from website.models import Person, Import, DataVersion
+
+
+logger = logging.getLogger(__name__)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
 
 
 class ImporterFactory(object):
@@ -16,103 +34,438 @@ class ImporterFactory(object):
 
     def get_importer(self):
         m = MimeTypes()
+        # Not every system mime.types knows about xlsx
+        m.add_type(XLSX_MIMETYPE, '.xlsx')
         path = self._import_object.file.path
         _, ext = os.path.splitext(path)
         mimetype, _ = m.guess_type(path)
         if mimetype == 'text/csv':
-            return CSVImporter(self._import_object)
-        elif mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
-            return XLSXImporter(self._import_object)
+            importer = CSVImporter(self._import_object)
+            # The encoding is a part of the parse cache key, so it has to be known beforehand
+            importer.get_encoding()
+        elif mimetype == XLSX_MIMETYPE:
+            importer = XLSXImporter(self._import_object)
         else:
             raise Exception('Не знаю как обработать файл типа {0} ({1})'.format(ext, mimetype))
+        return CachedImporter(importer, self._import_object)
 
 
-class CSVImporter(object):
+class BaseImporter(object):
     def __init__(self, import_object):
-        self._cvs_file = import_object.file.path
         self._header = import_object.header
         self._numbering = import_object.numbering
-        self._delimiter = import_object.delimiter
-        self._quotechar = import_object.quotechar
 
     @staticmethod
     def get_name():
-        return 'csv'
+        raise NotImplementedError
 
-    def import_data(self):
+    def iter_rows(self):
+        """
+        Yields every non-empty row of the file as a list of values, header rows included
+        """
+        raise NotImplementedError
+
+    def iter_split_rows(self):
+        """
+        Yields (True, row) for header rows and (False, (numbering, values)) for data rows
+        """
+        header = self._header
+        for row in self.iter_rows():
+            if header:
+                header -= 1
+                yield True, row
+            else:
+                yield False, (row[0:self._numbering], row[self._numbering:])
+
+    def iter_data(self):
+        """
+        Yields data rows as (numbering, values) tuples without keeping the file in memory
+        """
+        for is_header, row in self.iter_split_rows():
+            if not is_header:
+                yield row
+
+    def scan(self, max_rows=None):
+        """
+        Reads the whole file once and returns header rows, first max_rows data rows (all of them if max_rows
+        is None), maximal data columns count and total data rows count
+        """
         data = []
         data_header = []
         data_cols = 0
+        data_len = 0
+
+        for is_header, row in self.iter_split_rows():
+            if is_header:
+                data_header.append(row)
+                continue
+            data_cols = max(data_cols, len(row[1]))
+            data_len += 1
+            if max_rows is None or data_len <= max_rows:
+                data.append(row)
 
-        detector = UniversalDetector()
-        detector.reset()
+        return data_header, data, data_cols, data_len
+
+    def import_data(self):
+        data_header, data, data_cols, _ = self.scan()
+        return data_header, data, data_cols
+
+
+class CSVImporter(BaseImporter):
+    ENCODING_CHUNK_SIZE = 64 * 1024
+    ENCODING_MAX_BYTES = 4 * 1024 * 1024
+
+    # UTF-32 goes first, its little endian BOM starts with the UTF-16 one
+    BOMS = (
+        (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF32_LE, 'utf-32'),
+        (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16'),
+    )
+
+    def __init__(self, import_object):
+        super(CSVImporter, self).__init__(import_object)
+        self._import_object = import_object
+        self._cvs_file = import_object.file.path
+        self._delimiter = import_object.delimiter
+        self._quotechar = import_object.quotechar
+
+    @staticmethod
+    def get_name():
+        return 'csv'
+
+    def iter_sample(self, f):
+        read = 0
+        while read < self.ENCODING_MAX_BYTES:
+            chunk = f.read(min(self.ENCODING_CHUNK_SIZE, self.ENCODING_MAX_BYTES - read))
+            if not chunk:
+                return
+            read += len(chunk)
+            yield chunk
+
+    def is_utf8(self, f):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            for chunk in self.iter_sample(f):
+                decoder.decode(chunk)
+        except UnicodeDecodeError:
+            return False
+        return True
+
+    def detect_encoding(self):
+        """
+        Guesses encoding by the BOM, by UTF-8 validity or with chardet, reading at most ENCODING_MAX_BYTES
+        """
         with open(self._cvs_file, 'rb') as f:
-            for line in f.readlines():
-                detector.feed(line)
-                if detector.done: break
+            head = f.read(4)
+            for bom, encoding in self.BOMS:
+                if head.startswith(bom):
+                    return encoding
+
+            f.seek(0)
+            if self.is_utf8(f):
+                return 'utf-8'
+
+            f.seek(0)
+            detector = UniversalDetector()
+            for chunk in self.iter_sample(f):
+                detector.feed(chunk)
+                if detector.done:
+                    break
             detector.close()
         encoding = detector.result['encoding']
 
         if not encoding:
             raise Exception('Невозможно определить кодировку или файл бинарный')
 
+        return encoding
+
+    def get_encoding(self):
+        if not self._import_object.encoding:
+            self._import_object.encoding = self.detect_encoding()
+            if self._import_object.pk:
+                Import.objects.filter(pk=self._import_object.pk).update(encoding=self._import_object.encoding)
+        return self._import_object.encoding
+
+    def iter_rows(self):
+        encoding = self.get_encoding()
+
         with open(self._cvs_file, 'r', encoding=encoding) as f:
             reader = csv.reader(f, delimiter=self._delimiter, quotechar=self._quotechar)
-            header = self._header
             for row in reader:
                 if row.count('') == len(row):
                     continue
-                if header:
-                    header -= 1
-                    data_header.append(row)
-                    continue
-                data_cols = max(data_cols, len(row[self._numbering:]))
-                data.append((row[0:self._numbering], row[self._numbering:]))
+                yield row
 
-        return data_header, data, data_cols
 
-
-class XLSXImporter(object):
+class XLSXImporter(BaseImporter):
     def __init__(self, import_object):
+        super(XLSXImporter, self).__init__(import_object)
         self._xlsx_file = import_object.file.path
-        self._header = import_object.header
-        self._numbering = import_object.numbering
 
     @staticmethod
     def get_name():
         return 'xlsx'
 
-    def import_data(self):
-        wb = openpyxl.load_workbook(self._xlsx_file)
-        wb.template = False
-        ws = wb.active
+    def iter_rows(self):
+        # Read-only mode parses the sheet lazily, so only the current row is kept in memory
+        wb = openpyxl.load_workbook(self._xlsx_file, read_only=True)
+        try:
+            ws = wb.active
+            for row in ws.iter_rows(values_only=True):
+                values_row = [self.format_value(value) if value else '' for value in row]
+                if values_row.count('') == len(values_row):
+                    continue
+                yield values_row
+        finally:
+            wb.close()
 
-        header = self._header
+    def format_cell(self, cell):
+        return self.format_value(cell.value)
 
-        data = []
+    @staticmethod
+    def format_value(value):
+        if type(value) is datetime.datetime:
+            if not value.time() or value.time() == datetime.time(0):
+                return value.strftime('%d.%m.%Y')
+            else:
+                return value.strftime('%d.%m.%Y %H:%M')
+        return value
+
+
+class ParseCache(object):
+    """
+    Parsed rows of an import file stored in IMPORT_CACHE_DIR. The file is a fixed size offset of the meta
+    record followed by pickled chunks of data rows and the meta record itself (header rows, columns and rows count).
+    The name includes the hash of the file and the parse settings, so changed settings never hit a stale cache,
+    and the stale file is removed when the file is parsed with the new settings.
+    """
+    VERSION = 1
+    CHUNK_SIZE = 1000
+    OFFSET = struct.Struct('<Q')
+
+    def __init__(self, import_object, importer_name):
+        key = hashlib.sha1(repr((
+            self.VERSION,
+            importer_name,
+            import_object.get_file_hash(),
+            import_object.header,
+            import_object.numbering,
+            import_object.delimiter,
+            import_object.quotechar,
+            import_object.encoding,
+        )).encode('utf-8')).hexdigest()
+        self.import_object = import_object
+        self.path = os.path.join(self.get_dir(), '%s-%s.cache' % (import_object.pk, key))
+
+    @staticmethod
+    def get_dir():
+        return settings.IMPORT_CACHE_DIR
+
+    @classmethod
+    def clear(cls, import_object, keep=None):
+        for path in glob.glob(os.path.join(cls.get_dir(), '%s-*.cache' % import_object.pk)):
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def build(self, importer):
+        os.makedirs(self.get_dir(), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.get_dir(), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.OFFSET.pack(0))
+                data_header, data_cols, data_len = self._write_chunks(f, importer)
+                meta_offset = f.tell()
+                pickle.dump((data_header, data_cols, data_len), f, pickle.HIGHEST_PROTOCOL)
+                f.seek(0)
+                f.write(self.OFFSET.pack(meta_offset))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.clear(self.import_object, keep=self.path)
+
+    def _write_chunks(self, f, importer):
+        chunk = []
         data_header = []
         data_cols = 0
+        data_len = 0
 
-        for row in ws.rows:
-            values_row = [self.format_cell(cell) if cell.value else '' for cell in row]
-            if values_row.count('') == len(values_row):
+        for is_header, row in importer.iter_split_rows():
+            if is_header:
+                data_header.append(row)
                 continue
+            data_cols = max(data_cols, len(row[1]))
+            data_len += 1
+            chunk.append(row)
+            if len(chunk) == self.CHUNK_SIZE:
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
 
-            if header:
-                header -= 1
-                data_header.append(values_row)
-                continue
-            else:
-                data_cols = max(data_cols, len(values_row[self._numbering:]))
-                data.append((values_row[0:self._numbering], values_row[self._numbering:]))
+        return data_header, data_cols, data_len
+
+    def read_meta(self):
+        with open(self.path, 'rb') as f:
+            meta_offset, = self.OFFSET.unpack(f.read(self.OFFSET.size))
+            f.seek(meta_offset)
+            return pickle.load(f)
+
+    def iter_data(self):
+        with open(self.path, 'rb') as f:
+            meta_offset, = self.OFFSET.unpack(f.read(self.OFFSET.size))
+            while f.tell() < meta_offset:
+                for row in pickle.load(f):
+                    yield row
+
+
+class CachedImporter(object):
+    """
+    Wraps an importer so the file is parsed once and preview, show all and apply read the parsed rows from ParseCache
+    """
+    def __init__(self, importer, import_object):
+        self._importer = importer
+        self._cache = ParseCache(import_object, importer.get_name())
+
+    def get_name(self):
+        return self._importer.get_name()
+
+    def _ensure_cache(self):
+        if not self._cache.exists():
+            self._cache.build(self._importer)
+
+    def iter_data(self):
+        self._ensure_cache()
+        return self._cache.iter_data()
 
+    def scan(self, max_rows=None):
+        self._ensure_cache()
+        data_header, data_cols, data_len = self._cache.read_meta()
+        data = []
+        if max_rows is None or max_rows > 0:
+            for row in self._cache.iter_data():
+                if max_rows is not None and len(data) >= max_rows:
+                    break
+                data.append(row)
+        return data_header, data, data_cols, data_len
+
+    def import_data(self):
+        data_header, data, data_cols, _ = self.scan()
         return data_header, data, data_cols
 
-    def format_cell(self, cell):
-        value = cell.value
-        if type(value) is datetime.datetime:
-            if not value.time() or value.time() == datetime.time(0):
-                return value.strftime('%d.%m.%Y')
-            else:
-                return value.strftime('%d.%m.%Y %H:%M')
-        return value
\ No newline at end of file
+
+class PersonImportPipeline(object):
+    """
+    Creates persons from the rows of an import file chunk by chunk, so memory use does not depend on the file size.
+    mapping is a dict of Person field name to data column index.
+    """
+    CHUNK_SIZE = 1000
+
+    def __init__(self, import_object, mapping, chunk_size=None):
+        self._import_object = import_object
+        self._mapping = mapping
+        self._chunk_size = chunk_size or self.CHUNK_SIZE
+        self._states = set(i[0] for i in Person.STATES)
+
+    def iter_chunks(self):
+        chunk = []
+        for row in ImporterFactory(self._import_object).get_importer().iter_data():
+            chunk.append(row[1])
+            if len(chunk) == self._chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def clean_state(self, value):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None
+        return value if value in self._states else None
+
+    def map_chunk(self, rows):
+        persons = [Person(cemetery=self._import_object.cemetery, active_import=self._import_object) for _ in rows]
+        for field, col in self._mapping.items():
+            values = [row[col] if col < len(row) else '' for row in rows]
+            if field == 'state':
+                values = [self.clean_state(value) for value in values]
+            for person, value in zip(persons, values):
+                setattr(person, field, Person.translate_mapped_field_value(field, value, self._import_object))
+        for person in persons:
+            person.normalize_names()
+            person.update_derived_fields()
+        return persons
+
+    def insert_chunk(self, persons):
+        Person.objects.bulk_create(persons)
+
+    def run(self, progress=None):
+        """
+        Imports all rows, progress is called with the number of processed rows after every chunk. Chunks are
+        committed together with the progress, an exception of it rolls the chunk back.
+        """
+        started = time.perf_counter()
+        rows_processed = 0
+        for rows in self.iter_chunks():
+            persons = self.map_chunk(rows)
+            with transaction.atomic():
+                self.insert_chunk(persons)
+                rows_processed += len(rows)
+                if progress:
+                    progress(rows_processed)
+
+        elapsed = time.perf_counter() - started
+        logger.info('Import %s: %s rows in %.1f s (%.0f rows/s)', self._import_object.pk, rows_processed, elapsed,
+                    rows_processed / elapsed if elapsed else 0)
+        return rows_processed
+
+
+class CopyPersonImportPipeline(PersonImportPipeline):
+    """
+    PostgreSQL version of the pipeline, every chunk is streamed into the persons table with COPY FROM STDIN
+    instead of INSERT statements
+    """
+    CHUNK_SIZE = 10000
+
+    def __init__(self, import_object, mapping, chunk_size=None):
+        super(CopyPersonImportPipeline, self).__init__(import_object, mapping, chunk_size)
+        self._fields = [f for f in Person._meta.concrete_fields if not f.primary_key]
+        self._copy_sql = 'COPY %s (%s) FROM STDIN' % (
+            connection.ops.quote_name(Person._meta.db_table),
+            ', '.join(connection.ops.quote_name(f.column) for f in self._fields)
+        )
+
+    @staticmethod
+    def copy_value(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def insert_chunk(self, persons):
+        data = io.StringIO()
+        for person in persons:
+            values = [f.get_db_prep_save(getattr(person, f.attname), connection) for f in self._fields]
+            data.write('\t'.join(self.copy_value(value) for value in values))
+            data.write('\n')
+        data.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(self._copy_sql, data)
+        DataVersion.bump(DataVersion.PERSONS)
+
+
+def get_import_pipeline(import_object, mapping):
+    if connection.vendor == 'postgresql':
+        return CopyPersonImportPipeline(import_object, mapping)
+    return PersonImportPipeline(import_object, mapping)
@@ -0,0 +1,221 @@
+import datetime
+import json
+import logging
+import os
+import secrets
+import tempfile
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from website import export
+from website.duplicates import find_import_duplicates
+from website.hospitals import link_hospitals
+from website.importer import ImporterFactory, get_import_pipeline
+from website.models import DataVersion, Export, Import, Person
+from website.search import search_persons
+
+logger = logging.getLogger(__name__)
+
+# Exports report to be alive after every this number of written rows
+HEARTBEAT_ROWS = 10000
+
+
+def enqueue_import(obj, mapping):
+    obj.mapping = json.dumps(mapping)
+    obj.status = Import.QUEUED
+    obj.rows_total = 0
+    obj.rows_processed = 0
+    obj.error = ''
+    obj.queued_at = timezone.now()
+    obj.started_at = None
+    obj.finished_at = None
+    obj.save()
+
+
+class JobClaimed(Exception):
+    """
+    The job was claimed again by another worker, after this one missed heartbeats
+    """
+
+
+def claim_job(model):
+    """
+    Marks the oldest queued job of the model as running and returns it, skipping jobs locked by other workers.
+    Running jobs without a heartbeat for JOB_TIMEOUT were left by a stopped worker and are claimed again. Returns
+    the job and whether it was taken from a stopped worker.
+    """
+    stale = timezone.now() - datetime.timedelta(seconds=settings.JOB_TIMEOUT)
+    with transaction.atomic():
+        obj = model.objects.select_for_update(skip_locked=True) \
+            .filter(Q(status=model.QUEUED) | Q(status=model.RUNNING, heartbeat_at__lt=stale)) \
+            .order_by('queued_at', 'id').first()
+        if obj is None:
+            return None, False
+        interrupted = obj.status == model.RUNNING
+        if interrupted:
+            logger.warning('%s %s without heartbeat since %s is claimed again', model.__name__, obj.pk,
+                           obj.heartbeat_at)
+        obj.status = model.RUNNING
+        obj.started_at = obj.heartbeat_at = timezone.now()
+        obj.save(update_fields=['status', 'started_at', 'heartbeat_at'])
+    return obj, interrupted
+
+
+def heartbeat(obj, **fields):
+    """
+    Reports the claimed job as alive and updates the given fields of it. The start time identifies the claim, when
+    another worker claimed the job again JobClaimed is raised and the changes of the current transaction are to be
+    rolled back.
+    """
+    model = type(obj)
+    if not model.objects.filter(pk=obj.pk, status=model.RUNNING, started_at=obj.started_at) \
+            .update(heartbeat_at=timezone.now(), **fields):
+        raise JobClaimed('%s %s is not claimed by this worker' % (model.__name__, obj.pk))
+
+
+def claim_import():
+    obj, interrupted = claim_job(Import)
+    if interrupted:
+        # Persons of the stopped worker are imported again, its chunks are committed with heartbeats so
+        # none are added after the claim
+        Person.objects.filter(active_import=obj).delete()
+    return obj
+
+
+def run_import(obj):
+    mapping = {field: int(col) for field, col in json.loads(obj.mapping).items()}
+
+    def progress(rows_processed):
+        heartbeat(obj, rows_processed=rows_processed)
+
+    try:
+        _, _, _, rows_total = ImporterFactory(obj).get_importer().scan(0)
+        heartbeat(obj, rows_total=rows_total)
+        rows_processed = get_import_pipeline(obj, mapping).run(progress)
+    except JobClaimed:
+        logger.warning('Import %s was claimed by another worker', obj.pk)
+        return False
+    except Exception as e:
+        logger.exception('Import %s failed', obj.pk)
+        with transaction.atomic():
+            try:
+                heartbeat(obj, status=Import.FAILED, error=str(e), finished_at=timezone.now())
+            except JobClaimed:
+                # Persons belong to the worker running the import now
+                return False
+            # Committed chunks are removed with the failure, PersonQuerySet.delete bumps the persons version and
+            # refreshes the statistics
+            Person.objects.filter(active_import=obj).delete()
+        return False
+
+    try:
+        link_hospitals(Person.objects.filter(active_import=obj))
+    except Exception:
+        # Links are restored by the link_hospitals command
+        logger.exception('Linking hospitals of import %s failed', obj.pk)
+
+    try:
+        find_import_duplicates(obj)
+    except Exception:
+        # Duplicates are only a hint for the review of the import
+        logger.exception('Duplicate detection of import %s failed', obj.pk)
+
+    try:
+        heartbeat(obj, status=Import.DONE, data_added=True, rows_processed=rows_processed, finished_at=timezone.now())
+    except JobClaimed:
+        logger.warning('Import %s was claimed by another worker', obj.pk)
+        return False
+    return True
+
+
+def enqueue_export(format, cemetery=None, search=None):
+    """
+    Returns the export of the current persons data, queueing it unless a valid file already exists
+    """
+    obj, created = Export.objects.get_or_create(
+        format=format, cemetery=cemetery, search=search, data_version=DataVersion.get(DataVersion.PERSONS),
+        defaults={'queued_at': timezone.now()})
+    if not created and not obj.is_in_progress() and not obj.is_ready():
+        obj.status = Export.QUEUED
+        obj.error = ''
+        obj.queued_at = timezone.now()
+        obj.started_at = None
+        obj.finished_at = None
+        obj.save()
+    return obj
+
+
+def claim_export():
+    obj, _ = claim_job(Export)
+    return obj
+
+
+def get_export_queryset(obj):
+    if obj.cemetery_id:
+        return Person.objects.filter(cemetery=obj.cemetery_id)
+    persons = Person.objects.filter(active_import=None)
+    if obj.search_id:
+        persons = search_persons(persons, json.loads(obj.search.fields))
+    return persons
+
+
+def iter_heartbeats(obj, rows):
+    for i, row in enumerate(rows, 1):
+        if i % HEARTBEAT_ROWS == 0:
+            heartbeat(obj)
+        yield row
+
+
+def run_export(obj):
+    name = '%s-%s.%s' % (obj.pk, secrets.token_hex(8), obj.format)
+    path = obj.file.storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        # Written next to the final path and renamed, so the file is never seen half written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                rows = export.iter_export_rows(get_export_queryset(obj))
+                rows = export.WRITERS[obj.format](iter_heartbeats(obj, rows), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        heartbeat(obj, status=Export.DONE, file=name, rows=rows - 1, finished_at=timezone.now())
+    except JobClaimed:
+        logger.warning('Export %s was claimed by another worker', obj.pk)
+        if os.path.exists(path):
+            os.unlink(path)
+        return False
+    except Exception as e:
+        logger.exception('Export %s failed', obj.pk)
+        Export.objects.filter(pk=obj.pk, started_at=obj.started_at).update(
+            status=Export.FAILED, error=str(e), finished_at=timezone.now())
+        return False
+
+    # Files made from older data of the same persons are not served anymore
+    stale = Export.objects.filter(cemetery=obj.cemetery_id, search=obj.search_id, format=obj.format,
+                                  data_version__lt=obj.data_version).exclude(status=Export.RUNNING)
+    for stale_obj in stale:
+        stale_obj.delete()
+    return True
+
+
+def run_pending_jobs():
+    """
+    Runs queued jobs until the queue is empty, returns the number of processed jobs
+    """
+    processed = 0
+    while True:
+        obj = claim_import()
+        if obj is not None:
+            run_import(obj)
+        else:
+            obj = claim_export()
+            if obj is None:
+                return processed
+            run_export(obj)
+        processed += 1
@@ -0,0 +1,56 @@
+import unicodedata
+
+from django.db.backends.signals import connection_created
+from django.db.models import CharField, Lookup, TextField
+from django.dispatch import receiver
+
+
+def unaccent(value):
+    value = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in value if not unicodedata.combining(c))
+
+
+def search_text(value):
+    """
+    Python version of UPPER(immutable_unaccent(value)) for databases without unaccent
+    """
+    if value is None:
+        return None
+    return unaccent(value).upper()
+
+
+@receiver(connection_created)
+def register_sqlite_functions(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('search_text', 1, search_text)
+
+
+@CharField.register_lookup
+@TextField.register_lookup
+class SearchContains(Lookup):
+    """
+    Case and accent insensitive substring search. On PostgreSQL the expression matches trigram GIN indexes
+    created in migration 0049_trigram_indexes.
+    """
+    lookup_name = 'ucontains'
+    prepare_rhs = False
+    function = 'UPPER'
+
+    def get_db_prep_lookup(self, value, connection):
+        return '%s', [connection.ops.prep_for_like_query(value)]
+
+    def as_sql(self, compiler, connection, function=None):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        sql = "%s(%s) LIKE '%%%%' || %s(%s) || '%%%%' ESCAPE '\\'" % (
+            function or self.function, lhs, function or self.function, rhs)
+        return sql, lhs_params + rhs_params
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection, function='search_text')
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        sql = "UPPER(immutable_unaccent(%s)) LIKE '%%%%' || UPPER(immutable_unaccent(%s)) || '%%%%'" % (lhs, rhs)
+        return sql, lhs_params + rhs_params
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from website.models import Person
+from website.stats import defer_stats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes derived fields of all persons (screen fields, ...)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fields = Person.get_derived_fields()
+        last_id = 0
+        total = 0
+        with defer_stats():
+            while True:
+                persons = list(Person.objects.filter(id__gt=last_id).order_by('id')[:options['batch_size']])
+                if not persons:
+                    break
+                for person in persons:
+                    person.update_derived_fields()
+                Person.objects.bulk_update(persons, fields)
+                last_id = persons[-1].id
+                total += len(persons)
+
+        self.stdout.write('Updated %s persons' % total)
@@ -0,0 +1,87 @@
+import json
+import subprocess
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from website.benchmarks import BENCHMARKS, shared_corpus
+
+
+class Command(BaseCommand):
+    help = 'Runs performance benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run, all by default (%s)' % ', '.join(BENCHMARKS))
+        parser.add_argument('--rows', type=int, default=200000, help='Rows count of generated data')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of timed calls of repeated benchmarks')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of generated data')
+        parser.add_argument('--max-peak-mb', type=float, default=None,
+                            help='Fail if peak memory of any benchmark exceeds this value')
+        parser.add_argument('--output', help='Write results as JSON to this file')
+        parser.add_argument('--compare', help='Compare timings with results of an earlier run written by --output')
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark %s' % name)
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)['results']
+
+        failed = []
+        results = OrderedDict()
+        # The generated corpus is shared by the benchmarks and rolled back at the end
+        with shared_corpus():
+            for name in names:
+                result = BENCHMARKS[name](rows=options['rows'], repeat=options['repeat'], seed=options['seed'])
+                results[name] = result
+                self.stdout.write('%s: %s' % (name, ', '.join('%s=%s' % (k, self.format_value(k, v))
+                                                              for k, v in result.items())))
+                if baseline is not None and name in baseline:
+                    self.write_comparison(result, baseline[name])
+                peak_mb = result.get('peak_memory', 0) / 1024 / 1024
+                if options['max_peak_mb'] is not None and peak_mb > options['max_peak_mb']:
+                    failed.append('%s peak memory %.1f MB exceeds %.1f MB' % (name, peak_mb, options['max_peak_mb']))
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(OrderedDict([
+                    ('created_at', timezone.now().isoformat()),
+                    ('commit', self.get_commit()),
+                    ('database', connection.vendor),
+                    ('rows', options['rows']),
+                    ('repeat', options['repeat']),
+                    ('seed', options['seed']),
+                    ('results', results),
+                ]), f, indent=2)
+
+        if failed:
+            raise CommandError('; '.join(failed))
+
+    def write_comparison(self, result, baseline):
+        changes = []
+        for k, v in result.items():
+            if k.endswith('seconds') and baseline.get(k):
+                changes.append('%s=%+.0f%%' % (k, (v / baseline[k] - 1) * 100))
+        if changes:
+            self.stdout.write('  compared: %s' % ', '.join(changes))
+
+    @staticmethod
+    def get_commit():
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def format_value(key, value):
+        if key.endswith('peak_memory') or key == 'max_rss':
+            return '%.1fMB' % (value / 1024 / 1024)
+        if isinstance(value, float):
+            return '%.2f' % value
+        return value
@@ -0,0 +1,34 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from website.models import Export, SearchData
+
+
+class Command(BaseCommand):
+    help = 'Deletes saved searches not used recently'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.SEARCH_DATA_TTL_DAYS,
+                            help='Delete searches not used for this number of days')
+        parser.add_argument('--max-rows', type=int, default=settings.SEARCH_DATA_MAX_ROWS,
+                            help='Keep at most this number of most recently used searches')
+
+    def handle(self, *args, **options):
+        expired = SearchData.objects.filter(last_used__lt=timezone.now() - datetime.timedelta(days=options['days']))
+        ids = set(expired.values_list('id', flat=True))
+        ids.update(SearchData.objects.order_by('-last_used', '-id')
+                   .values_list('id', flat=True)[options['max_rows']:])
+
+        deleted = 0
+        ids = sorted(ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            # Exports are deleted one by one to remove their files
+            for export in Export.objects.filter(search__in=chunk):
+                export.delete()
+            deleted += SearchData.objects.filter(id__in=chunk).delete()[1].get('website.SearchData', 0)
+
+        self.stdout.write('Deleted %s searches' % deleted)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from website.synthetic import create_corpus, write_import_file
+
+
+class Command(BaseCommand):
+    help = 'Generates reproducible synthetic cemeteries, hospitals and persons, and import files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--persons', type=int, default=100000, help='Number of persons to create')
+        parser.add_argument('--cemeteries', type=int, default=20, help='Number of cemeteries to create')
+        parser.add_argument('--hospitals', type=int, default=200, help='Number of hospitals to create')
+        parser.add_argument('--seed', type=int, default=0, help='The same seed generates the same data')
+        parser.add_argument('--actual-ratio', type=float, default=0.2,
+                            help='Share of the known fields having an actual value')
+        parser.add_argument('--import-file', help='Write an import file of generated rows to this path')
+        parser.add_argument('--import-rows', type=int, default=10000, help='Number of rows of the import file')
+        parser.add_argument('--import-format', choices=['csv', 'xlsx'], default='csv')
+
+    def handle(self, *args, **options):
+        if options['persons']:
+            def progress(count):
+                if count % 10000 == 0:
+                    self.stdout.write('Created %s persons' % count)
+
+            with transaction.atomic():
+                cemeteries, hospitals = create_corpus(options['persons'], options['cemeteries'],
+                                                      options['hospitals'], options['seed'],
+                                                      options['actual_ratio'], progress)
+            self.stdout.write('Created %s cemeteries, %s hospitals and %s persons' % (
+                len(cemeteries), len(hospitals), options['persons']))
+
+        if options['import_file']:
+            write_import_file(options['import_file'], options['import_rows'], options['seed'],
+                              options['import_format'])
+            self.stdout.write('Written %s rows to %s' % (options['import_rows'], options['import_file']))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from website.hospitals import hospital_key, link_hospitals
+from website.models import Hospital, Person
+
+
+class Command(BaseCommand):
+    help = 'Links persons to the hospitals named in their hospital text'
+
+    def handle(self, *args, **options):
+        hospitals = [hospital for hospital in Hospital.objects.all() if hospital.key != hospital_key(hospital.name)]
+        for hospital in hospitals:
+            hospital.key = hospital_key(hospital.name)
+        Hospital.objects.bulk_update(hospitals, ['key'])
+        self.stdout.write('Updated keys of %s hospitals' % len(hospitals))
+
+        changed = link_hospitals(Person.objects.all())
+        self.stdout.write('Updated %s persons' % changed)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from website.models import DataVersion, Place, PlaceAlias
+from website.places import PLACES_FILE, load_places, read_places
+
+
+class Command(BaseCommand):
+    help = 'Loads regions and their aliases to the gazetteer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=PLACES_FILE,
+                            help='JSON list of {"name": ..., "aliases": [...]}')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            places, aliases = load_places(Place, PlaceAlias, read_places(options['file']))
+        DataVersion.bump(DataVersion.PLACES)
+
+        self.stdout.write('Created %s places and %s aliases' % (places, aliases))
+        self.stdout.write('Run backfill_persons to match persons with the new places')
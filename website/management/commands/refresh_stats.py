@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from website.stats import refresh_all_stats
+
+
+class Command(BaseCommand):
+    help = 'Recounts persons statistics of all cemeteries and hospitals'
+
+    def handle(self, *args, **options):
+        refresh_all_stats()
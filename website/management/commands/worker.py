@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from website.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (imports, exports)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process queued jobs and exit')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds to wait between queue polls')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            processed = run_pending_jobs()
+            if processed:
+                self.stdout.write('Processed %s job(s)' % processed)
+            if options['once']:
+                return
+            time.sleep(options['sleep'])
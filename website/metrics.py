@@ -0,0 +1,285 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from django.conf import settings
+
+from website.querystats import QueryCounter, record_queries
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERIES_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+# name: (type, help, buckets)
+METRICS = OrderedDict([
+    ('burialdb_requests_total', ('counter', 'Requests by view, method and status', None)),
+    ('burialdb_request_duration_seconds', ('histogram', 'Request latency by view', SECONDS_BUCKETS)),
+    ('burialdb_request_queries', ('histogram', 'SQL queries per request by view', QUERIES_BUCKETS)),
+    ('burialdb_request_query_seconds', ('histogram', 'SQL time per request by view', SECONDS_BUCKETS)),
+    ('burialdb_response_size_bytes', ('histogram', 'Response size by view, streaming responses excluded',
+                                      BYTES_BUCKETS)),
+    ('burialdb_template_render_seconds', ('histogram', 'Template response render time by view', SECONDS_BUCKETS)),
+])
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Other methods are counted as "other", so clients can not add label values
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+# Metrics of finished processes, see fold_finished_processes
+ARCHIVE_FILE = 'archive.json'
+
+
+class Registry:
+    """
+    Metrics of the current process. Every process writes them to its own file in METRICS_DIR, the metrics
+    endpoint sums the files of all processes, so every uwsgi worker counts. Files of finished processes are
+    moved to the archive, see fold_finished_processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.values = {}
+        self.flushed_at = 0
+
+    def get_path(self, pid=None):
+        return os.path.join(settings.METRICS_DIR, '%s.json' % (pid or os.getpid()))
+
+    def ensure_process(self):
+        # uwsgi forks the workers after loading the application
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.values = {}
+        self.flushed_at = time.monotonic()
+        try:
+            self.values = read_values(self.get_path())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logger.exception('Failed to read metrics of process %s', self.pid)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.ensure_process()
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(labels))
+        with self.lock:
+            self.ensure_process()
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(buckets) + 1) + [0]
+            # counts of the buckets by the upper bound, the last one is +Inf, then the sum
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def flush(self, force=False):
+        with self.lock:
+            self.ensure_process()
+            if not force and time.monotonic() - self.flushed_at < settings.METRICS_FLUSH_INTERVAL:
+                return
+            self.flushed_at = time.monotonic()
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        try:
+            write_values(self.get_path(), values)
+        except OSError:
+            logger.exception('Failed to write metrics of process %s', self.pid)
+
+
+def read_values(path):
+    with open(path, encoding='utf-8') as f:
+        return {(name, tuple(labels)): value for name, labels, value in json.load(f) if name in METRICS}
+
+
+def write_values(path, values):
+    temp_path = '%s.tmp' % path
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump([[name, list(labels), value] for (name, labels), value in values.items()], f)
+    os.replace(temp_path, path)
+
+
+def add_values(total, values):
+    for key, value in values.items():
+        if isinstance(value, list):
+            key_total = total.setdefault(key, [0] * len(value))
+            for i, item in enumerate(value):
+                key_total[i] += item
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+registry = Registry()
+
+
+@atexit.register
+def flush_on_exit():
+    if settings.METRICS and registry.pid == os.getpid():
+        registry.flush(force=True)
+
+
+def get_process_paths():
+    """
+    Metrics files of processes by pid
+    """
+    paths = {}
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name.isdigit():
+            paths[int(name)] = path
+    return paths
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def fold_finished_processes():
+    """
+    Adds the metrics of finished processes to ARCHIVE_FILE and removes their files, so restarted uwsgi workers
+    do not leave files behind. POSIX only, os.kill() can not check processes on Windows.
+    """
+    import fcntl
+
+    with open(os.path.join(settings.METRICS_DIR, 'archive.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        finished = [path for pid, path in get_process_paths().items() if not is_running(pid)]
+        if not finished:
+            return
+        archive_path = os.path.join(settings.METRICS_DIR, ARCHIVE_FILE)
+        try:
+            values = read_values(archive_path)
+        except FileNotFoundError:
+            values = {}
+        for path in finished:
+            add_values(values, read_values(path))
+        write_values(archive_path, values)
+        for path in finished:
+            os.unlink(path)
+
+
+def collect():
+    """
+    Metrics of all processes summed by name and labels, and the number of running processes
+    """
+    registry.flush(force=True)
+    if os.name == 'posix':
+        try:
+            fold_finished_processes()
+        except (OSError, ValueError):
+            logger.exception('Failed to archive metrics of finished processes')
+
+    values = {}
+    process_paths = get_process_paths()
+    for path in list(process_paths.values()) + [os.path.join(settings.METRICS_DIR, ARCHIVE_FILE)]:
+        try:
+            add_values(values, read_values(path))
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError):
+            logger.exception('Failed to read metrics %s', path)
+    return values, len(process_paths)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    return ','.join('%s="%s"' % (name, escape_label(value)) for name, value in zip(names, values))
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metrics(values, processes):
+    """
+    Metrics in the Prometheus text format
+    """
+    label_names = {'burialdb_requests_total': ('view', 'method', 'status')}
+    lines = [
+        '# HELP burialdb_metrics_processes Running processes with collected metrics',
+        '# TYPE burialdb_metrics_processes gauge',
+        'burialdb_metrics_processes %s' % processes,
+    ]
+    for name, (type, help, buckets) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+        names = label_names.get(name, ('view',))
+        for (key_name, labels), value in sorted(values.items()):
+            if key_name != name:
+                continue
+            labels = format_labels(names, labels)
+            if type == 'counter':
+                lines.append('%s{%s} %s' % (name, labels, format_number(value)))
+                continue
+            count = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), value):
+                count += bucket_count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, count))
+            lines.append('%s_sum{%s} %s' % (name, labels, format_number(value[-1])))
+            lines.append('%s_count{%s} %s' % (name, labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """
+    Records latency, SQL queries, response size and template render time of requests by URL name for
+    the metrics endpoint. Enabled by the METRICS setting.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        # Only the number and time of queries are kept, statements of large requests would use memory
+        with record_queries(QueryCounter()) as stats:
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unresolved'
+        method = request.method if request.method in METHODS else 'other'
+        registry.inc('burialdb_requests_total', [view, method, str(response.status_code)])
+        registry.observe('burialdb_request_duration_seconds', [view], duration)
+        registry.observe('burialdb_request_queries', [view], stats.count)
+        registry.observe('burialdb_request_query_seconds', [view], stats.time)
+        if not response.streaming:
+            registry.observe('burialdb_response_size_bytes', [view], len(response.content))
+        render_time = getattr(request, '_metrics_render_time', None)
+        if render_time is not None:
+            registry.observe('burialdb_template_render_seconds', [view], render_time)
+        registry.flush()
+        return response
+
+    def process_template_response(self, request, response):
+        # called right before the response is rendered
+        started = time.perf_counter()
+
+        def rendered(response):
+            request._metrics_render_time = time.perf_counter() - started
+
+        response.add_post_render_callback(rendered)
+        return response
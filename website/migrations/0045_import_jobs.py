@@ -0,0 +1,53 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0044_searchdata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='mapping',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='rows_processed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='rows_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Новый'), (1, 'В очереди'), (2, 'Выполняется'), (3, 'Выполнен'), (4, 'Ошибка')], db_index=True, default=0),
+        ),
+    ]
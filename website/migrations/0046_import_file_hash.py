@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0045_import_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+    ]
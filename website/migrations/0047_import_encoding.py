@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0046_import_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='import',
+            name='encoding',
+            field=models.CharField(blank=True, help_text='Определяется автоматически, если не указана', max_length=64, verbose_name='Кодировка'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:44
+
+from django.db import migrations, models
+from django.db.models import CharField, F, Value
+from django.db.models.functions import Coalesce, NullIf
+
+
+SCREEN_FIELDS = {
+    'screen_name': ['fio_actual', 'fio', 'ontombstone'],
+    'screen_born_region': ['born_region_actual', 'born_region'],
+    'screen_born_address': ['born_address_actual', 'born_address'],
+    'screen_address': ['address_actual', 'address'],
+    'screen_military_unit': ['military_unit_actual', 'military_unit'],
+}
+
+
+def fill_screen_fields(apps, schema_editor):
+    Person = apps.get_model('website', 'Person')
+    expressions = {}
+    for screen_field, fields in SCREEN_FIELDS.items():
+        sources = [NullIf(F(f), Value('')) for f in fields]
+        if screen_field == 'screen_name':
+            sources.append(Value(''))
+        expressions[screen_field] = Coalesce(*sources, output_field=CharField())
+    Person.objects.update(**expressions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0047_import_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='screen_address',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='screen_born_address',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='screen_born_region',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='screen_military_unit',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='screen_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['screen_name', 'id'], name='website_person_screen_name'),
+        ),
+        migrations.RunPython(fill_screen_fields, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+import warnings
+
+from django.db import migrations
+
+# Person columns searched with the __ucontains lookup (see website.lookups.SearchContains)
+SEARCH_FIELDS = [
+    'fio',
+    'fio_actual',
+    'ontombstone',
+    'hospital',
+    'born_region',
+    'born_region_actual',
+    'born_address',
+    'born_address_actual',
+    'conscription_place',
+    'conscription_place_actual',
+    'military_unit',
+    'military_unit_actual',
+    'rank',
+    'rank_actual',
+    'position',
+    'position_actual',
+    'address',
+    'address_actual',
+    'relatives',
+    'relatives_actual',
+    'grave',
+    'grave_actual',
+    'place_of_captivity',
+    'place_of_captivity_actual',
+    'camp',
+    'camp_actual',
+    'field_post',
+    'notes',
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    # unaccent() is only STABLE because of the dictionary lookup, an index expression requires IMMUTABLE
+    schema_editor.execute(
+        "CREATE OR REPLACE FUNCTION immutable_unaccent(text) RETURNS text AS "
+        "$$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$ "
+        "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT"
+    )
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if not cursor.fetchone():
+            warnings.warn('pg_trgm extension is not available, search will work without trigram indexes')
+            return
+
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS website_person_%s_trgm ON website_person '
+            'USING gin (UPPER(immutable_unaccent(%s)) gin_trgm_ops)' % (field, field)
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for field in SEARCH_FIELDS:
+        schema_editor.execute('DROP INDEX IF EXISTS website_person_%s_trgm' % field)
+    schema_editor.execute('DROP FUNCTION IF EXISTS immutable_unaccent(text)')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('website', '0048_person_screen_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, reverse_code=drop_trigram_indexes),
+    ]
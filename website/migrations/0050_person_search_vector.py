@@ -0,0 +1,92 @@
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Person columns indexed by search_vector, grouped by rank weight
+SEARCH_VECTOR_WEIGHTS = [
+    ('A', ['fio', 'fio_actual', 'ontombstone']),
+    ('B', [
+        'hospital',
+        'born_region',
+        'born_region_actual',
+        'born_address',
+        'born_address_actual',
+        'conscription_place',
+        'conscription_place_actual',
+        'military_unit',
+        'military_unit_actual',
+        'rank',
+        'rank_actual',
+        'position',
+        'position_actual',
+        'address',
+        'address_actual',
+        'relatives',
+        'relatives_actual',
+        'receipt_cause',
+        'receipt_cause_actual',
+        'death_cause',
+        'death_cause_actual',
+        'grave',
+        'grave_actual',
+        'place_of_captivity',
+        'place_of_captivity_actual',
+        'camp',
+        'camp_actual',
+        'field_post',
+        'field_post_actual',
+    ]),
+    ('D', ['notes']),
+]
+
+
+def search_vector_sql(prefix):
+    parts = []
+    for weight, fields in SEARCH_VECTOR_WEIGHTS:
+        text = " || ' ' || ".join("coalesce(%s%s, '')" % (prefix, f) for f in fields)
+        parts.append("setweight(to_tsvector('russian', immutable_unaccent(%s)), '%s')" % (text, weight))
+    return ' || '.join(parts)
+
+
+def create_search_vector_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    columns = ', '.join(f for _, fields in SEARCH_VECTOR_WEIGHTS for f in fields)
+    # The vector is maintained by the database so bulk_create, COPY and queryset updates keep it current
+    schema_editor.execute(
+        "CREATE OR REPLACE FUNCTION website_person_search_vector() RETURNS trigger AS $$ "
+        "BEGIN NEW.search_vector := %s; RETURN NEW; END "
+        "$$ LANGUAGE plpgsql" % search_vector_sql('NEW.')
+    )
+    schema_editor.execute(
+        'CREATE TRIGGER website_person_search_vector BEFORE INSERT OR UPDATE OF %s ON website_person '
+        'FOR EACH ROW EXECUTE PROCEDURE website_person_search_vector()' % columns
+    )
+    schema_editor.execute('UPDATE website_person SET search_vector = %s' % search_vector_sql(''))
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS website_person_search_vector ON website_person USING gin (search_vector)'
+    )
+
+
+def drop_search_vector_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute('DROP INDEX IF EXISTS website_person_search_vector')
+    schema_editor.execute('DROP TRIGGER IF EXISTS website_person_search_vector ON website_person')
+    schema_editor.execute('DROP FUNCTION IF EXISTS website_person_search_vector()')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('website', '0049_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_vector_trigger, reverse_code=drop_search_vector_trigger),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:52
+
+from django.db import migrations, models
+
+
+def create_persons_version(apps, schema_editor):
+    DataVersion = apps.get_model('website', 'DataVersion')
+    DataVersion.objects.get_or_create(name='persons')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0050_person_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32, unique=True)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_persons_version, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:53
+
+from functools import reduce
+from operator import and_, or_
+
+from django.db import migrations, models
+from django.db.models import Case, Q, Value, When
+
+STATUS_FIELDS = [
+    'cemetery_actual',
+    'fio_actual',
+    'year_actual',
+    'born_region_actual',
+    'born_address_actual',
+    'conscription_place_actual',
+    'military_unit_actual',
+    'rank_actual',
+    'position_actual',
+    'address_actual',
+    'relatives_actual',
+    'hospital_actual',
+    'receipt_date_actual',
+    'receipt_cause_actual',
+    'death_date_actual',
+    'death_cause_actual',
+    'grave_actual',
+    'date_of_captivity_actual',
+    'place_of_captivity_actual',
+    'camp_actual',
+    'camp_number_actual',
+    'lost_date_actual',
+    'field_post_actual',
+]
+
+
+def fill_status(apps, schema_editor):
+    Person = apps.get_model('website', 'Person')
+    conditions = []
+    for name in STATUS_FIELDS:
+        field = Person._meta.get_field(name)
+        if isinstance(field, (models.CharField, models.TextField)):
+            conditions.append(Q(**{'%s__gt' % name: ''}))
+        elif isinstance(field, models.IntegerField):
+            conditions.append(Q(**{'%s__gt' % name: 0}) | Q(**{'%s__lt' % name: 0}))
+        else:
+            conditions.append(Q(**{'%s__isnull' % name: False}))
+    Person.objects.update(status=Case(
+        When(reduce(and_, conditions), then=Value(2)),
+        When(reduce(or_, conditions), then=Value(1)),
+        default=Value(0),
+        output_field=models.IntegerField(),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0051_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Не заполнено'), (1, 'Заполнено частично'), (2, 'Заполнено')], db_index=True, default=0, editable=False, verbose_name='Полнота данных'),
+        ),
+        migrations.RunPython(fill_status, reverse_code=migrations.RunPython.noop),
+    ]
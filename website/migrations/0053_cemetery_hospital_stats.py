@@ -0,0 +1,71 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:56
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count, F
+import django.db.models.deletion
+
+
+def count_persons(queryset, field):
+    counts = Counter()
+    for key, state, status, count in queryset.order_by().values_list(field, 'state', 'status').annotate(Count('id')):
+        counts[key, state, status] += count
+    return counts
+
+
+def fill_stats(apps, schema_editor):
+    Person = apps.get_model('website', 'Person')
+    CemeteryStats = apps.get_model('website', 'CemeteryStats')
+    HospitalStats = apps.get_model('website', 'HospitalStats')
+
+    persons = Person.objects.filter(active_import=None)
+    cemetery_counts = count_persons(persons.filter(cemetery__isnull=False), 'cemetery') + count_persons(
+        persons.filter(cemetery_actual__isnull=False).exclude(cemetery=F('cemetery_actual')), 'cemetery_actual')
+    CemeteryStats.objects.bulk_create([
+        CemeteryStats(cemetery_id=key, state=state, status=status, count=count)
+        for (key, state, status), count in cemetery_counts.items()
+    ])
+
+    hospital_counts = count_persons(persons.filter(hospital_actual__isnull=False), 'hospital_actual')
+    HospitalStats.objects.bulk_create([
+        HospitalStats(hospital_id=key, state=state, status=status, count=count)
+        for (key, state, status), count in hospital_counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0052_person_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HospitalStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.IntegerField(choices=[(0, 'Лечился'), (1, 'Пропал без вести'), (2, 'Убит'), (3, 'Умер по пути в госпиталь'), (4, 'Погиб в плену')], null=True)),
+                ('status', models.IntegerField(choices=[(0, 'Не заполнено'), (1, 'Заполнено частично'), (2, 'Заполнено')])),
+                ('count', models.IntegerField(default=0)),
+                ('hospital', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='website.Hospital')),
+            ],
+            options={
+                'unique_together': {('hospital', 'state', 'status')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CemeteryStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.IntegerField(choices=[(0, 'Лечился'), (1, 'Пропал без вести'), (2, 'Убит'), (3, 'Умер по пути в госпиталь'), (4, 'Погиб в плену')], null=True)),
+                ('status', models.IntegerField(choices=[(0, 'Не заполнено'), (1, 'Заполнено частично'), (2, 'Заполнено')])),
+                ('count', models.IntegerField(default=0)),
+                ('cemetery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='website.Cemetery')),
+            ],
+            options={
+                'unique_together': {('cemetery', 'state', 'status')},
+            },
+        ),
+        migrations.RunPython(fill_stats, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+import website.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0053_cemetery_hospital_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Export',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(choices=[('xlsx', 'Excel'), ('csv', 'CSV')], default='xlsx', max_length=4)),
+                ('data_version', models.BigIntegerField(db_index=True)),
+                ('status', models.IntegerField(choices=[(1, 'В очереди'), (2, 'Выполняется'), (3, 'Выполнен'), (4, 'Ошибка')], db_index=True, default=1)),
+                ('file', models.FileField(blank=True, storage=website.storage.ExportStorage(), upload_to='')),
+                ('rows', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('queued_at', models.DateTimeField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('cemetery', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='website.Cemetery')),
+                ('search', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='website.SearchData')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='export',
+            constraint=models.UniqueConstraint(condition=models.Q(('cemetery__isnull', False), ('search__isnull', True)), fields=('format', 'cemetery', 'data_version'), name='website_export_cemetery'),
+        ),
+        migrations.AddConstraint(
+            model_name='export',
+            constraint=models.UniqueConstraint(condition=models.Q(('cemetery__isnull', True), ('search__isnull', False)), fields=('format', 'search', 'data_version'), name='website_export_search'),
+        ),
+        migrations.AddConstraint(
+            model_name='export',
+            constraint=models.UniqueConstraint(condition=models.Q(('cemetery__isnull', True), ('search__isnull', True)), fields=('format', 'data_version'), name='website_export_all'),
+        ),
+    ]
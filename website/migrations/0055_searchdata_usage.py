@@ -0,0 +1,39 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def remove_duplicate_searches(apps, schema_editor):
+    SearchData = apps.get_model('website', 'SearchData')
+    Export = apps.get_model('website', 'Export')
+    duplicates = SearchData.objects.values('hash').annotate(count=models.Count('id'), first_id=models.Min('id')) \
+        .filter(count__gt=1)
+    for row in duplicates:
+        others = SearchData.objects.filter(hash=row['hash']).exclude(id=row['first_id'])
+        Export.objects.filter(search__in=others).update(search_id=row['first_id'])
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0054_export'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchdata',
+            name='hits',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='searchdata',
+            name='last_used',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(remove_duplicate_searches, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='searchdata',
+            name='hash',
+            field=models.BinaryField(max_length=20, unique=True),
+        ),
+    ]
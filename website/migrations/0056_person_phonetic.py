@@ -0,0 +1,132 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:05
+
+import re
+
+from django.db import migrations, models
+
+# A copy of website.phonetic at the time of this migration, keys of later rules are computed by the
+# backfill_persons command
+
+# Latin transliterations of Russian letters, longer combinations first
+_LATIN = [
+    ('shch', 'щ'), ('sch', 'щ'), ('sky', 'скии'), ('iy', 'ии'), ('yi', 'ии'), ('zh', 'ж'), ('kh', 'х'), ('ts', 'ц'),
+    ('tz', 'ц'), ('ch', 'ч'), ('sh', 'ш'),
+    ('yu', 'ю'), ('ju', 'ю'), ('ya', 'я'), ('ja', 'я'), ('yo', 'е'), ('jo', 'е'), ('ye', 'е'), ('je', 'е'),
+    ('a', 'а'), ('b', 'б'), ('v', 'в'), ('w', 'в'), ('g', 'г'), ('h', 'х'), ('d', 'д'), ('e', 'е'), ('z', 'з'),
+    ('i', 'и'), ('j', 'и'), ('y', 'ы'), ('k', 'к'), ('l', 'л'), ('m', 'м'), ('n', 'н'), ('o', 'о'), ('p', 'п'),
+    ('r', 'р'), ('s', 'с'), ('t', 'т'), ('u', 'у'), ('f', 'ф'), ('c', 'к'), ('x', 'кс'), ('q', 'к'),
+]
+_LATIN_RE = re.compile('|'.join(latin for latin, _ in _LATIN))
+_LATIN_MAP = dict(_LATIN)
+
+# Feminine surname endings are reduced to the masculine ones, so Иванова sounds like Иванов
+_ENDINGS = [
+    ('ская', 'скии'), ('цкая', 'цкии'), ('ова', 'ов'), ('ева', 'ев'), ('ина', 'ин'), ('ына', 'ын'),
+]
+
+_GROUPS = [
+    ('тс', 'ц'), ('дс', 'ц'), ('тц', 'ц'), ('дц', 'ц'), ('сч', 'щ'), ('зч', 'щ'), ('жч', 'щ'), ('шч', 'щ'),
+]
+
+# Unstressed vowels sound alike and are often confused in lists
+_VOWELS = str.maketrans({'о': 'а', 'ы': 'а', 'я': 'а', 'е': 'и', 'э': 'и', 'ю': 'у'})
+
+_DEVOICED = {'б': 'п', 'в': 'ф', 'г': 'к', 'д': 'т', 'ж': 'ш', 'з': 'с'}
+_VOICELESS = set('пфктшсхцчщ')
+
+_WORD_RE = re.compile('[а-яa-z]+')
+
+
+def phonetic_word(word):
+    word = _LATIN_RE.sub(lambda m: _LATIN_MAP[m.group(0)], word)
+    word = word.replace('ь', '').replace('ъ', '')
+    if len(word) > 4:
+        for ending, replacement in _ENDINGS:
+            if word.endswith(ending):
+                word = word[:-len(ending)] + replacement
+                break
+    for group, replacement in _GROUPS:
+        word = word.replace(group, replacement)
+    word = word.translate(_VOWELS)
+
+    # Voiced consonants are pronounced voiceless at the end of the word and before voiceless consonants
+    letters = list(word)
+    for i in range(len(letters) - 1, -1, -1):
+        if letters[i] in _DEVOICED and (i == len(letters) - 1 or letters[i + 1] in _VOICELESS):
+            letters[i] = _DEVOICED[letters[i]]
+
+    key = []
+    for c in letters:
+        if not key or key[-1] != c:
+            key.append(c)
+    return ''.join(key).upper()
+
+
+def phonetic_key(value):
+    """
+    Russian phonetic key of a name, words of similarly sounding names (Иванова, Iwanow) get equal keys
+    """
+    if not value:
+        return ''
+    value = value.lower().replace('ё', 'е').replace('й', 'и')
+    return ' '.join(phonetic_word(word) for word in _WORD_RE.findall(value))
+
+
+PHONETIC_FIELDS = [
+    ('fio_phonetic', 'fio'),
+    ('fio_actual_phonetic', 'fio_actual'),
+    ('ontombstone_phonetic', 'ontombstone'),
+]
+
+
+def fill_phonetic_keys(apps, schema_editor):
+    Person = apps.get_model('website', 'Person')
+    last_id = 0
+    while True:
+        persons = list(Person.objects.filter(id__gt=last_id).order_by('id')
+                       .only('id', *[f for _, f in PHONETIC_FIELDS])[:1000])
+        if not persons:
+            break
+        for person in persons:
+            for phonetic_field, f in PHONETIC_FIELDS:
+                setattr(person, phonetic_field, phonetic_key(getattr(person, f)))
+        Person.objects.bulk_update(persons, [phonetic_field for phonetic_field, _ in PHONETIC_FIELDS])
+        last_id = persons[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0055_searchdata_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='fio_actual_phonetic',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='fio_phonetic',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='ontombstone_phonetic',
+            field=models.CharField(blank=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(fill_phonetic_keys, reverse_code=migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['fio_phonetic'], name='website_person_fio_phon', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['fio_actual_phonetic'], name='website_person_fio_act_phon', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='person',
+            index=models.Index(fields=['ontombstone_phonetic'], name='website_person_ontomb_phon', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
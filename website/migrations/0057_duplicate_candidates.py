@@ -0,0 +1,49 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_surname_keys(apps, schema_editor):
+    Person = apps.get_model('website', 'Person')
+    fields = ['fio_actual_phonetic', 'fio_phonetic', 'ontombstone_phonetic']
+    last_id = 0
+    while True:
+        persons = list(Person.objects.filter(id__gt=last_id).order_by('id').only('id', *fields)[:1000])
+        if not persons:
+            break
+        for person in persons:
+            keys = [getattr(person, f) for f in fields if getattr(person, f)]
+            person.surname_key = keys[0].split(' ')[0] if keys else ''
+        Person.objects.bulk_update(persons, ['surname_key'])
+        last_id = persons[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0056_person_phonetic'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='surname_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(fill_surname_keys, reverse_code=migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='DuplicateCandidate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('duplicate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='website.Person')),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='website.Person')),
+                ('source_import', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='duplicate_candidates', to='website.Import')),
+            ],
+            options={
+                'ordering': ['-score', 'id'],
+                'unique_together': {('person', 'duplicate')},
+            },
+        ),
+    ]
@@ -0,0 +1,199 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:08
+
+import calendar
+import datetime
+import re
+from collections import namedtuple
+
+from django.db import migrations, models
+
+# A copy of website.dates at the time of this migration, dates of later rules are parsed by the backfill_persons
+# command
+
+# Period of time denoted by a possibly partial date, both ends included
+DateRange = namedtuple('DateRange', ['start', 'end'])
+
+# Month names by their first three letters, in any case form (января, январь, янв.)
+MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'май': 5, 'мая': 5, 'июн': 6,
+    'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12,
+}
+
+_ISO_RE = re.compile(r'(?<!\d)(\d{4})-(\d{1,2})-(\d{1,2})(?!\d)')
+# dd.mm.yyyy as written in lists and emitted by XLSXImporter.format_value, also with / or - and two digit years
+_DAY_MONTH_YEAR_RE = re.compile(r'(?<!\d)(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})(?!\d)')
+_MONTH_YEAR_RE = re.compile(r'(?<![\d.])(\d{1,2})[./](\d{4})(?!\d)')
+_DAY_MONTH_NAME_YEAR_RE = re.compile(r'(?<!\d)(\d{1,2})\s*([а-я]{3,})\.?\s*(\d{4})(?!\d)')
+_MONTH_NAME_YEAR_RE = re.compile(r'(?<![а-я])([а-я]{3,})\.?\s*(\d{4})(?!\d)')
+_YEAR_RE = re.compile(r'(?<!\d)(1[89]\d\d|20\d\d)(?!\d)')
+
+
+def _year(value):
+    year = int(value)
+    return year + 1900 if len(value) == 2 else year
+
+
+def _day(year, month, day):
+    try:
+        date = datetime.date(year, month, day)
+    except ValueError:
+        return None
+    return DateRange(date, date)
+
+
+def _month(year, month):
+    if not 1 <= month <= 12 or not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+        return None
+    return DateRange(datetime.date(year, month, 1), datetime.date(year, month, calendar.monthrange(year, month)[1]))
+
+
+def _month_name(name):
+    return MONTHS.get(name[:3])
+
+
+def parse_date(value):
+    """
+    Period denoted by a free text date: a day (12.01.1942, 1942-01-12, 12 января 1942 г.), a month (01.1942,
+    январь 1942) or a year (1942, в 1942 г.). The first date found in the text is used, None if there is none.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if isinstance(value, datetime.date):
+        return DateRange(value, value)
+    if isinstance(value, int):
+        value = str(value)
+
+    text = value.lower().replace('ё', 'е')
+
+    match = _ISO_RE.search(text)
+    if match:
+        result = _day(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        if result:
+            return result
+
+    match = _DAY_MONTH_YEAR_RE.search(text)
+    if match:
+        result = _day(_year(match.group(3)), int(match.group(2)), int(match.group(1)))
+        if result:
+            return result
+
+    match = _DAY_MONTH_NAME_YEAR_RE.search(text)
+    if match and _month_name(match.group(2)):
+        result = _day(int(match.group(3)), _month_name(match.group(2)), int(match.group(1)))
+        if result:
+            return result
+
+    match = _MONTH_YEAR_RE.search(text)
+    if match:
+        result = _month(int(match.group(2)), int(match.group(1)))
+        if result:
+            return result
+
+    for match in _MONTH_NAME_YEAR_RE.finditer(text):
+        if _month_name(match.group(1)):
+            return _month(int(match.group(2)), _month_name(match.group(1)))
+
+    match = _YEAR_RE.search(text)
+    if match:
+        year = int(match.group(1))
+        return DateRange(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+    return None
+
+
+def parse_year(value):
+    """
+    Year of a free text date or year, None if it is not known exactly
+    """
+    period = parse_date(value)
+    if period is None or period.start.year != period.end.year:
+        return None
+    return period.start.year
+
+
+DATE_FIELDS = [
+    ('receipt_date', ['receipt_date_actual', 'receipt_date']),
+    ('death_date', ['death_date_actual', 'death_date']),
+    ('date_of_captivity', ['date_of_captivity_actual', 'date_of_captivity']),
+    ('lost_date', ['lost_date_actual', 'lost_date']),
+]
+
+
+def fill_dates(apps, schema_editor):
+    Person = apps.get_model('website', 'Person')
+    sources = ['year', 'year_actual'] + [source for _, fields in DATE_FIELDS for source in fields]
+    fields = ['birth_year'] + ['%s_%s' % (f, end) for f, _ in DATE_FIELDS for end in ('from', 'to')]
+    last_id = 0
+    while True:
+        persons = list(Person.objects.filter(id__gt=last_id).order_by('id').only('id', *sources)[:1000])
+        if not persons:
+            break
+        for person in persons:
+            person.birth_year = person.year_actual or parse_year(person.year)
+            for f, date_sources in DATE_FIELDS:
+                period = None
+                for source in date_sources:
+                    period = parse_date(getattr(person, source))
+                    if period:
+                        break
+                setattr(person, f + '_from', period.start if period else None)
+                setattr(person, f + '_to', period.end if period else None)
+        Person.objects.bulk_update(persons, fields)
+        last_id = persons[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0057_duplicate_candidates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='birth_year',
+            field=models.IntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='date_of_captivity_from',
+            field=models.DateField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='date_of_captivity_to',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='death_date_from',
+            field=models.DateField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='death_date_to',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='lost_date_from',
+            field=models.DateField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='lost_date_to',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='receipt_date_from',
+            field=models.DateField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='receipt_date_to',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_dates, reverse_code=migrations.RunPython.noop),
+    ]
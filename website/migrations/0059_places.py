@@ -0,0 +1,164 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:12
+
+import json
+import os
+import re
+import unicodedata
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The bundled gazetteer, later changes of it are loaded by the load_places command
+PLACES_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'places.json')
+
+# A copy of the matching of website.places at the time of this migration, regions of later rules are matched
+# by the backfill_persons command
+REGION_TYPE_WORDS = {
+    'ОБЛ', 'ОБЛАСТЬ', 'ОБЛАСТИ', 'ОБЛАСТЮ', 'КРАИ', 'КРАЯ', 'КРАЮ', 'АССР', 'ССР', 'АО', 'РЕСП', 'РЕСПУБЛИКА',
+    'РЕСПУБЛИКИ', 'РЕСПУБЛИКЕ', 'ГУБ', 'ГУБЕРНИЯ', 'ГУБЕРНИИ', 'АВТОНОМНАЯ', 'АВТОНОМНОИ',
+}
+TYPE_WORDS = REGION_TYPE_WORDS | {'СССР', 'Г', 'ГОР', 'ГОРОД', 'ГОРОДА', 'ГОРОДЕ'}
+
+ENDINGS = [
+    'ОГО', 'ЕГО', 'ОМУ', 'ЕМУ', 'АЯ', 'ЯЯ', 'ОИ', 'ЕИ', 'УЮ', 'ЮЮ', 'ЫИ', 'ИИ', 'ОЕ', 'ЕЕ', 'ЫМ', 'ИМ', 'ОМ', 'ЕМ',
+    'А', 'Я', 'Ы', 'И', 'Е', 'У', 'Ю',
+]
+
+ADJECTIVE_ENDINGS = (
+    'АЯ', 'ЯЯ', 'ОИ', 'ЕИ', 'ЫИ', 'ИИ', 'ОГО', 'ЕГО', 'ОМУ', 'ЕМУ', 'УЮ', 'ЮЮ', 'ОЕ', 'ЕЕ', 'ЫЕ', 'ИЕ', 'ЫМ', 'ИМ',
+)
+
+WORD_RE = re.compile('[А-ЯA-Z0-9]+')
+
+MAX_ALIAS_WORDS = 4
+
+# Fields of places with their sources, whether the source is an address and not a region name
+PLACE_FIELDS = [
+    ('birth_region', [('born_region_actual', False), ('born_region', False), ('born_address_actual', True),
+                      ('born_address', True)]),
+    ('address_region', [('address_actual', True), ('address', True)]),
+    ('conscription_region', [('conscription_place_actual', True), ('conscription_place', True)]),
+]
+
+
+def search_text(value):
+    value = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in value if not unicodedata.combining(c)).upper()
+
+
+def stem(word):
+    if len(word) >= 5:
+        for ending in ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 4:
+                return word[:-len(ending)]
+    return word
+
+
+def place_key(text):
+    return ' '.join(stem(word) for word in WORD_RE.findall(search_text(text)) if word not in TYPE_WORDS)
+
+
+def is_adjective(word):
+    return len(word) >= 5 and word.endswith(ADJECTIVE_ENDINGS)
+
+
+def names_region(words, positions, i, n):
+    first, last = positions[i], positions[i + n - 1]
+    if not all(is_adjective(word) for word in words[first:last + 1] if word not in TYPE_WORDS):
+        return True
+    if n == len(positions):
+        return True
+    return (first > 0 and words[first - 1] in REGION_TYPE_WORDS) or \
+        (last + 1 < len(words) and words[last + 1] in REGION_TYPE_WORDS)
+
+
+def match_place(keys, text, address):
+    if not text:
+        return None
+    words = WORD_RE.findall(search_text(text))
+    positions = [i for i, word in enumerate(words) if word not in TYPE_WORDS]
+    stems = [stem(words[i]) for i in positions]
+    for i in range(len(stems)):
+        for n in range(min(MAX_ALIAS_WORDS, len(stems) - i), 0, -1):
+            place_id = keys.get(' '.join(stems[i:i + n]))
+            if place_id is not None and (not address or names_region(words, positions, i, n)):
+                return place_id
+    return None
+
+
+def fill_places(apps, schema_editor):
+    Place = apps.get_model('website', 'Place')
+    PlaceAlias = apps.get_model('website', 'PlaceAlias')
+    Person = apps.get_model('website', 'Person')
+    with open(PLACES_FILE, encoding='utf-8') as f:
+        places = json.load(f)
+    for data in places:
+        place, _ = Place.objects.get_or_create(name=data['name'])
+        for name in [data['name']] + data.get('aliases', []):
+            key = place_key(name)
+            if key:
+                PlaceAlias.objects.update_or_create(key=key, defaults={'place': place, 'name': name})
+    keys = dict(PlaceAlias.objects.values_list('key', 'place_id'))
+
+    sources = [source for _, fields in PLACE_FIELDS for source, _ in fields]
+    fields = [f for f, _ in PLACE_FIELDS]
+    last_id = 0
+    while True:
+        persons = list(Person.objects.filter(id__gt=last_id).order_by('id').only('id', *sources)[:1000])
+        if not persons:
+            break
+        for person in persons:
+            for f, place_sources in PLACE_FIELDS:
+                place_id = None
+                for source, address in place_sources:
+                    place_id = match_place(keys, getattr(person, source), address)
+                    if place_id is not None:
+                        break
+                setattr(person, f + '_id', place_id)
+        Person.objects.bulk_update(persons, fields)
+        last_id = persons[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0058_person_dates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Place',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Название')),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PlaceAlias',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('place', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='website.Place')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='address_region',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='resident_persons', to='website.Place', verbose_name='Регион проживания'),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='birth_region',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='born_persons', to='website.Place', verbose_name='Регион рождения'),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='conscription_region',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='conscripted_persons', to='website.Place', verbose_name='Регион призыва'),
+        ),
+        migrations.RunPython(fill_places, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,140 @@
+# Generated by Django 3.0.14 on 2026-10-18 13:15
+
+import re
+import unicodedata
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count, F
+import django.db.models.deletion
+
+# A copy of website.hospitals.hospital_key at the time of this migration, keys of later rules are applied by
+# the backfill_persons and link_hospitals commands
+HOSPITAL_TYPES = [
+    ('ХППГ', [['ХИРУРГ', 'ПОЛЕВ', 'ПОДВИЖН', 'ГОСПИТАЛ'], ['ХИРУРГ', 'ППГ'], ['ХППГ']]),
+    ('ТППГ', [['ТЕРАПЕВТ', 'ПОЛЕВ', 'ПОДВИЖН', 'ГОСПИТАЛ'], ['ТЕРАПЕВТ', 'ППГ'], ['ТППГ']]),
+    ('ППГ', [['ПОЛЕВ', 'ПОДВИЖН', 'ГОСПИТАЛ'], ['ППГ']]),
+    ('СЭГ', [['СОРТИРОВОЧН', 'ЭВАКОГОСПИТАЛ'], ['СОРТИРОВОЧН', 'ЭГ'], ['СЭГ']]),
+    ('ЭГ', [['ЭВАКУАЦИОН', 'ГОСПИТАЛ'], ['ЭВАКОГОСПИТАЛ'], ['ЭГ']]),
+    ('ГЛР', [['ГОСПИТАЛ', 'ДЛЯ', 'ЛЕГКОРАНЕН'], ['ГЛР']]),
+    ('ИГ', [['ИНФЕКЦИОН', 'ГОСПИТАЛ'], ['ИГ']]),
+    ('МСБ', [['МЕДИКО', 'САНИТАРН', 'БАТАЛЬОН'], ['МЕДСАНБАТ'], ['МСБ']]),
+    ('ГОСПИТАЛЬ', [['ГОСПИТАЛ']]),
+]
+
+DEFAULT_TYPE = 'ЭГ'
+
+NOISE_WORDS = {'N', 'НОМЕР', 'НОМ'}
+
+WORD_RE = re.compile('[А-ЯA-Z]+|[0-9]+')
+
+
+def search_text(value):
+    value = unicodedata.normalize('NFKD', value)
+    return ''.join(c for c in value if not unicodedata.combining(c)).upper()
+
+
+def word_matches(word, pattern):
+    return word == pattern or (len(pattern) >= 5 and word.startswith(pattern))
+
+
+def match_type(words, i):
+    for type, sequences in HOSPITAL_TYPES:
+        for sequence in sequences:
+            if len(sequence) <= len(words) - i and \
+                    all(word_matches(word, pattern) for word, pattern in zip(words[i:], sequence)):
+                return type, len(sequence)
+    return None, 1
+
+
+def hospital_key(value):
+    if not value:
+        return ''
+    words = [word for word in WORD_RE.findall(search_text(value).replace('Ё', 'Е')) if word not in NOISE_WORDS]
+    tokens = []
+    types = []
+    number = None
+    i = 0
+    while i < len(words):
+        type, length = match_type(words, i)
+        if type:
+            tokens.append(type)
+            types.append(type)
+        else:
+            tokens.append(words[i])
+            if number is None and words[i].isdigit():
+                number = str(int(words[i]))
+        i += length
+
+    if number is not None:
+        types = [type for type in types if type != 'ГОСПИТАЛЬ']
+        return '%s %s' % (types[0] if types else DEFAULT_TYPE, number)
+    return ' '.join(tokens)[:255]
+
+
+def count_persons(queryset, field):
+    counts = Counter()
+    for key, state, status, count in queryset.order_by().values_list(field, 'state', 'status').annotate(Count('id')):
+        counts[key, state, status] += count
+    return counts
+
+
+def fill_hospital_links(apps, schema_editor):
+    Hospital = apps.get_model('website', 'Hospital')
+    HospitalStats = apps.get_model('website', 'HospitalStats')
+    Person = apps.get_model('website', 'Person')
+    hospital_ids = {}
+    for hospital in Hospital.objects.all():
+        hospital.key = hospital_key(hospital.name)
+        hospital.save(update_fields=['key'])
+        # Keys of several hospitals are ambiguous
+        hospital_ids[hospital.key] = None if hospital.key in hospital_ids else hospital.id
+
+    last_id = 0
+    while True:
+        persons = list(Person.objects.filter(id__gt=last_id).exclude(hospital=None).exclude(hospital='')
+                       .order_by('id').only('id', 'hospital')[:1000])
+        if not persons:
+            break
+        for person in persons:
+            person.hospital_key = hospital_key(person.hospital)
+            person.hospital_linked_id = hospital_ids.get(person.hospital_key)
+        Person.objects.bulk_update(persons, ['hospital_key', 'hospital_linked'])
+        last_id = persons[-1].id
+
+    # Persons are counted by the linked hospital too, like the hospital page lists them
+    persons = Person.objects.filter(active_import=None)
+    hospital_counts = count_persons(persons.filter(hospital_linked__isnull=False), 'hospital_linked') + count_persons(
+        persons.filter(hospital_actual__isnull=False).exclude(hospital_linked=F('hospital_actual')),
+        'hospital_actual')
+    HospitalStats.objects.all().delete()
+    HospitalStats.objects.bulk_create([
+        HospitalStats(hospital_id=key, state=state, status=status, count=count)
+        for (key, state, status), count in hospital_counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0059_places'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hospital',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='hospital_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='hospital_linked',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='person_hospital_linked', to='website.Hospital', verbose_name='Госпиталь из текста'),
+        ),
+        migrations.RunPython(fill_hospital_links, migrations.RunPython.noop),
+    ]
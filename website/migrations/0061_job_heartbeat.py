@@ -0,0 +1,32 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:40
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_heartbeats(apps, schema_editor):
+    # Running jobs are judged by the start until their worker reports again
+    for name in ('Import', 'Export'):
+        model = apps.get_model('website', name)
+        model.objects.filter(status=2).update(heartbeat_at=F('started_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0060_hospital_links'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='export',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='import',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(fill_heartbeats, migrations.RunPython.noop),
+    ]
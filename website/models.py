@@ -1,10 +1,20 @@
 import datetime
+import hashlib
 import os
+from collections import OrderedDict
+from functools import partial
 
-from django.db import models
-from django.db.models import Case, When, CharField
-from django.db.models.functions import Coalesce
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import BooleanField, Case, CharField, F, Func, IntegerField, Q, Value, When
+from django.db.models.functions import Coalesce, NullIf
 from django.urls import reverse
+from django.utils import timezone
+
+from website.dates import parse_date, parse_year
+from website.hospitals import hospital_key
+from website.phonetic import phonetic_key
+from website.storage import ExportStorage
 
 
 class Cemetery(models.Model):
@@ -19,12 +29,34 @@ class Cemetery(models.Model):
     def get_absolute_url(self):
         return reverse('cemetery_detail', kwargs={'pk': self.pk})
 
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            # Persons are detached through PersonQuerySet.update, SET NULL of the collector would leave their
+            # status and statistics stale
+            Person.objects.filter(cemetery=self).update(cemetery=None)
+            Person.objects.filter(cemetery_actual=self).update(cemetery_actual=None)
+            return super(Cemetery, self).delete(*args, **kwargs)
+
 
 def default_import_name():
     return 'import-%s' % datetime.datetime.now().strftime("%Y%m%d%H%M%S")
 
 
 class Import(models.Model):
+    NEW = 0
+    QUEUED = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATUSES = (
+        (NEW, 'Новый'),
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнен'),
+        (FAILED, 'Ошибка'),
+    )
+
     name = models.CharField(max_length=255, default=default_import_name)
     cemetery = models.ForeignKey(Cemetery, null=True, blank=True, on_delete=models.CASCADE, verbose_name='Мемориал')
     file = models.FileField(upload_to='import/', verbose_name='Файл для импорта')
@@ -32,7 +64,20 @@ class Import(models.Model):
     numbering = models.IntegerField(default=1, verbose_name='Колонки нумерации')
     delimiter = models.CharField(max_length=1, default=',', verbose_name='Разделитель')
     quotechar = models.CharField(max_length=1, default='"', verbose_name='Символ строки')
+    encoding = models.CharField(max_length=64, blank=True, verbose_name='Кодировка',
+                                help_text='Определяется автоматически, если не указана')
     data_added = models.BooleanField(default=False)
+    file_hash = models.CharField(max_length=40, blank=True, editable=False)
+
+    status = models.IntegerField(choices=STATUSES, default=NEW, db_index=True)
+    mapping = models.TextField(blank=True)
+    rows_total = models.IntegerField(default=0)
+    rows_processed = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ["name"]
@@ -43,13 +88,53 @@ class Import(models.Model):
     def get_absolute_url(self):
         return reverse('import_view', kwargs={'pk': self.pk})
 
+    def is_in_progress(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    def get_rows_per_second(self):
+        if not self.started_at or not self.rows_processed:
+            return None
+        elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return round(self.rows_processed / elapsed) if elapsed > 0 else None
+
+    def get_progress(self):
+        return {
+            'status': self.status,
+            'status_name': self.get_status_display(),
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'rows_per_second': self.get_rows_per_second(),
+            'data_added': self.data_added,
+            'error': self.error,
+        }
+
     def delete(self, *args, **kwargs):
+        from website.importer import ParseCache
+        ParseCache.clear(self)
         os.unlink(self.file.path)
+        cemetery_ids, hospital_ids = Person.objects.filter(active_import=self).get_stats_ids()
         super(Import, self).delete(*args, **kwargs)
+        # Persons of the import are detached by SET NULL bypassing PersonQuerySet
+        DataVersion.bump(DataVersion.PERSONS)
+        from website.stats import refresh_stats
+        refresh_stats(cemetery_ids, hospital_ids)
+
+    def get_file_hash(self):
+        if not self.file_hash:
+            file_hash = hashlib.sha1()
+            with open(self.file.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    file_hash.update(chunk)
+            self.file_hash = file_hash.hexdigest()
+            if self.pk:
+                Import.objects.filter(pk=self.pk).update(file_hash=self.file_hash)
+        return self.file_hash
 
 
 class Hospital(models.Model):
     name = models.CharField(max_length=255, verbose_name='Название')
+    # Name normalized by website.hospitals.hospital_key, persons are linked by it
+    key = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
 
     class Meta:
         ordering = ["name"]
@@ -60,91 +145,203 @@ class Hospital(models.Model):
     def get_absolute_url(self):
         return reverse('hospital_detail', kwargs={'pk': self.pk})
 
+    def save(self, *args, **kwargs):
+        self.key = hospital_key(self.name)
+        old_key = Hospital.objects.filter(pk=self.pk).values_list('key', flat=True).first() if self.pk else None
+        super(Hospital, self).save(*args, **kwargs)
+        if old_key != self.key:
+            self.relink_persons(old_key, self.key)
+
+    def delete(self, *args, **kwargs):
+        key = self.key
+        with transaction.atomic():
+            # See Cemetery.delete
+            Person.objects.filter(hospital_actual=self).update(hospital_actual=None)
+            Person.objects.filter(hospital_linked=self).update(hospital_linked=None)
+            result = super(Hospital, self).delete(*args, **kwargs)
+        # Another hospital of the key is not ambiguous any more
+        self.relink_persons(key)
+        return result
+
+    @staticmethod
+    def relink_persons(*keys):
+        from website.hospitals import link_hospitals
+        keys = [key for key in keys if key]
+        if keys:
+            link_hospitals(Person.objects.filter(hospital_key__in=keys))
+
+
+class Place(models.Model):
+    """
+    Canonical region of the gazetteer, see website.places
+    """
+    name = models.CharField(max_length=255, unique=True, verbose_name='Название')
+
+    class Meta:
+        ordering = ["name"]
+
+    def __str__(self):
+        return self.name
+
+
+class PlaceAlias(models.Model):
+    place = models.ForeignKey(Place, on_delete=models.CASCADE, related_name='aliases')
+    name = models.CharField(max_length=255)
+    # Name normalized by website.places.place_key
+    key = models.CharField(max_length=255, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Filled(Func):
+    """
+    SQL version of bool(value) for values of the field
+    """
+    output_field = BooleanField()
+
+    def __init__(self, expression, field):
+        if isinstance(field, (models.CharField, models.TextField)):
+            template = "COALESCE(%(expressions)s, '') <> ''"
+        elif isinstance(field, models.IntegerField):
+            template = 'COALESCE(%(expressions)s, 0) <> 0'
+        else:
+            template = '%(expressions)s IS NOT NULL'
+        super(Filled, self).__init__(expression, template=template)
+
+
+class AllOf(Func):
+    template = '(%(expressions)s)'
+    arg_joiner = ' AND '
+    output_field = BooleanField()
+
 
-class PersonManager(models.Manager):
+class AnyOf(Func):
+    template = '(%(expressions)s)'
+    arg_joiner = ' OR '
+    output_field = BooleanField()
+
+
+class DataVersion(models.Model):
+    """
+    Counter incremented on every change of the data, caches shared between processes are keyed by it
+    """
+    PERSONS = 'persons'
+    PLACES = 'places'
+
+    name = models.CharField(max_length=32, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def get(cls, name):
+        version = cls.objects.filter(name=name).values_list('version', flat=True).first()
+        return version or 0
+
+    @classmethod
+    def bump(cls, name):
+        """
+        Increments the version when the current transaction commits, once per transaction. Writers do not hold
+        the lock of the version row until they commit, and caches are not filled from uncommitted data under
+        the new version.
+        """
+        connection = transaction.get_connection()
+        # Callbacks of rolled back savepoints are removed from run_on_commit too
+        if any(getattr(func, 'data_version', None) == name for _, func in connection.run_on_commit):
+            return
+        increment = partial(cls.increment, name)
+        increment.data_version = name
+        transaction.on_commit(increment)
+
+    @classmethod
+    def increment(cls, name):
+        if not cls.objects.filter(name=name).update(version=F('version') + 1):
+            cls.objects.get_or_create(name=name, defaults={'version': 1})
+
+
+class PersonQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Derived fields are computed from the new values in the same UPDATE statement
+        if set(kwargs) & Person.get_status_source_fields():
+            kwargs['status'] = Person.get_status_expression(kwargs)
+        if set(kwargs) & Person.get_screen_source_fields():
+            kwargs.update(Person.get_screen_field_expressions(kwargs))
+        computed_ids = None
+        relink = False
+        if set(kwargs) & Person.get_computed_source_fields():
+            computed, row_fields = Person.get_computed_values(kwargs)
+            if 'hospital_key' in computed:
+                from website.hospitals import resolve_hospital_keys
+                key = computed['hospital_key']
+                computed['hospital_linked'] = resolve_hospital_keys([key]).get(key) if key else None
+            kwargs.update(computed)
+            if row_fields:
+                # Fields depending on values of the rows are recomputed from the updated rows
+                computed_ids = list(self.values_list('id', flat=True))
+                relink = 'hospital' in kwargs and 'hospital_linked' not in kwargs
+        stats_fields = set(kwargs) & Person.get_stats_source_fields()
+        if stats_fields:
+            cemetery_ids, hospital_ids = self.get_stats_ids()
+        rows = super(PersonQuerySet, self).update(**kwargs)
+        DataVersion.bump(DataVersion.PERSONS)
+        if computed_ids:
+            for i in range(0, len(computed_ids), 500):
+                persons = Person.objects.filter(id__in=computed_ids[i:i + 500])
+                persons.update_computed_fields()
+                if relink:
+                    from website.hospitals import link_hospitals
+                    link_hospitals(persons)
+
+        if stats_fields:
+            from website.stats import refresh_stats, refresh_all_stats
+            values = {f: kwargs[f] for f in stats_fields if f.startswith(('cemetery', 'hospital'))}
+            if any(hasattr(value, 'resolve_expression') for value in values.values()):
+                refresh_all_stats()
+                return rows
+            for f, value in values.items():
+                ids = hospital_ids if f.startswith('hospital') else cemetery_ids
+                ids.add(value.pk if isinstance(value, models.Model) else value)
+            refresh_stats(cemetery_ids, hospital_ids)
+        return rows
+
+    def delete(self):
+        cemetery_ids, hospital_ids = self.get_stats_ids()
+        result = super(PersonQuerySet, self).delete()
+        DataVersion.bump(DataVersion.PERSONS)
+        from website.stats import refresh_stats
+        refresh_stats(cemetery_ids, hospital_ids)
+        return result
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        result = super(PersonQuerySet, self).bulk_create(objs, *args, **kwargs)
+        DataVersion.bump(DataVersion.PERSONS)
+        cemetery_ids, hospital_ids = Person.get_stats_ids(obj.get_stats_values() for obj in objs
+                                                          if obj.active_import_id is None)
+        if cemetery_ids or hospital_ids:
+            from website.stats import refresh_stats
+            refresh_stats(cemetery_ids, hospital_ids)
+        return result
+
+    def get_stats_ids(self):
+        """
+        Cemeteries and hospitals of the persons, whose statistics depend on them
+        """
+        return Person.get_stats_ids(self.order_by().values_list(*Person._stats_fields[:4]).distinct())
+
+    def update_screen_fields(self):
+        return super(PersonQuerySet, self).update(**Person.get_screen_field_expressions())
+
+    def update_computed_fields(self):
+        persons = list(self.select_related(None).only('id', *Person.get_computed_source_fields()))
+        for person in persons:
+            person.update_computed_fields()
+        Person.objects.bulk_update(persons, Person.get_computed_fields(), batch_size=1000)
+
+
+class PersonManager(models.Manager.from_queryset(PersonQuerySet)):
     def get_queryset(self):
         q = super(PersonManager, self).get_queryset()
-
-        q = q.select_related('cemetery', 'cemetery_actual', 'hospital_actual').annotate(
-            screen_name=Coalesce(
-                Case(
-                    When(fio_actual__exact='', then=None),
-                    When(fio_actual__isnull=False, then='fio_actual'),
-                    default=None,
-                    output_field=CharField()
-                ),
-                Case(
-                    When(fio__exact='', then=None),
-                    When(fio__isnull=False, then='fio'),
-                    default=None,
-                    output_field=CharField()
-                ),
-                Case(
-                    When(ontombstone__exact='', then=None),
-                    When(ontombstone__isnull=False, then='ontombstone'),
-                    default=None,
-                    output_field=CharField()
-                )
-            ),
-            screen_born_region=Coalesce(
-                Case(
-                    When(born_region_actual__exact='', then=None),
-                    When(born_region_actual__isnull=False, then='born_region_actual'),
-                    default=None,
-                    output_field=CharField()
-                ),
-                Case(
-                    When(born_region__exact='', then=None),
-                    When(born_region__isnull=False, then='born_region'),
-                    default=None,
-                    output_field=CharField()
-                )
-            ),
-            screen_born_address=Coalesce(
-                Case(
-                    When(born_address_actual__exact='', then=None),
-                    When(born_address_actual__isnull=False, then='born_address_actual'),
-                    default=None,
-                    output_field=CharField()
-                ),
-                Case(
-                    When(born_address__exact='', then=None),
-                    When(born_address__isnull=False, then='born_address'),
-                    default=None,
-                    output_field=CharField()
-                )
-            ),
-            screen_address=Coalesce(
-                Case(
-                    When(address_actual__exact='', then=None),
-                    When(address_actual__isnull=False, then='address_actual'),
-                    default=None,
-                    output_field=CharField()
-                ),
-                Case(
-                    When(address__exact='', then=None),
-                    When(address__isnull=False, then='address'),
-                    default=None,
-                    output_field=CharField()
-                )
-            ),
-            screen_military_unit=Coalesce(
-                Case(
-                    When(military_unit_actual__exact='', then=None),
-                    When(military_unit_actual__isnull=False, then='military_unit_actual'),
-                    default=None,
-                    output_field=CharField()
-                ),
-                Case(
-                    When(military_unit__exact='', then=None),
-                    When(military_unit__isnull=False, then='military_unit'),
-                    default=None,
-                    output_field=CharField()
-                )
-            ),
-        )
-
-        return q
+        return q.select_related('cemetery', 'cemetery_actual', 'hospital_actual')
 
 
 class Person(models.Model):
@@ -152,6 +349,12 @@ class Person(models.Model):
     PARTIAL = 1
     COMPLETE = 2
 
+    STATUSES = (
+        (INCOMPLETE, 'Не заполнено'),
+        (PARTIAL, 'Заполнено частично'),
+        (COMPLETE, 'Заполнено'),
+    )
+
     TREATED = 0
     MIA = 1
     KILLED = 2
@@ -177,6 +380,10 @@ class Person(models.Model):
 
     hospital = models.CharField(max_length=255, blank=True, null=True, verbose_name='Госпиталь')
     hospital_actual = models.ForeignKey(Hospital, null=True, blank=True, on_delete=models.SET_NULL, related_name='person_hospital_actual', verbose_name='Актуальный госпиталь')
+    # Hospital named in the hospital text, linked by website.hospitals.link_hospitals
+    hospital_key = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
+    hospital_linked = models.ForeignKey(Hospital, null=True, blank=True, on_delete=models.SET_NULL, editable=False,
+                                        related_name='person_hospital_linked', verbose_name='Госпиталь из текста')
 
     fio = models.CharField(max_length=255, blank=True, null=True, verbose_name='ФИО (список, прочие источники)')
     fio_actual = models.CharField(max_length=255, blank=True, null=True, verbose_name='Актуальные ФИО (список, прочие источники)')
@@ -243,6 +450,93 @@ class Person(models.Model):
 
     notes = models.TextField(blank=True, verbose_name='Примечания')
 
+    screen_name = models.CharField(max_length=1024, blank=True, default='', editable=False)
+    screen_born_region = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    screen_born_address = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    screen_address = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    screen_military_unit = models.CharField(max_length=255, blank=True, null=True, editable=False)
+
+    status = models.IntegerField(choices=STATUSES, default=INCOMPLETE, db_index=True, editable=False,
+                                 verbose_name='Полнота данных')
+
+    fio_phonetic = models.CharField(max_length=255, blank=True, default='', editable=False)
+    fio_actual_phonetic = models.CharField(max_length=255, blank=True, default='', editable=False)
+    ontombstone_phonetic = models.CharField(max_length=1024, blank=True, default='', editable=False)
+    # Blocking key of duplicate detection, see website.duplicates
+    surname_key = models.CharField(max_length=255, blank=True, default='', db_index=True, editable=False)
+
+    # Regions of the gazetteer named in the place fields, see website.places
+    birth_region = models.ForeignKey(Place, null=True, blank=True, on_delete=models.SET_NULL, editable=False,
+                                     related_name='born_persons', verbose_name='Регион рождения')
+    address_region = models.ForeignKey(Place, null=True, blank=True, on_delete=models.SET_NULL, editable=False,
+                                       related_name='resident_persons', verbose_name='Регион проживания')
+    conscription_region = models.ForeignKey(Place, null=True, blank=True, on_delete=models.SET_NULL,
+                                            editable=False, related_name='conscripted_persons',
+                                            verbose_name='Регион призыва')
+
+    # Periods of free text dates parsed by website.dates
+    birth_year = models.IntegerField(null=True, db_index=True, editable=False)
+    receipt_date_from = models.DateField(null=True, db_index=True, editable=False)
+    receipt_date_to = models.DateField(null=True, editable=False)
+    death_date_from = models.DateField(null=True, db_index=True, editable=False)
+    death_date_to = models.DateField(null=True, editable=False)
+    date_of_captivity_from = models.DateField(null=True, db_index=True, editable=False)
+    date_of_captivity_to = models.DateField(null=True, editable=False)
+    lost_date_from = models.DateField(null=True, db_index=True, editable=False)
+    lost_date_to = models.DateField(null=True, editable=False)
+
+    # Maintained by a database trigger on PostgreSQL, see migration 0050_person_search_vector
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['screen_name', 'id'], name='website_person_screen_name'),
+            # Pattern ops let PostgreSQL use the indexes for prefix searches in any collation
+            models.Index(fields=['fio_phonetic'], name='website_person_fio_phon', opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['fio_actual_phonetic'], name='website_person_fio_act_phon',
+                         opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['ontombstone_phonetic'], name='website_person_ontomb_phon',
+                         opclasses=['varchar_pattern_ops']),
+        ]
+
+    # Fields which the cemetery and hospital statistics depend on, see website.stats
+    _stats_fields = ['cemetery_id', 'cemetery_actual_id', 'hospital_linked_id', 'hospital_actual_id', 'active_import_id',
+                     'state', 'status']
+
+    # Screen field is the first non empty field of the list
+    _screen_fields = OrderedDict([
+        ('screen_name', ['fio_actual', 'fio', 'ontombstone']),
+        ('screen_born_region', ['born_region_actual', 'born_region']),
+        ('screen_born_address', ['born_address_actual', 'born_address']),
+        ('screen_address', ['address_actual', 'address']),
+        ('screen_military_unit', ['military_unit_actual', 'military_unit']),
+    ])
+
+    # Phonetic key field of the name field, see website.phonetic. Ordered by priority for surname_key
+    _phonetic_fields = OrderedDict([
+        ('fio_actual_phonetic', 'fio_actual'),
+        ('fio_phonetic', 'fio'),
+        ('ontombstone_phonetic', 'ontombstone'),
+    ])
+
+    # Date fields parsed into <field>_from and <field>_to, from the first non empty source field
+    _date_fields = OrderedDict([
+        ('receipt_date', ['receipt_date_actual', 'receipt_date']),
+        ('death_date', ['death_date_actual', 'death_date']),
+        ('date_of_captivity', ['date_of_captivity_actual', 'date_of_captivity']),
+        ('lost_date', ['lost_date_actual', 'lost_date']),
+    ])
+
+    # Region fields matched in the first source field naming a known place
+    _place_fields = OrderedDict([
+        ('birth_region', ['born_region_actual', 'born_region', 'born_address_actual', 'born_address']),
+        ('address_region', ['address_actual', 'address']),
+        ('conscription_region', ['conscription_place_actual', 'conscription_place']),
+    ])
+
+    # Sources of _place_fields naming only a region, other sources are addresses
+    _region_name_fields = ['born_region_actual', 'born_region']
+
     _single_mapped_fields = [
         'ontombstone',
         'state'
@@ -333,6 +627,7 @@ class Person(models.Model):
         'fio': ['fio', 'fio_actual', 'ontombstone'],
         'born_year': ['year', 'year_actual'],
         'state': ['state'],
+        'status': ['status'],
         'cemetery': ['cemetery__name', 'cemetery_actual__name'],
         'hospital': ['hospital', 'hospital_actual__name'],
         'born_region': ['born_region', 'born_region_actual'],
@@ -355,34 +650,37 @@ class Person(models.Model):
         'lost_date': ['lost_date', 'lost_date_actual'],
         'field_post': ['field_post'],
         'notes': ['notes'],
+        'region': ['birth_region', 'address_region', 'conscription_region'],
     }
 
     _search_filters_mapping = {
-        'fio': '__unaccent__icontains',
+        'fio': '__ucontains',
         'born_year': '__contains',
         'state': '',
-        'hospital': '__unaccent__icontains',
-        'cemetery': '__unaccent__icontains',
-        'born_region': '__unaccent__icontains',
-        'born_address': '__unaccent__icontains',
-        'conscription_place': '__unaccent__icontains',
-        'military_unit': '__unaccent__icontains',
-        'rank': '__unaccent__icontains',
-        'position': '__unaccent__icontains',
-        'address': '__unaccent__icontains',
-        'relatives': '__unaccent__icontains',
+        'status': '',
+        'hospital': '__ucontains',
+        'cemetery': '__ucontains',
+        'born_region': '__ucontains',
+        'born_address': '__ucontains',
+        'conscription_place': '__ucontains',
+        'military_unit': '__ucontains',
+        'rank': '__ucontains',
+        'position': '__ucontains',
+        'address': '__ucontains',
+        'relatives': '__ucontains',
         'receipt_date': '__icontains',
         'receipt_cause': '__icontains',
         'death_date': '__icontains',
         'death_cause': '__icontains',
-        'grave': '__unaccent__icontains',
+        'grave': '__ucontains',
         'date_of_captivity': '__icontains',
-        'place_of_captivity': '__unaccent__icontains',
-        'camp': '__unaccent__icontains',
+        'place_of_captivity': '__ucontains',
+        'camp': '__ucontains',
         'camp_number': '__icontains',
         'lost_date': '__icontains',
-        'field_post': '__unaccent__icontains',
-        'notes': '__unaccent__icontains',
+        'field_post': '__ucontains',
+        'notes': '__ucontains',
+        'region': '',
     }
 
     objects = PersonManager()
@@ -460,7 +758,7 @@ class Person(models.Model):
         skipped_some = False
         have_some = False
         for f, f_actual in self.get_pair_card_fields():
-            if self.__getattribute__(f_actual):
+            if getattr(self, self._meta.get_field(f_actual).attname):
                 have_some = True
             else:
                 skipped_some = True
@@ -474,16 +772,409 @@ class Person(models.Model):
         else:
             return self.INCOMPLETE
 
-    def save(self, *args, **kwargs):
+    @classmethod
+    def get_status_source_fields(cls):
+        return set(f_actual for f, f_actual in cls.get_pair_card_fields())
+
+    @classmethod
+    def get_status_expression(cls, values=None):
+        """
+        SQL version of get_status. Fields present in values are taken from values instead of the row
+        """
+        values = values or {}
+        have_some = False
+        skipped_some = False
+        conditions = []
+        for f, f_actual in cls.get_pair_card_fields():
+            value = values.get(f_actual)
+            if f_actual in values and not hasattr(value, 'resolve_expression'):
+                if value:
+                    have_some = True
+                else:
+                    skipped_some = True
+            else:
+                conditions.append(Filled(value if f_actual in values else F(f_actual), cls._meta.get_field(f_actual)))
+
+        if have_some and skipped_some:
+            return Value(cls.PARTIAL)
+        if not conditions:
+            return Value(cls.COMPLETE if have_some else cls.INCOMPLETE)
+
+        whens = []
+        if not skipped_some:
+            whens.append(When(AllOf(*conditions), then=Value(cls.COMPLETE)))
+        if not have_some:
+            whens.append(When(AnyOf(*conditions), then=Value(cls.PARTIAL)))
+        default = cls.PARTIAL if have_some else cls.INCOMPLETE
+        return Case(*whens, default=Value(default), output_field=IntegerField())
+
+    @classmethod
+    def get_screen_source_fields(cls):
+        return set(f for fields in cls._screen_fields.values() for f in fields)
+
+    @classmethod
+    def get_screen_field_expressions(cls, values=None):
+        """
+        Returns SQL expressions of screen fields, values may override source fields (e.g. values of an update)
+        """
+        values = values or {}
+        expressions = {}
+        for screen_field, fields in cls._screen_fields.items():
+            sources = []
+            for f in fields:
+                value = values.get(f, F(f))
+                if not hasattr(value, 'resolve_expression'):
+                    value = Value(value, output_field=CharField())
+                sources.append(NullIf(value, Value('')))
+            if screen_field == 'screen_name':
+                sources.append(Value(''))
+            expressions[screen_field] = Coalesce(*sources, output_field=CharField())
+        return expressions
+
+    @classmethod
+    def get_derived_fields(cls):
+        """
+        Fields computed from other fields of the person by update_derived_fields
+        """
+        return list(cls._screen_fields) + ['status'] + cls.get_computed_fields()
+
+    @classmethod
+    def get_computed_field_sources(cls):
+        """
+        Fields computed in Python with their source fields, a computed field gets its value from the first source
+        giving one
+        """
+        sources = OrderedDict((f, [source]) for f, source in cls._phonetic_fields.items())
+        sources['surname_key'] = list(cls._phonetic_fields.values())
+        sources['birth_year'] = ['year_actual', 'year']
+        for f, date_sources in cls._date_fields.items():
+            sources[f + '_from'] = sources[f + '_to'] = date_sources
+        sources.update(cls._place_fields)
+        sources['hospital_key'] = ['hospital']
+        return sources
+
+    @classmethod
+    def get_computed_source_fields(cls):
+        """
+        Fields which get_computed_fields are computed from in Python
+        """
+        return set(source for sources in cls.get_computed_field_sources().values() for source in sources)
+
+    @classmethod
+    def get_computed_fields(cls):
+        return list(cls.get_computed_field_sources())
+
+    @classmethod
+    def get_empty_source_conditions(cls):
+        """
+        Conditions of rows whose source field gives no computed value, for sources whose result is stored
+        """
+        conditions = {f: Q(**{key: ''}) for key, f in cls._phonetic_fields.items()}
+        conditions['year_actual'] = Q(year_actual=None) | Q(year_actual=0)
+        return conditions
+
+    @classmethod
+    def get_computed_values(cls, values):
+        """
+        Computed fields which the values of an update give without loading the rows: the first source giving
+        a value is a literal in values, and earlier sources are in values or their rows are checked in SQL.
+        Returns them and the computed fields depending on the rows.
+        """
+        empty_conditions = cls.get_empty_source_conditions()
+        computed = {}
+        row_fields = []
+        persons = {}
+        for f, sources in cls.get_computed_field_sources().items():
+            if not set(sources) & set(values):
+                continue
+            prefix = []
+            condition = Q()
+            for source in sources:
+                if source in values:
+                    if hasattr(values[source], 'resolve_expression'):
+                        break
+                    prefix.append(source)
+                elif source in empty_conditions:
+                    condition &= empty_conditions[source]
+                else:
+                    break
+            if prefix:
+                person = persons.get(tuple(prefix))
+                if person is None:
+                    person = persons[tuple(prefix)] = Person(**{source: values[source] for source in prefix})
+                    person.update_computed_fields()
+                field = cls._meta.get_field(f)
+                value = getattr(person, field.attname)
+                if value not in (None, '') or len(prefix) == len(sources):
+                    if condition:
+                        # Rows with a value from an earlier source keep it
+                        value = Case(When(condition, then=Value(value)), default=F(field.attname),
+                                     output_field=field)
+                    computed[f] = value
+                    continue
+            row_fields.append(f)
+        return computed, row_fields
+
+    def update_screen_fields(self):
+        for screen_field, fields in self._screen_fields.items():
+            value = None
+            for f in fields:
+                if getattr(self, f):
+                    value = getattr(self, f)
+                    break
+            if value is None and screen_field == 'screen_name':
+                value = ''
+            setattr(self, screen_field, value)
+
+    def update_phonetic_fields(self):
+        for phonetic_field, f in self._phonetic_fields.items():
+            setattr(self, phonetic_field, phonetic_key(getattr(self, f)))
+        # Surname of the name shown for the person, the first word of the name
+        keys = [getattr(self, f) for f in self._phonetic_fields if getattr(self, f)]
+        self.surname_key = keys[0].split(' ')[0] if keys else ''
+
+    def update_date_fields(self):
+        self.birth_year = self.year_actual or parse_year(self.year)
+        for f, sources in self._date_fields.items():
+            period = None
+            for source in sources:
+                period = parse_date(getattr(self, source))
+                if period:
+                    break
+            setattr(self, f + '_from', period.start if period else None)
+            setattr(self, f + '_to', period.end if period else None)
+
+    def update_place_fields(self):
+        from website.places import match_place
+        for f, sources in self._place_fields.items():
+            place_id = None
+            for source in sources:
+                place_id = match_place(getattr(self, source), address=source not in self._region_name_fields)
+                if place_id is not None:
+                    break
+            setattr(self, f + '_id', place_id)
+
+    def update_computed_fields(self):
+        self.update_phonetic_fields()
+        self.update_date_fields()
+        self.update_place_fields()
+        self.hospital_key = hospital_key(self.hospital)
+
+    def link_hospital(self):
+        from website.hospitals import resolve_hospital_keys
+        self.hospital_linked_id = resolve_hospital_keys([self.hospital_key]).get(self.hospital_key) \
+            if self.hospital_key else None
+
+    def update_derived_fields(self):
+        self.update_screen_fields()
+        self.update_computed_fields()
+        self.status = self.get_status()
+
+    def normalize_names(self):
         if self.ontombstone:
             self.ontombstone = self.ontombstone.title()
         if self.fio:
             self.fio = self.fio.title()
         if self.fio_actual:
             self.fio_actual = self.fio_actual.title()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Person, cls).from_db(db, field_names, values)
+        instance._loaded_stats_values = instance.get_stats_values() if instance.has_stats_values() else None
+        return instance
+
+    @classmethod
+    def get_stats_source_fields(cls):
+        fields = set()
+        for attname in cls._stats_fields:
+            field = cls._meta.get_field(attname[:-3] if attname.endswith('_id') else attname)
+            fields |= {field.name, field.attname}
+        return fields
+
+    @classmethod
+    def get_stats_ids(cls, rows):
+        """
+        Cemetery and hospital ids from rows of _stats_fields values
+        """
+        cemetery_ids, hospital_ids = set(), set()
+        for cemetery_id, cemetery_actual_id, hospital_linked_id, hospital_actual_id, *_ in rows:
+            cemetery_ids |= {cemetery_id, cemetery_actual_id}
+            hospital_ids |= {hospital_linked_id, hospital_actual_id}
+        return cemetery_ids - {None}, hospital_ids - {None}
+
+    def get_stats_values(self):
+        # __dict__ is used to not load deferred fields
+        return tuple(self.__dict__.get(f) for f in self._stats_fields)
+
+    def has_stats_values(self):
+        return not set(self._stats_fields) & self.get_deferred_fields()
+
+    def get_saved_stats_values(self):
+        return Person.objects.filter(pk=self.pk).values_list(*self._stats_fields).first()
+
+    def save(self, *args, **kwargs):
+        self.normalize_names()
+        self.update_derived_fields()
+        self.link_hospital()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | set(self.get_derived_fields()) | \
+                {'hospital_linked'}
+        old_stats_values = None
+        if not self._state.adding or self.pk is not None:
+            old_stats_values = getattr(self, '_loaded_stats_values', None) or self.get_saved_stats_values()
         super(Person, self).save(*args, **kwargs)
+        DataVersion.bump(DataVersion.PERSONS)
+
+        stats_values = self.get_stats_values() if self.has_stats_values() else self.get_saved_stats_values()
+        if stats_values != old_stats_values:
+            from website.stats import apply_stats_change
+            apply_stats_change(old_stats_values, stats_values)
+        self._loaded_stats_values = stats_values
+
+    def delete(self, *args, **kwargs):
+        stats_values = getattr(self, '_loaded_stats_values', None) or self.get_saved_stats_values()
+        result = super(Person, self).delete(*args, **kwargs)
+        DataVersion.bump(DataVersion.PERSONS)
+        from website.stats import apply_stats_change
+        apply_stats_change(stats_values, None)
+        return result
+
+
+class CemeteryStats(models.Model):
+    """
+    Number of persons of the cemetery by state and completeness status, maintained by website.stats
+    """
+    cemetery = models.ForeignKey(Cemetery, on_delete=models.CASCADE, related_name='stats')
+    state = models.IntegerField(choices=Person.STATES, null=True)
+    status = models.IntegerField(choices=Person.STATUSES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['cemetery', 'state', 'status']
+
+
+class HospitalStats(models.Model):
+    """
+    Number of persons of the hospital by state and completeness status, maintained by website.stats
+    """
+    hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='stats')
+    state = models.IntegerField(choices=Person.STATES, null=True)
+    status = models.IntegerField(choices=Person.STATUSES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['hospital', 'state', 'status']
+
+
+class DuplicateCandidate(models.Model):
+    """
+    Person of an import which may describe the same person as another one, found by website.duplicates
+    """
+    source_import = models.ForeignKey(Import, on_delete=models.CASCADE, related_name='duplicate_candidates')
+    person = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='+')
+    duplicate = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['-score', 'id']
+        unique_together = ['person', 'duplicate']
+
+    def get_score_percent(self):
+        return round(self.score * 100)
 
 
 class SearchData(models.Model):
-    hash = models.BinaryField(max_length=20, db_index=True)
+    hash = models.BinaryField(max_length=20, unique=True)
     fields = models.TextField()
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+    hits = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def touch(cls, id):
+        """
+        Records a use of the search, returns False if it does not exist (was evicted)
+        """
+        return bool(cls.objects.filter(id=id).update(last_used=timezone.now(), hits=F('hits') + 1))
+
+
+class Export(models.Model):
+    QUEUED = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATUSES = (
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнен'),
+        (FAILED, 'Ошибка'),
+    )
+
+    XLSX = 'xlsx'
+    CSV = 'csv'
+
+    FORMATS = (
+        (XLSX, 'Excel'),
+        (CSV, 'CSV'),
+    )
+
+    # Persons of the cemetery or found by the search, all persons if both are empty
+    cemetery = models.ForeignKey(Cemetery, null=True, blank=True, on_delete=models.CASCADE)
+    search = models.ForeignKey(SearchData, null=True, blank=True, on_delete=models.CASCADE)
+    format = models.CharField(max_length=4, choices=FORMATS, default=XLSX)
+    # DataVersion of persons the file was made from, the file is reused while the version is current
+    data_version = models.BigIntegerField(db_index=True)
+
+    status = models.IntegerField(choices=STATUSES, default=QUEUED, db_index=True)
+    file = models.FileField(storage=ExportStorage(), blank=True)
+    rows = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # One export of the same persons per data version, enqueue_export relies on it. NULLs are never equal
+        # in unique indexes, so exports of cemeteries, searches and all persons are constrained separately.
+        constraints = [
+            models.UniqueConstraint(fields=['format', 'cemetery', 'data_version'], name='website_export_cemetery',
+                                    condition=models.Q(cemetery__isnull=False, search__isnull=True)),
+            models.UniqueConstraint(fields=['format', 'search', 'data_version'], name='website_export_search',
+                                    condition=models.Q(cemetery__isnull=True, search__isnull=False)),
+            models.UniqueConstraint(fields=['format', 'data_version'], name='website_export_all',
+                                    condition=models.Q(cemetery__isnull=True, search__isnull=True)),
+        ]
+
+    def __str__(self):
+        if self.cemetery:
+            return self.cemetery.name
+        if self.search:
+            return 'Поиск %s' % self.search_id
+        return 'Люди'
+
+    def get_absolute_url(self):
+        return reverse('export_view', kwargs={'pk': self.pk})
+
+    def get_filename(self):
+        return '%s.%s' % (self, self.format)
+
+    def is_in_progress(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+
+    def is_ready(self):
+        return self.status == self.DONE and bool(self.file) and os.path.exists(self.file.path)
+
+    def get_progress(self):
+        return {
+            'status': self.status,
+            'status_name': self.get_status_display(),
+            'rows': self.rows,
+            'error': self.error,
+        }
+
+    def delete(self, *args, **kwargs):
+        if self.file and os.path.exists(self.file.path):
+            os.unlink(self.file.path)
+        super(Export, self).delete(*args, **kwargs)
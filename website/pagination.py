@@ -0,0 +1,100 @@
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    data = json.dumps(values, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor('Invalid cursor %r' % token)
+    if not isinstance(values, list):
+        raise InvalidCursor('Invalid cursor %r' % token)
+    return values
+
+
+class KeysetPage:
+    """
+    Page of a queryset which follows the previous page by filtering on the ordering keys of its last row
+    instead of using OFFSET. The queryset must be ordered by non null fields, the last of them unique.
+
+    The cursor is an opaque token holding the number of rows before the page and the keys of the last row
+    of the previous page.
+    """
+
+    def __init__(self, queryset, cursor, per_page):
+        self.keys = []
+        for field in queryset.query.order_by:
+            if not isinstance(field, str):
+                raise ValueError('Keyset pagination supports ordering by field names only')
+            self.keys.append((field.lstrip('-'), field.startswith('-')))
+        if not self.keys:
+            raise ValueError('Keyset pagination requires an ordered queryset')
+
+        offset = 0
+        if cursor:
+            values = decode_cursor(cursor)
+            if len(values) != len(self.keys) + 1 or not isinstance(values[0], int) or values[0] < 0:
+                raise InvalidCursor('Invalid cursor %r' % cursor)
+            offset = values[0]
+            queryset = queryset.filter(self.get_seek_filter(values[1:]))
+
+        rows = list(queryset[:per_page + 1])
+        self.object_list = rows[:per_page]
+        self.has_next = len(rows) > per_page
+        self.start_index = offset + 1
+        self.next_cursor = None
+        if self.has_next:
+            last = self.object_list[-1]
+            self.next_cursor = encode_cursor([offset + len(self.object_list)] +
+                                             [getattr(last, name) for name, _ in self.keys])
+
+    def get_seek_filter(self, values):
+        """
+        Rows after values in the ordering: (a > x) OR (a = x AND b > y) OR ...
+        """
+        seek = Q()
+        for i, (name, descending) in enumerate(self.keys):
+            condition = Q(**{'%s__%s' % (name, 'lt' if descending else 'gt'): values[i]})
+            for j, (prev_name, _) in enumerate(self.keys[:i]):
+                condition &= Q(**{prev_name: values[j]})
+            seek |= condition
+
+        # Redundant bound on the first key lets the database use a range scan of the index
+        name, descending = self.keys[0]
+        return Q(**{'%s__%s' % (name, 'lte' if descending else 'gte'): values[0]}) & seek
+
+
+class IdListPage:
+    """
+    Page of an ordered list of primary keys computed beforehand, rows are fetched by primary key. The cursor
+    holds the number of rows before the page, so cursors of KeysetPage over the same rows are accepted too.
+    """
+
+    def __init__(self, queryset, ids, cursor, per_page):
+        offset = 0
+        if cursor:
+            values = decode_cursor(cursor)
+            if not values or not isinstance(values[0], int) or values[0] < 0:
+                raise InvalidCursor('Invalid cursor %r' % cursor)
+            offset = values[0]
+
+        page_ids = ids[offset:offset + per_page]
+        objects = queryset.in_bulk(page_ids)
+        # Rows deleted since the list was computed are skipped
+        self.object_list = [objects[pk] for pk in page_ids if pk in objects]
+        self.has_next = offset + per_page < len(ids)
+        self.start_index = offset + 1
+        self.next_cursor = encode_cursor([offset + per_page]) if self.has_next else None
@@ -0,0 +1,164 @@
+import json
+import os
+import re
+import time
+from functools import lru_cache
+
+from website.lookups import search_text
+
+# The bundled gazetteer, loaded by migration 0059. After changing it run the load_places command, then
+# backfill_persons to match existing persons with the new places
+PLACES_FILE = os.path.join(os.path.dirname(__file__), 'data', 'places.json')
+
+# Words of administrative unit types, they are omitted so "Калининская обл." and "Калининской области" match
+REGION_TYPE_WORDS = {
+    'ОБЛ', 'ОБЛАСТЬ', 'ОБЛАСТИ', 'ОБЛАСТЮ', 'КРАИ', 'КРАЯ', 'КРАЮ', 'АССР', 'ССР', 'АО', 'РЕСП', 'РЕСПУБЛИКА',
+    'РЕСПУБЛИКИ', 'РЕСПУБЛИКЕ', 'ГУБ', 'ГУБЕРНИЯ', 'ГУБЕРНИИ', 'АВТОНОМНАЯ', 'АВТОНОМНОИ',
+}
+TYPE_WORDS = REGION_TYPE_WORDS | {'СССР', 'Г', 'ГОР', 'ГОРОД', 'ГОРОДА', 'ГОРОДЕ'}
+
+# Case endings of adjectives and nouns, longer endings first
+ENDINGS = [
+    'ОГО', 'ЕГО', 'ОМУ', 'ЕМУ', 'АЯ', 'ЯЯ', 'ОИ', 'ЕИ', 'УЮ', 'ЮЮ', 'ЫИ', 'ИИ', 'ОЕ', 'ЕЕ', 'ЫМ', 'ИМ', 'ОМ', 'ЕМ',
+    'А', 'Я', 'Ы', 'И', 'Е', 'У', 'Ю',
+]
+
+# Adjective endings, an adjective alone ("Московская") in an address is more likely a street than a region
+ADJECTIVE_ENDINGS = (
+    'АЯ', 'ЯЯ', 'ОИ', 'ЕИ', 'ЫИ', 'ИИ', 'ОГО', 'ЕГО', 'ОМУ', 'ЕМУ', 'УЮ', 'ЮЮ', 'ОЕ', 'ЕЕ', 'ЫЕ', 'ИЕ', 'ЫМ', 'ИМ',
+)
+
+_WORD_RE = re.compile('[А-ЯA-Z0-9]+')
+
+# Longest alias in words
+MAX_ALIAS_WORDS = 4
+
+# Seconds between checks of the places version by a process
+MATCHER_CHECK_INTERVAL = 60
+
+
+def stem(word):
+    if len(word) >= 5:
+        for ending in ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 4:
+                return word[:-len(ending)]
+    return word
+
+
+def place_words(text):
+    return [stem(word) for word in _WORD_RE.findall(search_text(text)) if word not in TYPE_WORDS]
+
+
+def place_key(text):
+    """
+    Normalized form of a place name: case, accents, unit type words and case endings are dropped
+    """
+    return ' '.join(place_words(text))
+
+
+def is_adjective(word):
+    return len(word) >= 5 and word.endswith(ADJECTIVE_ENDINGS)
+
+
+def names_region(words, positions, i, n):
+    """
+    Whether the alias found in words of an address at positions[i:i + n] names a region. Aliases which are only
+    adjectives need a region type word next to them ("Московская обл.") or must be the whole value, so
+    "ул. Московская" is not in Московская область.
+    """
+    first, last = positions[i], positions[i + n - 1]
+    if not all(is_adjective(word) for word in words[first:last + 1] if word not in TYPE_WORDS):
+        return True
+    if n == len(positions):
+        return True
+    return (first > 0 and words[first - 1] in REGION_TYPE_WORDS) or \
+        (last + 1 < len(words) and words[last + 1] in REGION_TYPE_WORDS)
+
+
+class PlaceMatcher:
+    """
+    Finds the first known place name in a text by looking up runs of normalized words in a hash of alias keys
+    """
+
+    def __init__(self, keys):
+        self._keys = dict(keys)
+        self.match = lru_cache(maxsize=10000)(self._match)
+
+    def _match(self, text, address=False):
+        if not text:
+            return None
+        words = _WORD_RE.findall(search_text(text))
+        positions = [i for i, word in enumerate(words) if word not in TYPE_WORDS]
+        stems = [stem(words[i]) for i in positions]
+        for i in range(len(stems)):
+            for n in range(min(MAX_ALIAS_WORDS, len(stems) - i), 0, -1):
+                place_id = self._keys.get(' '.join(stems[i:i + n]))
+                if place_id is not None and (not address or names_region(words, positions, i, n)):
+                    return place_id
+        return None
+
+
+class _MatcherCache:
+    matcher = None
+    version = None
+    checked = 0
+
+
+_cache = _MatcherCache()
+
+
+def get_place_matcher():
+    """
+    Matcher of the gazetteer aliases, rebuilt by a process when the places change
+    """
+    from website.models import DataVersion, PlaceAlias
+
+    now = time.monotonic()
+    if _cache.matcher is None or now - _cache.checked > MATCHER_CHECK_INTERVAL:
+        version = DataVersion.get(DataVersion.PLACES)
+        if _cache.matcher is None or version != _cache.version:
+            _cache.matcher = PlaceMatcher(PlaceAlias.objects.values_list('key', 'place_id'))
+            _cache.version = version
+        _cache.checked = now
+    return _cache.matcher
+
+
+def reset_place_matcher():
+    _cache.matcher = None
+
+
+def match_place(*values, address=False):
+    """
+    Id of the place of the first value naming a known place. Values are addresses unless they only name a region,
+    see names_region.
+    """
+    matcher = get_place_matcher()
+    for value in values:
+        place_id = matcher.match(value, address)
+        if place_id is not None:
+            return place_id
+    return None
+
+
+def read_places(path=PLACES_FILE):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_places(place_model, alias_model, places):
+    """
+    Creates places and aliases from a list of {"name": ..., "aliases": [...]}, existing aliases are moved to
+    the place listing them. Returns the number of created places and aliases.
+    """
+    created_places = 0
+    created_aliases = 0
+    for data in places:
+        place, created = place_model.objects.get_or_create(name=data['name'])
+        created_places += created
+        for name in [data['name']] + data.get('aliases', []):
+            key = place_key(name)
+            if not key:
+                continue
+            _, created = alias_model.objects.update_or_create(key=key, defaults={'place': place, 'name': name})
+            created_aliases += created
+    return created_places, created_aliases
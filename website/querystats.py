@@ -0,0 +1,142 @@
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    """
+    SQL queries executed in a block, see record_queries
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, repr(params), time.perf_counter() - started))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(elapsed for _, _, elapsed in self.queries)
+
+    def duplicates(self):
+        """
+        Queries executed more than once with the same parameters, as (sql, count) pairs
+        """
+        counts = Counter((sql, params) for sql, params, _ in self.queries)
+        return [(sql, count) for (sql, _), count in counts.most_common() if count > 1]
+
+    def repeated(self, threshold):
+        """
+        Queries executed at least threshold times with any parameters, N+1 candidates, as (sql, count) pairs
+        """
+        counts = Counter(sql for sql, _, _ in self.queries)
+        return [(sql, count) for sql, count in counts.most_common() if count >= threshold]
+
+
+class QueryCounter:
+    """
+    Number and time of SQL queries executed in a block, without keeping the statements
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - started
+
+
+@contextmanager
+def record_queries(stats=None):
+    """
+    Records queries of all database connections made in the block, unlike CaptureQueriesContext works
+    with DEBUG off. Queries are kept by a new QueryStats unless another recorder like QueryCounter is given.
+    """
+    if stats is None:
+        stats = QueryStats()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+def get_view_class(request):
+    match = getattr(request, 'resolver_match', None)
+    return getattr(match.func, 'view_class', None) if match else None
+
+
+def get_query_budget(request):
+    """
+    Maximal number of queries of the view of the request declared by its query_budget attribute, None if unknown
+    """
+    return getattr(get_view_class(request), 'query_budget', None)
+
+
+class QueryStatsMiddleware:
+    """
+    Development middleware logging the number and time of queries of every request, duplicated and repeated
+    queries and views exceeding their query_budget. Enabled by the QUERY_STATS setting.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with record_queries() as stats:
+            response = self.get_response(request)
+
+        match = request.resolver_match
+        view = match.view_name if match else request.path
+        logger.info('%s %s: %s queries in %.1f ms', request.method, view, stats.count, stats.time * 1000)
+        for sql, count in stats.duplicates():
+            logger.warning('%s %s: duplicated %s times: %s', request.method, view, count, sql)
+        for sql, count in stats.repeated(settings.QUERY_REPEAT_THRESHOLD):
+            logger.warning('%s %s: repeated %s times: %s', request.method, view, count, sql)
+        budget = get_query_budget(request)
+        if budget is not None and stats.count > budget:
+            logger.warning('%s %s: %s queries exceed the budget of %s', request.method, view, stats.count, budget)
+
+        response['X-Query-Count'] = str(stats.count)
+        response['X-Query-Time'] = '%.1f' % (stats.time * 1000)
+        return response
+
+
+class QueryBudgetTestMixin:
+    """
+    TestCase mixin failing when a view makes more queries than its query_budget, or duplicated or repeated queries
+    """
+    query_repeat_threshold = 5
+
+    def assertQueryBudget(self, method, path, data=None, budget=None, **extra):
+        with record_queries() as stats:
+            response = getattr(self.client, method)(path, data, **extra)
+        if budget is None:
+            budget = get_query_budget(response.wsgi_request)
+        self.assertIsNotNone(budget, 'The view of %s declares no query_budget' % path)
+
+        queries = '\n'.join(sql for sql, _, _ in stats.queries)
+        self.assertLessEqual(stats.count, budget, '%s made %s queries over the budget of %s:\n%s' % (
+            path, stats.count, budget, queries))
+        self.assertEqual(stats.duplicates(), [], '%s made duplicated queries' % path)
+        self.assertEqual(stats.repeated(self.query_repeat_threshold), [], '%s made repeated queries' % path)
+        return response
+
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast
+
+from website.dates import parse_date
+from website.models import DataVersion, Person, SearchData
+from website.phonetic import phonetic_key
+
+# Search form fields of dates which are also searched by periods with <field>_from and <field>_to fields. Dates are
+# matched by the periods parsed into Person.<field>_from and <field>_to, years of birth by Person.birth_year.
+RANGE_SEARCH_FIELDS = ['born_year', 'receipt_date', 'death_date', 'date_of_captivity', 'lost_date']
+
+# In-process LRU of SearchData ids by hash
+_search_ids = OrderedDict()
+_search_ids_lock = threading.Lock()
+
+# Columns matched by the quick search when full-text search is not available
+QUICK_SEARCH_FIELDS = [
+    'fio',
+    'fio_actual',
+    'ontombstone',
+    'hospital',
+    'born_region',
+    'born_region_actual',
+    'born_address',
+    'born_address_actual',
+    'conscription_place',
+    'conscription_place_actual',
+    'military_unit',
+    'military_unit_actual',
+    'address',
+    'address_actual',
+    'notes',
+]
+
+
+class UnaccentSearchQuery(SearchQuery):
+    """
+    Search query unaccented by immutable_unaccent() in SQL, with the same rules as the text of
+    Person.search_vector in the trigger
+    """
+
+    def as_sql(self, compiler, connection):
+        sql, params = super().as_sql(compiler, connection)
+        # The text is the last placeholder, after the config
+        i = sql.rindex('%s')
+        return '%simmutable_unaccent(%%s)%s' % (sql[:i], sql[i + 2:]), params
+
+
+def quick_search(queryset, text):
+    """
+    Filters persons by words of text. On PostgreSQL uses Person.search_vector and orders the result by rank,
+    elsewhere falls back to substring search over QUICK_SEARCH_FIELDS keeping the queryset ordering.
+    """
+    if connections[queryset.db].vendor == 'postgresql':
+        query = UnaccentSearchQuery(text, config='russian')
+        ordering = ['-search_rank'] + list(queryset.query.order_by)
+        # ts_rank() returns real, double precision values survive the round trip through pagination cursors
+        rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+        return queryset.filter(search_vector=query).annotate(search_rank=rank).order_by(*ordering)
+
+    filter = Q()
+    for field in QUICK_SEARCH_FIELDS:
+        filter |= Q(**{'%s__ucontains' % field: text})
+    return queryset.filter(filter)
+
+
+def get_range_search_fields():
+    return ['%s_%s' % (f, end) for f in RANGE_SEARCH_FIELDS for end in ('from', 'to')]
+
+
+def range_filter(field, start, end):
+    """
+    Persons whose date of the search field is within the period from start to end, both are DateRange or None
+    """
+    filter = Q()
+    if field == 'born_year':
+        if start:
+            filter &= Q(birth_year__gte=start.start.year)
+        if end:
+            filter &= Q(birth_year__lte=end.end.year)
+        return filter
+    if start:
+        filter &= Q(**{'%s_from__gte' % field: start.start})
+    if end:
+        filter &= Q(**{'%s_to__lte' % field: end.end})
+    return filter
+
+
+def sounds_like_filter(text):
+    """
+    Persons whose name sounds like text: the phonetic key of the name equals the key of text or starts with it
+    followed by other words, so "Иванов" finds "Иванова Мария". Both conditions use the phonetic key indexes.
+    """
+    key = phonetic_key(text)
+    if not key:
+        return Q()
+    filter = Q()
+    for field in Person._phonetic_fields:
+        filter |= Q(**{field: key}) | Q(**{'%s__startswith' % field: key + ' '})
+    return filter
+
+
+def search_persons(queryset, fields):
+    """
+    Filters persons by fields of a saved search (see PersonSearchForm)
+    """
+    for k, v in Person.get_search_mapping().items():
+        if k in fields:
+            val = fields[k]
+            if k == 'fio' and fields.get('fio_sounds_like'):
+                queryset = queryset.filter(sounds_like_filter(val))
+                continue
+            filter = Q()
+            for field in v:
+                if field == 'state' and val == '-1':
+                    args = {'state__isnull': True}
+                else:
+                    args = {'%s%s' % (field, Person._search_filters_mapping[k]): val}
+                filter |= Q(**args)
+            # Parsed dates add persons written in another format, texts parse_date can not read still match
+            period = parse_date(val) if k in RANGE_SEARCH_FIELDS else None
+            if period:
+                filter |= range_filter(k, period, period)
+            queryset = queryset.filter(filter)
+    for k in RANGE_SEARCH_FIELDS:
+        start = parse_date(fields.get('%s_from' % k))
+        end = parse_date(fields.get('%s_to' % k))
+        if start or end:
+            queryset = queryset.filter(range_filter(k, start, end))
+    if fields.get('quick'):
+        queryset = quick_search(queryset, fields['quick'])
+    return queryset
+
+
+def get_search_result_ids(queryset, search):
+    """
+    Ordered primary keys of persons found by the saved search, cached until persons change. Returns None for
+    results larger than SEARCH_RESULT_CACHE_LIMIT, those are paginated by the database.
+    """
+    cache_key = 'search:%s:%s' % (DataVersion.get(DataVersion.PERSONS), search.id)
+    ids = cache.get(cache_key)
+    if ids is None:
+        ids = list(queryset.values_list('id', flat=True)[:settings.SEARCH_RESULT_CACHE_LIMIT + 1])
+        if len(ids) > settings.SEARCH_RESULT_CACHE_LIMIT:
+            # Remembered as False so the limit is not hit on every page of a large result
+            ids = False
+        cache.set(cache_key, ids, settings.SEARCH_RESULT_CACHE_TIMEOUT)
+    return ids if ids is not False else None
+
+
+def save_search(fields):
+    """
+    SearchData of search form fields, created if the same search was not saved before. Records the use of it.
+    """
+    fields = json.dumps(fields)
+    hash = hashlib.sha1(fields.encode('utf-8')).digest()
+
+    with _search_ids_lock:
+        id = _search_ids.get(hash)
+        if id is not None:
+            _search_ids.move_to_end(hash)
+    # The cached id may belong to a search evicted by another process
+    if id is None or not SearchData.touch(id):
+        # hash is unique, a concurrent create of the same search makes get_or_create read the other row
+        id = SearchData.objects.get_or_create(hash=hash, defaults={'fields': fields})[0].id
+        SearchData.touch(id)
+
+    with _search_ids_lock:
+        _search_ids[hash] = id
+        _search_ids.move_to_end(hash)
+        while len(_search_ids) > settings.SEARCH_ID_CACHE_SIZE:
+            _search_ids.popitem(last=False)
+    return id
+
+
+def forget_searches():
+    with _search_ids_lock:
+        _search_ids.clear()
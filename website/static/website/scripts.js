@@ -46,6 +46,79 @@ function activate_pagination(page, load_more_url, list_element) {
     }
 }
 
+function poll_export_progress(progress_url, finished_statuses) {
+    $.ajax({
+        url: progress_url,
+        success: function (data) {
+            $('#export-status').text(data.status_name);
+            if (finished_statuses.indexOf(data.status) !== -1)
+                window.location.reload();
+            else
+                setTimeout(function () { poll_export_progress(progress_url, finished_statuses); }, 2000);
+        },
+        error: function () {
+            setTimeout(function () { poll_export_progress(progress_url, finished_statuses); }, 10000);
+        }
+    });
+}
+
+function activate_cursor_pagination(next_cursor, load_more_url, list_element) {
+    var loading = false;
+
+    $(window).scroll(function () {
+        if ($(window).scrollTop() === $(document).height() - $(window).height()) {
+            load_more();
+        }
+    });
+
+    function load_more() {
+        if (!next_cursor || loading)
+            return;
+
+        loading = true;
+        $.ajax({
+            url: load_more_url,
+            data: {"cursor": next_cursor},
+            contentType: "application/json",
+            success: function (data) {
+                next_cursor = data.next_cursor;
+                $('#' + list_element + ' tr:last').after(data.content);
+                clickable_rows();
+                $('[data-toggle="tooltip"]').tooltip();
+                $('[data-toggle="popover"]').popover();
+            },
+            error: function () {
+                next_cursor = null;
+            },
+            complete: function () {
+                loading = false;
+            }
+        });
+    }
+}
+
+function poll_import_progress(progress_url, finished_statuses) {
+    $.ajax({
+        url: progress_url,
+        success: function (data) {
+            $('#import-status').text(data.status_name);
+            $('#import-rows-processed').text(data.rows_processed);
+            $('#import-rows-total').text(data.rows_total);
+            $('#import-rows-per-second').text(data.rows_per_second || 0);
+            if (data.rows_total > 0)
+                $('#import-progress').css('width', Math.round(100 * data.rows_processed / data.rows_total) + '%');
+
+            if (data.data_added || finished_statuses.indexOf(data.status) !== -1)
+                window.location.reload();
+            else
+                setTimeout(function () { poll_import_progress(progress_url, finished_statuses); }, 2000);
+        },
+        error: function () {
+            setTimeout(function () { poll_import_progress(progress_url, finished_statuses); }, 10000);
+        }
+    });
+}
+
 function copy_data(from, to)
 {
     f_elem = $('#'+from);
@@ -0,0 +1,155 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from website.models import Cemetery, CemeteryStats, Hospital, HospitalStats, Person
+
+_deferred = threading.local()
+
+
+def count_persons(queryset, field):
+    counts = Counter()
+    rows = queryset.order_by().values_list(field, 'state', 'status').annotate(count=Count('id'))
+    for key, state, status, count in rows:
+        counts[key, state, status] += count
+    return counts
+
+
+def count_cemetery_persons(cemetery_ids=None):
+    """
+    Persons of cemeteries by state and status, a person with different cemetery and cemetery_actual is counted
+    in both of them
+    """
+    persons = Person.objects.filter(active_import=None)
+    actual_persons = persons.filter(cemetery_actual__isnull=False).exclude(cemetery=F('cemetery_actual'))
+    if cemetery_ids is not None:
+        persons = persons.filter(cemetery__in=cemetery_ids)
+        actual_persons = actual_persons.filter(cemetery_actual__in=cemetery_ids)
+    else:
+        persons = persons.filter(cemetery__isnull=False)
+    return count_persons(persons, 'cemetery') + count_persons(actual_persons, 'cemetery_actual')
+
+
+def count_hospital_persons(hospital_ids=None):
+    """
+    Persons of hospitals by state and status like HospitalDetailView lists them, a person linked by the hospital
+    name and with a different hospital_actual is counted in both of them
+    """
+    persons = Person.objects.filter(active_import=None)
+    actual_persons = persons.filter(hospital_actual__isnull=False).exclude(hospital_linked=F('hospital_actual'))
+    if hospital_ids is not None:
+        persons = persons.filter(hospital_linked__in=hospital_ids)
+        actual_persons = actual_persons.filter(hospital_actual__in=hospital_ids)
+    else:
+        persons = persons.filter(hospital_linked__isnull=False)
+    return count_persons(persons, 'hospital_linked') + count_persons(actual_persons, 'hospital_actual')
+
+
+def get_person_counts(values):
+    """
+    Statistics rows a person with Person._stats_fields values is counted in, as cemetery and hospital counters
+    keyed like count_cemetery_persons and count_hospital_persons. None values are a missing person.
+    """
+    cemeteries, hospitals = Counter(), Counter()
+    if values is None:
+        return cemeteries, hospitals
+    cemetery_id, cemetery_actual_id, hospital_linked_id, hospital_actual_id, active_import_id, state, status = values
+    if active_import_id is not None:
+        return cemeteries, hospitals
+    for key in {cemetery_id, cemetery_actual_id} - {None}:
+        cemeteries[key, state, status] += 1
+    for key in {hospital_linked_id, hospital_actual_id} - {None}:
+        hospitals[key, state, status] += 1
+    return cemeteries, hospitals
+
+
+def change_count(model, field, key, state, status, delta):
+    rows = model.objects.filter(**{'%s_id' % field: key, 'state': state, 'status': status})
+    if rows.update(count=F('count') + delta):
+        if delta < 0:
+            rows.filter(count__lte=0).delete()
+        return
+    if delta < 0:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**{'%s_id' % field: key, 'state': state, 'status': status, 'count': delta})
+    except IntegrityError:
+        # Created by a concurrent change, or the cemetery or hospital is deleted
+        rows.update(count=F('count') + delta)
+
+
+def apply_stats_change(old_values, new_values):
+    """
+    Changes statistics by a single person changed from old to new Person._stats_fields values, None for a missing
+    person. Counts are incremented instead of recounting all persons of the cemeteries and hospitals.
+    """
+    if getattr(_deferred, 'ids', None) is not None:
+        refresh_stats(*Person.get_stats_ids(values for values in (old_values, new_values) if values is not None))
+        return
+
+    old_cemeteries, old_hospitals = get_person_counts(old_values)
+    cemeteries, hospitals = get_person_counts(new_values)
+    cemeteries.subtract(old_cemeteries)
+    hospitals.subtract(old_hospitals)
+    for model, field, counts in ((CemeteryStats, 'cemetery', cemeteries), (HospitalStats, 'hospital', hospitals)):
+        for (key, state, status), delta in sorted(counts.items(), key=lambda item: item[0][0]):
+            if delta:
+                change_count(model, field, key, state, status, delta)
+
+
+def replace_stats(model, field, parent_model, ids, counts):
+    with transaction.atomic():
+        stats = model.objects.all()
+        if ids is not None:
+            # Serializes concurrent refreshes of the same rows
+            list(parent_model.objects.select_for_update().filter(pk__in=ids).values_list('pk'))
+            stats = stats.filter(**{'%s__in' % field: ids})
+        stats.delete()
+        model.objects.bulk_create([
+            model(**{'%s_id' % field: key, 'state': state, 'status': status, 'count': count})
+            for (key, state, status), count in counts.items()
+        ])
+
+
+@contextmanager
+def defer_stats():
+    """
+    Collects statistics refreshes of the block and runs them once on exit, for bulk changes made in batches
+    """
+    if getattr(_deferred, 'ids', None) is not None:
+        yield
+        return
+
+    _deferred.ids = (set(), set())
+    try:
+        yield
+        cemetery_ids, hospital_ids = _deferred.ids
+    finally:
+        _deferred.ids = None
+    refresh_stats(cemetery_ids, hospital_ids)
+
+
+def refresh_stats(cemetery_ids=(), hospital_ids=()):
+    """
+    Recounts statistics of the given cemeteries and hospitals
+    """
+    if getattr(_deferred, 'ids', None) is not None:
+        _deferred.ids[0].update(cemetery_ids)
+        _deferred.ids[1].update(hospital_ids)
+        return
+
+    cemetery_ids = sorted(set(cemetery_ids) - {None})
+    hospital_ids = sorted(set(hospital_ids) - {None})
+    if cemetery_ids:
+        replace_stats(CemeteryStats, 'cemetery', Cemetery, cemetery_ids, count_cemetery_persons(cemetery_ids))
+    if hospital_ids:
+        replace_stats(HospitalStats, 'hospital', Hospital, hospital_ids, count_hospital_persons(hospital_ids))
+
+
+def refresh_all_stats():
+    replace_stats(CemeteryStats, 'cemetery', Cemetery, None, count_cemetery_persons())
+    replace_stats(HospitalStats, 'hospital', Hospital, None, count_hospital_persons())
@@ -0,0 +1,18 @@
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+
+class ExportStorage(FileSystemStorage):
+    """
+    Export files in EXPORT_DIR outside MEDIA_ROOT, so they are only served by the login protected ExportDownloadView
+    """
+
+    @property
+    def base_location(self):
+        return settings.EXPORT_DIR
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
@@ -0,0 +1,291 @@
+import csv
+import datetime
+import random
+from collections import OrderedDict
+
+from django.utils import timezone
+from openpyxl import Workbook
+
+from website.hospitals import resolve_hospital_keys
+from website.models import Cemetery, Hospital, Person
+from website.places import read_places
+from website.stats import defer_stats
+
+SURNAMES = [
+    'Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков', 'Федоров',
+    'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров', 'Павлов', 'Козлов', 'Степанов', 'Николаев',
+    'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Соловьев', 'Борисов', 'Яковлев', 'Григорьев',
+    'Романов', 'Воробьев', 'Сергеев', 'Кузьмин', 'Фролов', 'Александров', 'Дмитриев', 'Королев', 'Гусев', 'Киселев',
+    'Ильин', 'Максимов', 'Поляков', 'Сорокин', 'Виноградов', 'Ковалев', 'Белов', 'Медведев', 'Антонов', 'Тарасов',
+    'Жуков', 'Баранов', 'Филиппов', 'Комаров', 'Давыдов', 'Беляев', 'Герасимов', 'Богданов', 'Осипов', 'Сидоров',
+    'Матвеев', 'Титов', 'Марков', 'Миронов', 'Крылов', 'Куликов', 'Карпов', 'Власов', 'Мельников', 'Денисов',
+    'Гаврилов', 'Тихонов', 'Казаков', 'Афанасьев', 'Данилов', 'Савельев', 'Тимофеев', 'Фомин', 'Чернов', 'Абрамов',
+    'Успенский', 'Покровский', 'Вознесенский', 'Троицкий', 'Шевченко', 'Бондаренко', 'Коваленко', 'Ковальчук',
+    'Мельник', 'Бойко', 'Ткаченко', 'Кравченко', 'Гарипов', 'Хабибуллин', 'Сафин', 'Ахметов', 'Исмаилов', 'Алиев',
+]
+
+MALE_NAMES = [
+    'Иван', 'Петр', 'Алексей', 'Николай', 'Михаил', 'Сергей', 'Василий', 'Александр', 'Федор', 'Дмитрий', 'Андрей',
+    'Павел', 'Григорий', 'Степан', 'Яков', 'Егор', 'Семен', 'Тимофей', 'Илья', 'Константин', 'Владимир', 'Борис',
+    'Максим', 'Матвей', 'Никита', 'Роман', 'Филипп', 'Захар', 'Афанасий', 'Гавриил',
+]
+
+FEMALE_NAMES = [
+    'Мария', 'Анна', 'Екатерина', 'Евдокия', 'Александра', 'Татьяна', 'Надежда', 'Валентина', 'Клавдия', 'Нина',
+    'Зинаида', 'Антонина', 'Прасковья', 'Ольга', 'Елена',
+]
+
+# Stems of patronymics, "Иванович" and "Ивановна"
+PATRONYMICS = [
+    'Иванов', 'Петров', 'Алексеев', 'Николаев', 'Михайлов', 'Сергеев', 'Васильев', 'Александров', 'Федоров',
+    'Дмитриев', 'Андреев', 'Павлов', 'Григорьев', 'Степанов', 'Яковлев', 'Егоров', 'Семенов', 'Тимофеев',
+    'Константинов', 'Владимиров', 'Борисов', 'Максимов', 'Матвеев', 'Романов', 'Филиппов', 'Захаров', 'Афанасьев',
+]
+
+DISTRICTS = ['Ржевский', 'Калининский', 'Лужский', 'Сызранский', 'Ковровский', 'Муромский', 'Шуйский',
+             'Котельничский', 'Вятский', 'Ленинский', 'Советский', 'Октябрьский', 'Кировский', 'Сталинский']
+
+SETTLEMENTS = ['Ивановка', 'Петровка', 'Александровка', 'Никольское', 'Покровка', 'Березовка', 'Сосновка',
+               'Красное', 'Михайловка', 'Горки', 'Заречье', 'Новоселки', 'Дубровка', 'Каменка']
+
+RANKS = ['рядовой', 'красноармеец', 'ефрейтор', 'мл. сержант', 'сержант', 'ст. сержант', 'старшина',
+         'мл. лейтенант', 'лейтенант', 'ст. лейтенант', 'капитан', 'майор']
+
+POSITIONS = ['стрелок', 'пулеметчик', 'автоматчик', 'сапер', 'связист', 'наводчик', 'шофер', 'санитар',
+             'командир отделения', 'командир взвода', 'командир роты']
+
+UNITS = ['%s сд', '%s сп', '%s гв. сд', '%s осбр', '%s тбр', '%s ап', '%s гсп']
+
+CAUSES = ['ранение', 'тяжелое ранение', 'осколочное ранение', 'пулевое ранение', 'контузия', 'обморожение',
+          'болезнь', 'ранение в грудь', 'ранение в голову']
+
+RELATIVES = ['жена', 'мать', 'отец', 'сестра', 'брат', 'сын', 'дочь']
+
+MONTHS = ['января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа', 'сентября', 'октября',
+          'ноября', 'декабря']
+
+HOSPITAL_TYPES = ['ЭГ', 'СЭГ', 'ППГ', 'ХППГ']
+
+WAR_START = datetime.date(1941, 6, 22)
+WAR_END = datetime.date(1945, 5, 9)
+
+# Share of persons having a value of the primary field
+FIELD_FREQUENCIES = OrderedDict([
+    ('ontombstone', 0.3),
+    ('year', 0.8),
+    ('born_region', 0.6),
+    ('born_address', 0.4),
+    ('conscription_place', 0.6),
+    ('military_unit', 0.5),
+    ('rank', 0.7),
+    ('position', 0.3),
+    ('address', 0.3),
+    ('relatives', 0.4),
+    ('hospital', 0.5),
+    ('receipt_date', 0.4),
+    ('receipt_cause', 0.3),
+    ('death_date', 0.8),
+    ('death_cause', 0.5),
+    ('grave', 0.5),
+    ('date_of_captivity', 0.05),
+    ('place_of_captivity', 0.05),
+    ('camp', 0.05),
+    ('camp_number', 0.05),
+    ('lost_date', 0.1),
+    ('field_post', 0.1),
+    ('notes', 0.1),
+])
+
+# Columns of generated import files after the numbering column
+IMPORT_FIELDS = ['fio', 'state'] + list(FIELD_FREQUENCIES)
+
+CHUNK_SIZE = 1000
+
+
+class SyntheticData:
+    """
+    Reproducible generator of realistic persons data, the same seed gives the same values
+    """
+
+    def __init__(self, seed=0, actual_ratio=0.2, hospitals=100):
+        self.random = random.Random(seed)
+        self.actual_ratio = actual_ratio
+        self.places = [[place['name']] + place['aliases'] for place in read_places()]
+        self.hospital_names = self.make_hospital_names(hospitals)
+
+    def chance(self, probability):
+        return self.random.random() < probability
+
+    def make_hospital_names(self, count):
+        numbers = self.random.sample(range(100, 6000), count)
+        return ['%s %s' % (self.random.choice(HOSPITAL_TYPES), number) for number in numbers]
+
+    def surname(self, female):
+        surname = self.random.choice(SURNAMES)
+        if not female:
+            return surname
+        if surname.endswith(('ов', 'ев', 'ин', 'ын')):
+            return surname + 'а'
+        if surname.endswith('ий'):
+            return surname[:-2] + 'ая'
+        return surname
+
+    def patronymic(self, female):
+        return self.random.choice(PATRONYMICS) + ('на' if female else 'ич')
+
+    def fio(self):
+        female = self.chance(0.05)
+        name = self.random.choice(FEMALE_NAMES if female else MALE_NAMES)
+        if self.chance(0.1):
+            return '%s %s.%s.' % (self.surname(female), name[0], self.patronymic(female)[0])
+        return '%s %s %s' % (self.surname(female), name, self.patronymic(female))
+
+    def region(self):
+        names = self.random.choice(self.places)
+        name = self.random.choice(names)
+        if name.endswith(' область') and self.chance(0.5):
+            name = name[:-len('асть')] + '.'
+        return name
+
+    def settlement(self):
+        return '%s %s' % (self.random.choice(['д.', 'с.', 'пос.']), self.random.choice(SETTLEMENTS))
+
+    def date(self, start=WAR_START, end=WAR_END):
+        return start + datetime.timedelta(days=self.random.randint(0, (end - start).days))
+
+    def date_text(self, date):
+        format = self.random.random()
+        if format < 0.6:
+            return date.strftime('%d.%m.%Y')
+        if format < 0.75:
+            return '%s %s %s г.' % (date.day, MONTHS[date.month - 1], date.year)
+        if format < 0.9:
+            return date.strftime('%m.%Y')
+        return str(date.year)
+
+    def hospital(self):
+        name = self.random.choice(self.hospital_names)
+        if self.chance(0.2):
+            type, number = name.split(' ')
+            return {'ЭГ': 'эвакогоспиталь № %s', 'СЭГ': 'СЭГ-%s'}.get(type, type + ' №%s') % number
+        return name
+
+    def values(self):
+        """
+        Text values of the mapped fields of a person as they are found in lists
+        """
+        fio = self.fio()
+        values = OrderedDict([('fio', fio), ('state', self.random.choice(Person.STATES)[0])])
+        death = self.date()
+        generators = {
+            'ontombstone': lambda: fio.split(' ')[0] + ' ' + ''.join(w[0] + '.' for w in fio.split(' ')[1:]),
+            'year': lambda: self.random.choice(['%s', '%s г.', '%s г.р.']) % self.random.randint(1890, 1927),
+            'born_region': self.region,
+            'born_address': lambda: '%s, %s' % (self.settlement(), self.region()),
+            'conscription_place': lambda: '%s РВК, %s' % (self.random.choice(DISTRICTS), self.region()),
+            'military_unit': lambda: self.random.choice(UNITS) % self.random.randint(1, 400),
+            'rank': lambda: self.random.choice(RANKS),
+            'position': lambda: self.random.choice(POSITIONS),
+            'address': lambda: '%s, %s' % (self.settlement(), self.region()),
+            'relatives': lambda: '%s %s' % (self.random.choice(RELATIVES), self.fio()),
+            'hospital': self.hospital,
+            'receipt_date': lambda: self.date_text(death - datetime.timedelta(days=self.random.randint(1, 60))),
+            'receipt_cause': lambda: self.random.choice(CAUSES),
+            'death_date': lambda: self.date_text(death),
+            'death_cause': lambda: self.random.choice(CAUSES),
+            'grave': lambda: 'ряд %s, могила %s' % (self.random.randint(1, 40), self.random.randint(1, 300)),
+            'date_of_captivity': lambda: self.date_text(self.date()),
+            'place_of_captivity': self.region,
+            'camp': lambda: 'Шталаг %s' % self.random.choice(['IV B', 'VI K', 'XI A', '326', '352']),
+            'camp_number': lambda: str(self.random.randint(1, 200000)),
+            'lost_date': lambda: self.date_text(self.date()),
+            'field_post': lambda: 'п/п %05d' % self.random.randint(1, 99999),
+            'notes': lambda: self.random.choice(['перезахоронен', 'уточнено по донесению', 'нет данных']),
+        }
+        for field, frequency in FIELD_FREQUENCIES.items():
+            values[field] = generators[field]() if self.chance(frequency) else ''
+        return values
+
+    def actual_values(self, values):
+        """
+        Sparse corrected values of the _actual fields
+        """
+        actual = {}
+        if values['fio'] and self.chance(self.actual_ratio):
+            actual['fio_actual'] = self.fio() if self.chance(0.2) else values['fio']
+        if values['year'] and self.chance(self.actual_ratio):
+            actual['year_actual'] = self.random.randint(1890, 1927)
+        for field in ('born_region', 'conscription_place', 'military_unit', 'rank', 'address', 'grave'):
+            if values[field] and self.chance(self.actual_ratio):
+                actual[field + '_actual'] = values[field]
+        for field in ('receipt_date', 'death_date'):
+            if values[field] and self.chance(self.actual_ratio):
+                date = self.date()
+                actual[field + '_actual'] = timezone.make_aware(datetime.datetime(date.year, date.month, date.day))
+        return actual
+
+
+def create_corpus(persons, cemeteries=10, hospitals=100, seed=0, actual_ratio=0.2, progress=None):
+    """
+    Creates cemeteries, hospitals and persons with generated data. Returns the created cemeteries and hospitals.
+    """
+    data = SyntheticData(seed, actual_ratio, hospitals)
+    cemetery_objects = [Cemetery.objects.create(name='Воинское захоронение № %s' % (i + 1))
+                        for i in range(cemeteries)]
+    hospital_objects = [Hospital.objects.create(name=name) for name in data.hospital_names]
+
+    with defer_stats():
+        for start in range(0, persons, CHUNK_SIZE):
+            chunk = []
+            for _ in range(min(CHUNK_SIZE, persons - start)):
+                values = data.values()
+                person = Person(**values)
+                if cemetery_objects:
+                    person.cemetery = data.random.choice(cemetery_objects)
+                for field, value in data.actual_values(values).items():
+                    setattr(person, field, value)
+                if values['hospital'] and hospital_objects and data.chance(actual_ratio):
+                    person.hospital_actual = data.random.choice(hospital_objects)
+                person.normalize_names()
+                person.update_derived_fields()
+                chunk.append(person)
+
+            hospital_ids = resolve_hospital_keys({person.hospital_key for person in chunk} - {''})
+            for person in chunk:
+                person.hospital_linked_id = hospital_ids.get(person.hospital_key)
+            Person.objects.bulk_create(chunk)
+            if progress:
+                progress(start + len(chunk))
+    return cemetery_objects, hospital_objects
+
+
+def iter_import_rows(rows, seed=0):
+    """
+    Yields the header and rows of an import file: numbering column and the mapped fields
+    """
+    data = SyntheticData(seed)
+    yield ['N'] + [str(Person._meta.get_field(field).verbose_name) for field in IMPORT_FIELDS]
+    for row in range(rows):
+        values = data.values()
+        yield [row + 1] + [values[field] for field in IMPORT_FIELDS]
+
+
+def get_import_mapping():
+    """
+    Mapping of the files written by write_import_file, field name to data column index
+    """
+    return {field: col for col, field in enumerate(IMPORT_FIELDS)}
+
+
+def write_import_file(path, rows, seed=0, format='csv'):
+    if format == 'xlsx':
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        for row in iter_import_rows(rows, seed):
+            ws.append(row)
+        wb.save(path)
+    else:
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            for row in iter_import_rows(rows, seed):
+                writer.writerow(row)
@@ -1,6 +1,65 @@
-from django.test import TestCase
+import codecs
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from unittest import mock, skipUnless
 
-from website.models import Person
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import Workbook, load_workbook
+
+from website.counts import get_count
+from website.dates import parse_date, parse_year
+from website.importer import ImporterFactory, CSVImporter, PersonImportPipeline, CopyPersonImportPipeline
+from website.jobs import claim_import, enqueue_export, enqueue_import, run_import, run_pending_jobs
+from website.metrics import collect, registry, render_metrics
+from website.duplicates import Record, score
+from website.forms import PersonSearchForm
+from website.hospitals import hospital_key, link_hospitals
+from website.models import DataVersion, Person, Import, Cemetery, Hospital, CemeteryStats, HospitalStats, Export, SearchData, \
+    DuplicateCandidate, Place
+from website.pagination import KeysetPage, InvalidCursor
+from website.phonetic import phonetic_key
+from website.querystats import QueryBudgetTestMixin, QueryCounter, record_queries
+from website.places import PlaceMatcher, match_place, place_key, read_places, reset_place_matcher
+from website.search import quick_search, save_search, forget_searches, search_persons
+from website.stats import refresh_all_stats
+from website.synthetic import SyntheticData, create_corpus, get_import_mapping, write_import_file
+from website.views import KeysetPaginationMixin
+
+
+def commit_callbacks():
+    callbacks = connection.run_on_commit[:]
+    del connection.run_on_commit[:]
+    for _, func in callbacks:
+        func()
+
+
+@contextmanager
+def run_commit_callbacks():
+    """
+    Runs on_commit callbacks as if the block was a committed transaction, TestCase never commits. DataVersion
+    is bumped by them.
+    """
+    commit_callbacks()
+    yield
+    commit_callbacks()
 
 
 class PersonTestCase(TestCase):
@@ -35,3 +94,1161 @@ class PersonTestCase(TestCase):
 
     def tearDown(self):
         Person.objects.all().delete()
+
+
+class PersonStatusTestCase(TestCase):
+    def setUp(self):
+        self.cemetery = Cemetery.objects.create(name='Мемориал')
+
+    def get_complete_values(self):
+        values = {}
+        for f, f_actual in Person.get_pair_card_fields():
+            field = Person._meta.get_field(f_actual)
+            if field.is_relation:
+                values[f_actual] = self.cemetery if f == 'cemetery' else Hospital.objects.create(name='Госпиталь')
+            elif isinstance(field, models.IntegerField):
+                values[f_actual] = 1942
+            elif isinstance(field, models.DateTimeField):
+                values[f_actual] = timezone.now()
+            else:
+                values[f_actual] = 'x'
+        return values
+
+    def test_status_on_save(self):
+        person = Person.objects.create(fio='Иванов')
+        self.assertEqual(person.status, Person.INCOMPLETE)
+        person.fio_actual = 'Иванов'
+        person.save(update_fields=['fio_actual'])
+        self.assertEqual(Person.objects.get().status, Person.PARTIAL)
+
+        person = Person.objects.create(**self.get_complete_values())
+        self.assertEqual(Person.objects.get(pk=person.pk).status, Person.COMPLETE)
+
+    def test_status_on_update(self):
+        Person.objects.create(fio='Иванов')
+        Person.objects.create(fio='Петров', fio_actual='Петров', year_actual=0)
+        Person.objects.create(**self.get_complete_values())
+
+        Person.objects.update(status=Person.get_status_expression())
+        for person in Person.objects.all():
+            self.assertEqual(person.status, person.get_status())
+
+        Person.objects.filter(fio='Петров').update(fio_actual='')
+        self.assertEqual(Person.objects.get(fio='Петров').status, Person.INCOMPLETE)
+        Person.objects.filter(fio='Петров').update(fio_actual=F('fio'))
+        self.assertEqual(Person.objects.get(fio='Петров').status, Person.PARTIAL)
+
+        Person.objects.filter(fio='Иванов').update(**self.get_complete_values())
+        self.assertEqual(Person.objects.get(fio='Иванов').status, Person.COMPLETE)
+        Person.objects.filter(fio='Иванов').update(year_actual=None)
+        self.assertEqual(Person.objects.get(fio='Иванов').status, Person.PARTIAL)
+
+    def test_cemetery_status_counts(self):
+        Person.objects.create(fio='Иванов', cemetery=self.cemetery)
+        Person.objects.create(fio='Петров', cemetery_actual=self.cemetery)
+        self.client.force_login(get_user_model().objects.create_user('user', password='password'))
+        response = self.client.get(reverse('cemetery_detail', args=[self.cemetery.pk]))
+        self.assertEqual([status['count'] for status in response.context['status_counts']], [1, 1, 0])
+
+
+class PersonScreenFieldsTestCase(TestCase):
+    def test_screen_fields_on_save(self):
+        person = Person.objects.create(fio='иванов', ontombstone='петров', born_region='Тверская', military_unit='')
+        self.assertEqual(person.screen_name, 'Иванов')
+        self.assertEqual(person.screen_born_region, 'Тверская')
+        self.assertIsNone(person.screen_military_unit)
+
+        person.fio_actual = 'сидоров'
+        person.save(update_fields=['fio_actual'])
+        self.assertEqual(Person.objects.get(pk=person.pk).screen_name, 'Сидоров')
+
+    def test_unknown_screen_name(self):
+        person = Person.objects.create()
+        self.assertEqual(person.screen_name, '')
+
+    def test_screen_fields_on_update(self):
+        person = Person.objects.create(fio='Иванов', born_region='Тверская')
+        Person.objects.filter(pk=person.pk).update(fio='', ontombstone='Петров', born_region_actual='Калининская')
+        person.refresh_from_db()
+        self.assertEqual(person.screen_name, 'Петров')
+        self.assertEqual(person.screen_born_region, 'Калининская')
+
+    def test_backfill(self):
+        person = Person.objects.create(fio='Иванов')
+        Person.objects.filter(pk=person.pk).update(screen_name='')
+        call_command('backfill_persons', stdout=io.StringIO())
+        self.assertEqual(Person.objects.get(pk=person.pk).screen_name, 'Иванов')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_CACHE_DIR=tempfile.mkdtemp())
+class ImporterTestCase(TestCase):
+    def create_import(self, name, content, **kwargs):
+        return Import.objects.create(file=SimpleUploadedFile(name, content), **kwargs)
+
+    def create_xlsx_import(self, rows, **kwargs):
+        wb = Workbook()
+        ws = wb.active
+        for row in rows:
+            ws.append(row)
+        stream = io.BytesIO()
+        wb.save(stream)
+        return self.create_import('import.xlsx', stream.getvalue(), **kwargs)
+
+    def test_xlsx_rows(self):
+        obj = self.create_xlsx_import([
+            ['#', 'ФИО', 'Дата смерти'],
+            [1, 'Иванов Иван', datetime.datetime(1942, 5, 1)],
+            [None, None, None],
+            [2, 'Петров Петр', None],
+        ])
+        importer = ImporterFactory(obj).get_importer()
+        self.assertEqual(list(importer.iter_data()), [
+            ([1], ['Иванов Иван', '01.05.1942']),
+            ([2], ['Петров Петр', '']),
+        ])
+
+    def test_xlsx_scan_limits_rows(self):
+        obj = self.create_xlsx_import([['#', 'ФИО']] + [[i, 'Человек %s' % i] for i in range(1, 11)])
+        data_header, data, data_cols, data_len = ImporterFactory(obj).get_importer().scan(3)
+        self.assertEqual(data_header, [['#', 'ФИО']])
+        self.assertEqual(data, [([1], ['Человек 1']), ([2], ['Человек 2']), ([3], ['Человек 3'])])
+        self.assertEqual(data_cols, 1)
+        self.assertEqual(data_len, 10)
+
+    def test_csv_rows(self):
+        obj = self.create_import('import.csv', 'N,ФИО\n1,Иванов\n,\n2,Петров\n'.encode('utf-8'))
+        _, data, data_cols, data_len = ImporterFactory(obj).get_importer().scan()
+        self.assertEqual(data, [(['1'], ['Иванов']), (['2'], ['Петров'])])
+        self.assertEqual((data_cols, data_len), (1, 2))
+
+    def test_csv_encoding_detected_once(self):
+        content = 'N;ФИО\n' + ''.join('%s;Иванов Иван Иванович\n' % i for i in range(100))
+        obj = self.create_import('import.csv', content.encode('cp1251'), delimiter=';')
+        _, data, _, _ = ImporterFactory(obj).get_importer().scan(1)
+        self.assertEqual(data, [(['0'], ['Иванов Иван Иванович'])])
+        obj.refresh_from_db()
+        self.assertEqual(obj.encoding, 'windows-1251')
+
+        with mock.patch.object(CSVImporter, 'detect_encoding', side_effect=AssertionError('Encoding detected twice')):
+            ImporterFactory(obj).get_importer().scan(1)
+
+    def test_csv_encoding_bom_and_utf8(self):
+        obj = self.create_import('bom.csv', codecs.BOM_UTF8 + 'N,ФИО\n1,Иванов\n'.encode('utf-8'))
+        self.assertEqual(CSVImporter(obj).detect_encoding(), 'utf-8-sig')
+        obj = self.create_import('utf16.csv', 'N,ФИО\n1,Иванов\n'.encode('utf-16'))
+        self.assertEqual(CSVImporter(obj).detect_encoding(), 'utf-16')
+        obj = self.create_import('utf8.csv', 'N,ФИО\n1,Иванов\n'.encode('utf-8'))
+        self.assertEqual(CSVImporter(obj).detect_encoding(), 'utf-8')
+
+    def test_parsed_rows_cached(self):
+        obj = self.create_import('import.csv', 'N,ФИО\n1,Иванов\n2,Петров\n'.encode('utf-8'))
+        expected = ImporterFactory(obj).get_importer().scan()
+
+        with mock.patch.object(CSVImporter, 'iter_rows', side_effect=AssertionError('File parsed twice')):
+            self.assertEqual(ImporterFactory(obj).get_importer().scan(), expected)
+            self.assertEqual(list(ImporterFactory(obj).get_importer().iter_data()), expected[1])
+
+    def test_parse_settings_change_invalidates_cache(self):
+        obj = self.create_import('import.csv', 'N,ФИО\n1,Иванов\n2,Петров\n'.encode('utf-8'))
+        ImporterFactory(obj).get_importer().scan()
+
+        obj.header = 0
+        data_header, data, _, data_len = ImporterFactory(obj).get_importer().scan()
+        self.assertEqual(data_header, [])
+        self.assertEqual(data_len, 3)
+        # The cache of the old settings is removed
+        self.assertEqual(len([name for name in os.listdir(settings.IMPORT_CACHE_DIR)
+                              if name.startswith('%s-' % obj.pk)]), 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_CACHE_DIR=tempfile.mkdtemp())
+class ImportJobTestCase(TestCase):
+    def create_import(self, content):
+        return Import.objects.create(file=SimpleUploadedFile('import.csv', content.encode('utf-8')))
+
+    def test_import_job(self):
+        obj = self.create_import('N,ФИО,Категория\n1,Иванов,2\n2,Петров,9\n')
+        enqueue_import(obj, {'fio': 0, 'state': 1})
+        self.assertEqual(run_pending_jobs(), 1)
+
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, Import.DONE)
+        self.assertTrue(obj.data_added)
+        self.assertEqual((obj.rows_processed, obj.rows_total), (2, 2))
+        persons = Person.objects.filter(active_import=obj).order_by('id')
+        self.assertEqual([(p.fio, p.state) for p in persons], [('Иванов', 2), ('Петров', None)])
+
+    def test_import_pipeline_chunks(self):
+        obj = self.create_import('N,ФИО,Категория\n' + ''.join('%s,иванов %s,1\n' % (i, i) for i in range(7)))
+        progress = []
+        PersonImportPipeline(obj, {'fio': 0, 'state': 1}, chunk_size=3).run(progress.append)
+
+        self.assertEqual(progress, [3, 6, 7])
+        persons = Person.objects.filter(active_import=obj).order_by('id')
+        self.assertEqual([p.fio for p in persons], ['Иванов %s' % i for i in range(7)])
+        self.assertEqual([p.screen_name for p in persons], ['Иванов %s' % i for i in range(7)])
+        self.assertEqual(set(p.state for p in persons), {Person.MIA})
+
+    @skipUnless(connection.vendor == 'postgresql', 'COPY is PostgreSQL only')
+    def test_copy_import_pipeline(self):
+        obj = self.create_import('N,ФИО,Примечания\n1,"иванов\tиван","a\\b\nc"\n2,петров,\n')
+        CopyPersonImportPipeline(obj, {'fio': 0, 'notes': 1}).run()
+
+        persons = Person.objects.filter(active_import=obj).order_by('id')
+        self.assertEqual([(p.fio, p.notes, p.year) for p in persons],
+                         [('Иванов\tИван', 'a\\b\nc', None), ('Петров', '', None)])
+
+    def test_failed_import_job(self):
+        obj = self.create_import('N,ФИО\n1,Иванов\n2,Петров\n')
+        enqueue_import(obj, {'fio': 0})
+
+        class FailingPipeline(PersonImportPipeline):
+            def insert_chunk(self, persons):
+                if Person.objects.filter(active_import=obj).exists():
+                    raise ValueError('Insert failed')
+                # Without bumping the version, which is up to the removal of the committed chunks
+                models.QuerySet(Person).bulk_create(persons)
+
+        version = DataVersion.get(DataVersion.PERSONS)
+        with mock.patch('website.jobs.get_import_pipeline', lambda o, m: FailingPipeline(o, m, chunk_size=1)), \
+                run_commit_callbacks():
+            run_pending_jobs()
+
+        self.assertGreater(DataVersion.get(DataVersion.PERSONS), version)
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, Import.FAILED)
+        self.assertFalse(obj.data_added)
+        self.assertTrue(obj.error)
+        self.assertFalse(Person.objects.filter(active_import=obj).exists())
+
+    def test_interrupted_import_job(self):
+        obj = self.create_import('N,ФИО\n1,Иванов\n2,Петров\n')
+        enqueue_import(obj, {'fio': 0})
+        # Left by a stopped worker after the first row
+        started_at = timezone.now() - datetime.timedelta(seconds=settings.JOB_TIMEOUT + 1)
+        Import.objects.filter(pk=obj.pk).update(status=Import.RUNNING, started_at=started_at,
+                                                heartbeat_at=timezone.now())
+        Person.objects.create(fio='Иванов', active_import=obj)
+        self.assertEqual(run_pending_jobs(), 0)
+
+        Import.objects.filter(pk=obj.pk).update(heartbeat_at=started_at)
+        self.assertEqual(run_pending_jobs(), 1)
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, Import.DONE)
+        persons = Person.objects.filter(active_import=obj).order_by('id')
+        self.assertEqual([p.fio for p in persons], ['Иванов', 'Петров'])
+
+    def test_apply_or_undo_in_progress(self):
+        obj = self.create_import('N,ФИО\n1,Иванов\n')
+        enqueue_import(obj, {'fio': 0})
+        person = Person.objects.create(fio='Петров', active_import=obj)
+        self.client.force_login(get_user_model().objects.create_user('user'))
+        for action in ('undo', 'apply'):
+            response = self.client.post(reverse('import_apply_or_undo', args=[obj.pk]), {'action': action})
+            self.assertRedirects(response, obj.get_absolute_url(), fetch_redirect_response=False)
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, Import.QUEUED)
+        self.assertEqual(Person.objects.get(active_import=obj), person)
+
+    def test_claimed_import_job(self):
+        obj = self.create_import('N,ФИО\n1,Иванов\n2,Петров\n')
+        enqueue_import(obj, {'fio': 0})
+        stalled = claim_import()
+        Import.objects.filter(pk=obj.pk).update(
+            heartbeat_at=timezone.now() - datetime.timedelta(seconds=settings.JOB_TIMEOUT + 1))
+        claimed = claim_import()
+        self.assertEqual(claimed.pk, obj.pk)
+
+        # The stalled worker stops without touching persons of the other one
+        self.assertFalse(run_import(stalled))
+        self.assertTrue(run_import(claimed))
+        self.assertFalse(run_import(stalled))
+        obj.refresh_from_db()
+        self.assertEqual(obj.status, Import.DONE)
+        persons = Person.objects.filter(active_import=obj).order_by('id')
+        self.assertEqual([p.fio for p in persons], ['Иванов', 'Петров'])
+
+    def test_import_pipeline_rollback(self):
+        obj = self.create_import('N,ФИО\n1,Иванов\n2,Петров\n')
+
+        def progress(rows_processed):
+            if rows_processed > 1:
+                raise ValueError('Progress failed')
+
+        with self.assertRaises(ValueError):
+            PersonImportPipeline(obj, {'fio': 0}, chunk_size=1).run(progress)
+        self.assertEqual([p.fio for p in Person.objects.filter(active_import=obj)], ['Иванов'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_CACHE_DIR=tempfile.mkdtemp())
+class HospitalLinkTestCase(TestCase):
+    def setUp(self):
+        self.hospital = Hospital.objects.create(name='Эвакогоспиталь № 1234')
+
+    def test_hospital_key(self):
+        for value in ('ЭГ 1234', 'эг-1234', 'ЭГ №1234 г. Калинин', 'эвакогоспиталь 1234', 'госпиталь 1234', '1234'):
+            self.assertEqual(hospital_key(value), 'ЭГ 1234', value)
+        self.assertEqual(hospital_key('Сортировочный эвакогоспиталь № 290'), 'СЭГ 290')
+        self.assertEqual(hospital_key('хирургический полевой подвижной госпиталь 123'), 'ХППГ 123')
+        self.assertEqual(hospital_key('ППГ-123'), 'ППГ 123')
+        self.assertNotEqual(hospital_key('ППГ 1234'), hospital_key('ЭГ 1234'))
+        self.assertEqual(hospital_key(None), '')
+
+    def test_person_linked(self):
+        person = Person.objects.create(fio='Иванов', hospital='ЭГ-1234')
+        self.assertEqual(person.hospital_linked_id, self.hospital.id)
+        Person.objects.filter(id=person.id).update(hospital='ППГ 1234')
+        person.refresh_from_db()
+        self.assertIsNone(person.hospital_linked_id)
+
+    def test_hospital_changes(self):
+        person = Person.objects.create(fio='Иванов', hospital='СЭГ 290')
+        self.assertIsNone(person.hospital_linked_id)
+        other = Hospital.objects.create(name='Сортировочный эвакогоспиталь 290')
+        person.refresh_from_db()
+        self.assertEqual(person.hospital_linked_id, other.id)
+
+        # Persons of ambiguous names are not linked
+        duplicate = Hospital.objects.create(name='СЭГ № 290')
+        person.refresh_from_db()
+        self.assertIsNone(person.hospital_linked_id)
+        duplicate.delete()
+        person.refresh_from_db()
+        self.assertEqual(person.hospital_linked_id, other.id)
+
+    def test_import_linked(self):
+        content = 'N,ФИО,Госпиталь\n1,Иванов,ЭГ 1234\n'
+        obj = Import.objects.create(file=SimpleUploadedFile('import.csv', content.encode('utf-8')))
+        enqueue_import(obj, {'fio': 0, 'hospital': 1})
+        run_pending_jobs()
+        self.assertEqual(Person.objects.get(active_import=obj).hospital_linked_id, self.hospital.id)
+
+    def test_link_hospitals(self):
+        Person.objects.create(fio='Иванов', hospital='эвакогоспиталь №1234')
+        Person.objects.filter(hospital_key='ЭГ 1234').update(hospital_linked=None)
+        self.assertEqual(link_hospitals(Person.objects.all()), 1)
+        self.assertEqual(link_hospitals(Person.objects.all()), 0)
+
+    def test_link_hospitals_command(self):
+        person = Person.objects.create(fio='Иванов', hospital='эвакогоспиталь №1234')
+        Hospital.objects.update(key='')
+        Person.objects.update(hospital_linked=None)
+        call_command('link_hospitals', stdout=io.StringIO())
+        self.assertEqual(Hospital.objects.get().key, 'ЭГ 1234')
+        person.refresh_from_db()
+        self.assertEqual(person.hospital_linked_id, self.hospital.id)
+
+    def test_hospital_detail(self):
+        Person.objects.create(fio='Иванов', hospital='ЭГ 1234')
+        Person.objects.create(fio='Петров', hospital_actual=self.hospital)
+        Person.objects.create(fio='Сидоров', hospital='ЭГ 4321')
+        Person.objects.create(fio='Кузнецов', hospital='ЭГ 1234', active_import=Import.objects.create(
+            file=SimpleUploadedFile('import.csv', b'')))
+        self.client.force_login(get_user_model().objects.create_user('user'))
+        response = self.client.get(reverse('hospital_detail', args=[self.hospital.id]))
+        self.assertEqual(response.context['total_count'], 2)
+        self.assertEqual([p.fio for p in response.context['person_list']], ['Иванов', 'Петров'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_CACHE_DIR=tempfile.mkdtemp())
+class DuplicateDetectionTestCase(TestCase):
+    def setUp(self):
+        self.existing = Person.objects.create(fio='Иванов Иван Петрович', year='1910 г.', born_region='Калининская обл.')
+        Person.objects.create(fio='Иванов Иван Петрович', year='1915')
+        Person.objects.create(fio='Петров Петр', year='1910')
+
+    def test_import_duplicates(self):
+        obj = Import.objects.create(file=SimpleUploadedFile('import.csv', (
+            'N,ФИО,Год,Регион\n'
+            '1,Ivanov Ivan Petrovich,1910,Калининская область\n'
+            '2,Иванов Иван Петрович,1910,Калининская обл.\n'
+            '3,Сидоров Петр,1910,\n'
+        ).encode('utf-8')))
+        enqueue_import(obj, {'fio': 0, 'year': 1, 'born_region': 2})
+        run_pending_jobs()
+
+        first, second, _ = Person.objects.filter(active_import=obj).order_by('id')
+        pairs = set(obj.duplicate_candidates.values_list('person', 'duplicate'))
+        self.assertEqual(pairs, {(first.id, self.existing.id), (second.id, self.existing.id), (second.id, first.id)})
+        self.assertTrue(all(c.score > 0.8 for c in obj.duplicate_candidates.all()))
+
+        self.client.force_login(get_user_model().objects.create_user('user'))
+        response = self.client.get(reverse('import_view', args=[obj.pk]))
+        self.assertContains(response, 'Возможные дубликаты')
+
+        response = self.client.post(reverse('import_apply_or_undo', args=[obj.pk]), {'action': 'undo'})
+        self.assertFalse(DuplicateCandidate.objects.exists())
+
+    def test_score(self):
+        person = Person(fio='Иванов Иван', year='1910', born_region='Калининская обл.', death_date='12.01.1942')
+        other = Person(fio='Иванова Ивана', year='1910', born_region='Тверская обл.', death_date='15.03.1943')
+        for p in (person, other):
+            p.update_derived_fields()
+        self.assertEqual(score(Record(person), Record(person)), 1)
+        self.assertLess(score(Record(person), Record(other)), 0.8)
+
+
+class DateParserTestCase(TestCase):
+    def test_parse_date(self):
+        day = datetime.date(1942, 1, 12)
+        for value in ('12.01.1942', '12.01.1942 13:30', '12/1/42', '1942-01-12', '12 января 1942 г.',
+                      'погиб 12 янв. 1942', datetime.datetime(1942, 1, 12)):
+            self.assertEqual(parse_date(value), (day, day), value)
+        march = (datetime.date(1942, 3, 1), datetime.date(1942, 3, 31))
+        for value in ('03.1942', 'март 1942', 'в марте 1942 г.'):
+            self.assertEqual(parse_date(value), march, value)
+        self.assertEqual(parse_date('1942 г.'), (datetime.date(1942, 1, 1), datetime.date(1942, 12, 31)))
+        self.assertIsNone(parse_date('неизвестно'))
+        self.assertEqual(parse_year('около 1910 г.р.'), 1910)
+        self.assertIsNone(parse_year(''))
+
+    def test_date_fields(self):
+        person = Person.objects.create(year='1910 г.р.', death_date='05.1942',
+                                       receipt_date_actual=timezone.make_aware(datetime.datetime(1942, 4, 1)),
+                                       receipt_date='1941')
+        self.assertEqual(person.birth_year, 1910)
+        self.assertEqual((person.death_date_from, person.death_date_to),
+                         (datetime.date(1942, 5, 1), datetime.date(1942, 5, 31)))
+        self.assertEqual(person.receipt_date_from, datetime.date(1942, 4, 1))
+
+        Person.objects.filter(id=person.id).update(death_date='', year_actual=1911)
+        person.refresh_from_db()
+        self.assertIsNone(person.death_date_from)
+        self.assertEqual(person.birth_year, 1911)
+
+    def test_range_search(self):
+        Person.objects.create(fio='А', year='1910', death_date='12.01.1942')
+        Person.objects.create(fio='Б', year='1920', death_date='март 1943')
+        Person.objects.create(fio='В', death_date='1944 г.')
+        Person.objects.create(fio='Г', death_date='неизвестно')
+        Person.objects.create(fio='Д', death_date='конец 1941 - нач. 1942')
+        persons = Person.objects.order_by('fio')
+
+        def names(fields):
+            return [p.fio for p in search_persons(persons, fields)]
+
+        self.assertEqual(names({'death_date_from': '1942', 'death_date_to': '1943'}), ['А', 'Б'])
+        self.assertEqual(names({'death_date_from': '02.1943'}), ['Б', 'В'])
+        self.assertEqual(names({'death_date': '1942'}), ['А', 'Д'])
+        self.assertEqual(names({'death_date': '1942-01-12'}), ['А'])
+        self.assertEqual(names({'death_date': 'неизв'}), ['Г'])
+        self.assertEqual(names({'born_year_to': '1915'}), ['А'])
+        self.assertEqual(names({'born_year': '1920'}), ['Б'])
+
+    def test_invalid_range(self):
+        form = PersonSearchForm({'advanced_search': 0, 'death_date_from': 'когда-то'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('death_date_from', form.errors)
+
+
+class PlaceTestCase(TestCase):
+    def setUp(self):
+        reset_place_matcher()
+        self.tver = Place.objects.get(name='Тверская область')
+
+    def test_bundled_aliases_unique(self):
+        keys = {}
+        for place in read_places():
+            for name in [place['name']] + place['aliases']:
+                self.assertEqual(keys.setdefault(place_key(name), place['name']), place['name'], name)
+
+    def test_match_place(self):
+        for value in ('Калининская обл.', 'Ржевский р-н Калининской обл.', 'д. Ивановка, Тверской губернии',
+                      'ТВЕРСКАЯ ОБЛАСТЬ'):
+            self.assertEqual(match_place(value), self.tver.id, value)
+        self.assertEqual(match_place('', None, 'Калининской области'), self.tver.id)
+        self.assertIsNone(match_place('неизвестно'))
+
+    def test_street_is_not_region(self):
+        moscow_region = Place.objects.get(name='Московская область')
+        self.assertIsNone(match_place('ул. Московская, д.5, г. Калинин', address=True))
+        self.assertEqual(match_place('ул. Московская, д.5, Калининская обл.', address=True), self.tver.id)
+        self.assertEqual(match_place('Московская', address=True), moscow_region.id)
+        self.assertEqual(match_place('Московская, Клинский р-н'), moscow_region.id)
+
+        person = Person.objects.create(fio='Иванов', address='ул. Московская, д.5, г. Калинин',
+                                       born_address='Тверская ул., д. 1')
+        self.assertIsNone(person.address_region_id)
+        self.assertIsNone(person.birth_region_id)
+
+    def test_longest_alias(self):
+        matcher = PlaceMatcher([(place_key('Северная Осетия'), 1), (place_key('Осетия'), 2)])
+        self.assertEqual(matcher.match('г. Орджоникидзе, Северная Осетия'), 1)
+        self.assertEqual(matcher.match('Южная Осетия'), 2)
+
+    def test_region_fields(self):
+        person = Person.objects.create(fio='Иванов', born_address='Ржевский р-н Калининской обл.',
+                                       conscription_place='Ржевский РВК')
+        self.assertEqual(person.birth_region_id, self.tver.id)
+        self.assertIsNone(person.conscription_region_id)
+        Person.objects.filter(id=person.id).update(conscription_place_actual='Калининский ОВК, Калининская обл.')
+        person.refresh_from_db()
+        self.assertEqual(person.conscription_region_id, self.tver.id)
+
+    def test_region_search(self):
+        Person.objects.create(fio='А', born_region='Калининская обл.')
+        Person.objects.create(fio='Б', address='г. Тверь, Тверская губ.')
+        Person.objects.create(fio='В', born_region='Смоленская обл.')
+        persons = search_persons(Person.objects.order_by('fio'), {'region': str(self.tver.id)})
+        self.assertEqual([p.fio for p in persons], ['А', 'Б'])
+
+    def test_regions_view(self):
+        Person.objects.create(fio='А', born_region='Калининская обл.', conscription_place='Калининская обл.')
+        Person.objects.create(fio='Б', born_region='Тверская губерния')
+        self.client.force_login(get_user_model().objects.create_user('user'))
+        response = self.client.get(reverse('regions'))
+        place = [p for p in response.context['place_list'] if p.id == self.tver.id][0]
+        self.assertEqual((place.born_count, place.conscripted_count), (2, 1))
+
+        response = self.client.get(reverse('region_persons', args=[self.tver.id]))
+        response = self.client.get(response.url)
+        self.assertEqual(response.context['total_count'].value, 2)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMPORT_CACHE_DIR=tempfile.mkdtemp())
+class SyntheticDataTestCase(TestCase):
+    def test_reproducible(self):
+        values = [SyntheticData(seed=1).values() for _ in range(2)]
+        self.assertEqual(values[0], values[1])
+        self.assertNotEqual(SyntheticData(seed=2).values(), values[0])
+
+    def test_create_corpus(self):
+        cemeteries, hospitals = create_corpus(50, cemeteries=2, hospitals=5, seed=1)
+        self.assertEqual(Person.objects.count(), 50)
+        self.assertEqual(CemeteryStats.objects.aggregate(total=models.Sum('count'))['total'], 50)
+        self.assertTrue(Person.objects.exclude(hospital_linked=None).exists())
+
+    def test_import_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'import.csv')
+        write_import_file(path, 20, seed=1)
+        with open(path, 'rb') as f:
+            obj = Import.objects.create(file=SimpleUploadedFile('import.csv', f.read()))
+        enqueue_import(obj, get_import_mapping())
+        run_pending_jobs()
+        self.assertEqual(Person.objects.filter(active_import=obj).count(), 20)
+
+
+class PersonSearchTestCase(TestCase):
+    def setUp(self):
+        Person.objects.create(fio='Ёлкин Иван', born_region='Калининская обл.')
+        Person.objects.create(fio='Петров Петр', notes='100% известен')
+
+    def test_search_lookup(self):
+        self.assertEqual([p.fio for p in Person.objects.filter(fio__ucontains='елкин')], ['Ёлкин Иван'])
+        self.assertEqual(Person.objects.filter(born_region__ucontains='калинин').count(), 1)
+        self.assertEqual(Person.objects.filter(notes__ucontains='100%').count(), 1)
+        self.assertEqual(Person.objects.filter(notes__ucontains='1_0').count(), 0)
+
+    def test_quick_search(self):
+        Person.objects.create(fio='Сидоров Андрей', notes='Упоминается Ёлкин')
+        persons = Person.objects.order_by('screen_name', 'id')
+        self.assertEqual([p.fio for p in quick_search(persons, 'елкин')], ['Ёлкин Иван', 'Сидоров Андрей'])
+        self.assertEqual([p.fio for p in quick_search(persons, 'андрей')], ['Сидоров Андрей'])
+
+        Person.objects.filter(fio='Петров Петр').update(fio_actual='Елкин Петр')
+        self.assertEqual(quick_search(persons, 'Ёлкин').count(), 3)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Full-text search is PostgreSQL only')
+    def test_quick_search_short_i(self):
+        Person.objects.create(fio='Зайцев Сергей')
+        Person.objects.create(fio='Андрейченко Николай', address='ул. Майская')
+        persons = Person.objects.order_by('screen_name', 'id')
+        self.assertEqual([p.fio for p in quick_search(persons, 'Зайцев')], ['Зайцев Сергей'])
+        self.assertEqual([p.fio for p in quick_search(persons, 'андрейченко майская')], ['Андрейченко Николай'])
+        # The query is unaccented by the same function as search_vector
+        self.assertIn('immutable_unaccent(', str(quick_search(persons, 'Зайцев').query))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Trigram indexes are PostgreSQL only')
+    def test_search_uses_trigram_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if not cursor.fetchone():
+                self.skipTest('pg_trgm is not installed')
+            cursor.execute('SET enable_seqscan = off')
+        plan = Person.objects.filter(fio__ucontains='елкин').explain()
+        self.assertIn('website_person_fio_trgm', plan)
+
+
+class SearchResultCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        user = get_user_model().objects.create_user('user')
+        self.client.force_login(user)
+        for i in range(5):
+            Person.objects.create(fio='Иванов %s' % i)
+        Person.objects.create(fio='Петров')
+        response = self.client.post(reverse('persons'), {'fio': 'Иванов', 'advanced_search': 0})
+        self.url = reverse('persons')
+        self.q = response['Location'].split('?q=')[1]
+
+    def test_pages_fetched_by_id(self):
+        with mock.patch.object(KeysetPaginationMixin, 'cursor_paginate_by', 2):
+            response = self.client.get(self.url, {'q': self.q})
+            self.assertEqual(str(response.context['total_count']), '5')
+            persons = list(response.context['person_list'])
+            cursor = response.context['next_cursor']
+            with CaptureQueriesContext(connection) as queries:
+                while cursor:
+                    response = self.client.get(self.url, {'q': self.q, 'cursor': cursor})
+                    persons += response.context['person_list']
+                    cursor = response.context['next_cursor']
+            self.assertFalse([q for q in queries.captured_queries if 'LIKE' in q['sql']])
+        self.assertEqual([p.fio for p in persons], ['Иванов %s' % i for i in range(5)])
+
+    def test_invalidated_by_person_changes(self):
+        self.client.get(self.url, {'q': self.q})
+        with run_commit_callbacks():
+            Person.objects.create(fio='Иванов 5')
+        response = self.client.get(self.url, {'q': self.q})
+        self.assertEqual(str(response.context['total_count']), '6')
+
+    @override_settings(SEARCH_RESULT_CACHE_LIMIT=3)
+    def test_large_result_not_cached(self):
+        with mock.patch.object(KeysetPaginationMixin, 'cursor_paginate_by', 2):
+            response = self.client.get(self.url, {'q': self.q})
+            self.assertEqual(len(response.context['person_list']), 2)
+            response = self.client.get(self.url, {'q': self.q, 'cursor': response.context['next_cursor']})
+            self.assertEqual([p.fio for p in response.context['person_list']], ['Иванов 2', 'Иванов 3'])
+
+
+class SearchDataTestCase(TestCase):
+    def setUp(self):
+        forget_searches()
+
+    def test_save_search(self):
+        id = save_search({'fio': 'Иванов'})
+        self.assertEqual(save_search({'fio': 'Иванов'}), id)
+        self.assertNotEqual(save_search({'fio': 'Петров'}), id)
+        self.assertEqual(SearchData.objects.get(id=id).hits, 2)
+
+    def test_save_evicted_search(self):
+        id = save_search({'fio': 'Иванов'})
+        SearchData.objects.filter(id=id).delete()
+        new_id = save_search({'fio': 'Иванов'})
+        self.assertNotEqual(new_id, id)
+        self.assertTrue(SearchData.objects.filter(id=new_id).exists())
+
+    def test_save_search_created_concurrently(self):
+        fields = {'fio': 'Иванов'}
+        other = SearchData.objects.create(hash=hashlib.sha1(json.dumps(fields).encode('utf-8')).digest(),
+                                          fields=json.dumps(fields))
+        self.assertEqual(save_search(fields), other.id)
+        self.assertEqual(SearchData.objects.count(), 1)
+
+    def test_evict_searches(self):
+        old = SearchData.objects.get(id=save_search({'fio': 'Иванов'}))
+        SearchData.objects.filter(id=old.id).update(last_used=timezone.now() - datetime.timedelta(days=100))
+        recent = [save_search({'fio': str(i)}) for i in range(3)]
+        call_command('evict_searches', days=90, max_rows=2, stdout=io.StringIO())
+        self.assertEqual(sorted(SearchData.objects.values_list('id', flat=True)), recent[1:])
+
+
+class PhoneticSearchTestCase(TestCase):
+    def test_phonetic_key(self):
+        self.assertEqual(phonetic_key('Иванова'), phonetic_key('Иванов'))
+        self.assertEqual(phonetic_key('Iwanow'), phonetic_key('Иванов'))
+        self.assertEqual(phonetic_key('Завадская'), phonetic_key('Zavadsky'))
+        self.assertEqual(phonetic_key('Прокопьев'), phonetic_key('Прокопиев'))
+        self.assertEqual(phonetic_key('Зайцев'), phonetic_key('Заитсев'))
+        self.assertNotEqual(phonetic_key('Иванов'), phonetic_key('Петров'))
+        self.assertEqual(phonetic_key(None), '')
+
+    def test_keys_maintained(self):
+        person = Person.objects.create(fio='Иванова Мария', ontombstone='Ivanova M.')
+        self.assertEqual(person.fio_phonetic, phonetic_key('Иванов Мария'))
+        Person.objects.filter(id=person.id).update(fio_actual='Петрова')
+        Person.objects.filter(id=person.id).update(fio=F('fio_actual'))
+        person.refresh_from_db()
+        self.assertEqual(person.fio_actual_phonetic, phonetic_key('Петров'))
+        self.assertEqual(person.fio_phonetic, phonetic_key('Петров'))
+
+    def test_literal_update_does_not_load_ids(self):
+        hospital = Hospital.objects.create(name='ЭГ 1234')
+        person = Person.objects.create(fio='Иванова Мария', fio_actual='Ivanova', year='1920',
+                                       born_region='Тверская губ.')
+        values = {'fio': 'Петрова Анна', 'ontombstone': 'Петрова А.', 'hospital': 'Эвакогоспиталь № 1234',
+                  'born_region_actual': 'Калининская обл.', 'year': '1921'}
+        with CaptureQueriesContext(connection) as queries:
+            Person.objects.update(**values)
+        self.assertFalse([q['sql'] for q in queries.captured_queries
+                          if q['sql'].startswith('SELECT "website_person"."id" FROM')])
+        person.refresh_from_db()
+        expected = Person(fio_actual='Ivanova', born_region='Тверская губ.', **values)
+        expected.update_computed_fields()
+        for f in Person.get_computed_fields():
+            attname = Person._meta.get_field(f).attname
+            self.assertEqual(getattr(person, attname), getattr(expected, attname), f)
+        self.assertEqual(person.hospital_linked, hospital)
+
+        # Rows with a value of an earlier source keep it
+        Person.objects.update(year_actual=1919)
+        Person.objects.update(fio='Кузнецова Анна', year='1922')
+        person.refresh_from_db()
+        self.assertEqual(person.surname_key, phonetic_key('Ivanova'))
+        self.assertEqual(person.birth_year, 1919)
+
+        # Computed fields whose earlier sources are not stored are recomputed from the rows
+        Person.objects.update(born_region='')
+        person.refresh_from_db()
+        self.assertEqual(person.birth_region.name, 'Тверская область')
+
+    def test_sounds_like_search(self):
+        Person.objects.create(fio='Иванова Мария')
+        Person.objects.create(fio='Ivanov')
+        Person.objects.create(fio_actual='Иванов Петр', fio='Иваньков Петр')
+        Person.objects.create(fio='Ивановский')
+        persons = search_persons(Person.objects.order_by('id'), {'fio': 'Иванов', 'fio_sounds_like': True})
+        self.assertEqual([p.screen_name for p in persons], ['Иванова Мария', 'Ivanov', 'Иванов Петр'])
+
+
+class KeysetPaginationTestCase(TestCase):
+    def setUp(self):
+        self.cemetery = Cemetery.objects.create(name='Мемориал')
+        for i in range(7):
+            Person.objects.create(fio='Иванов %s' % (i % 3), cemetery=self.cemetery)
+
+    def test_pages(self):
+        queryset = Person.objects.order_by('screen_name', 'id')
+        expected = list(queryset)
+        persons, cursor, start_indexes = [], None, []
+        while True:
+            page = KeysetPage(queryset, cursor, 3)
+            persons += page.object_list
+            start_indexes.append(page.start_index)
+            cursor = page.next_cursor
+            if not page.has_next:
+                break
+        self.assertEqual(persons, expected)
+        self.assertEqual(start_indexes, [1, 4, 7])
+
+    def test_ranked_pages(self):
+        Person.objects.create(fio='Петров', notes='Сослуживец: Иванов')
+        queryset = quick_search(Person.objects.order_by('screen_name', 'id'), 'иванов')
+        persons, cursor = [], None
+        while True:
+            page = KeysetPage(queryset, cursor, 2)
+            persons += page.object_list
+            cursor = page.next_cursor
+            if not page.has_next:
+                break
+        self.assertEqual(len(persons), 8)
+        self.assertEqual(persons, list(queryset))
+
+    def test_invalid_cursor(self):
+        queryset = Person.objects.order_by('screen_name', 'id')
+        for cursor in ('abc', 'WzEsMl0', 'eyJhIjoxfQ'):
+            with self.assertRaises(InvalidCursor):
+                KeysetPage(queryset, cursor, 3)
+
+    def test_cemetery_detail_cursor(self):
+        user = get_user_model().objects.create_user('user', password='password')
+        self.client.force_login(user)
+        url = reverse('cemetery_detail', args=[self.cemetery.pk])
+        with mock.patch.object(KeysetPaginationMixin, 'cursor_paginate_by', 5):
+            response = self.client.get(url)
+            self.assertEqual(len(response.context['person_list']), 5)
+            cursor = response.context['next_cursor']
+
+            response = self.client.get(url, {'cursor': cursor}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = response.json()
+            self.assertIsNone(data['next_cursor'])
+            self.assertEqual(data['content'].count('clickable-row'), 2)
+
+            response = self.client.get(url, {'cursor': 'abc'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 404)
+
+            response = self.client.get(reverse('persons'))
+            self.assertEqual(response.context['start_item_number'], 1)
+            self.assertIsNotNone(response.context['next_cursor'])
+
+
+class QueryBudgetTestCase(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        self.cemetery = Cemetery.objects.create(name='Мемориал')
+        self.hospital = Hospital.objects.create(name='ЭГ 1234')
+        for i in range(60):
+            Person.objects.create(fio='Иванов %s' % i, cemetery=self.cemetery, hospital='ЭГ 1234',
+                                  hospital_actual=self.hospital, born_region='Калининская обл.')
+        self.person = Person.objects.first()
+        self.client.force_login(get_user_model().objects.create_user('user'))
+
+    def test_record_queries(self):
+        with record_queries() as stats:
+            for _ in range(2):
+                Person.objects.filter(id=self.person.id).exists()
+            Person.objects.filter(id=0).exists()
+        self.assertEqual(stats.count, 3)
+        self.assertEqual([count for _, count in stats.duplicates()], [2])
+        self.assertEqual([count for _, count in stats.repeated(3)], [3])
+
+        with record_queries(QueryCounter()) as counter:
+            Person.objects.filter(id=self.person.id).exists()
+        self.assertEqual(counter.count, 1)
+        self.assertGreater(counter.time, 0)
+
+    def test_view_budgets(self):
+        search_id = save_search({'advanced_search': 0, 'fio': 'Иванов'})
+        urls = [
+            reverse('cemeteries'),
+            reverse('cemetery_detail', args=[self.cemetery.id]),
+            reverse('cemetery_edit', args=[self.cemetery.id]),
+            reverse('cemetery_delete', args=[self.cemetery.id]),
+            reverse('hospitals'),
+            reverse('hospital_detail', args=[self.hospital.id]),
+            reverse('hospital_edit', args=[self.hospital.id]),
+            reverse('persons'),
+            '%s?q=%s' % (reverse('persons'), search_id),
+            reverse('person_detail', args=[self.person.id]),
+            reverse('person_edit', args=[self.person.id]),
+            reverse('person_delete', args=[self.person.id]),
+            reverse('person_create'),
+            reverse('regions'),
+            reverse('import_list'),
+        ]
+        for url in urls:
+            self.assertEqual(self.assertQueryBudget('get', url).status_code, 200, url)
+
+    def test_budget_exceeded(self):
+        with self.assertRaises(AssertionError):
+            self.assertQueryBudget('get', reverse('persons'), budget=1)
+
+    def test_middleware(self):
+        middleware = ['website.querystats.QueryStatsMiddleware'] + settings.MIDDLEWARE
+        with override_settings(MIDDLEWARE=middleware), self.assertLogs('website.querystats', 'INFO') as logs:
+            response = self.client.get(reverse('person_detail', args=[self.person.id]))
+        self.assertEqual(response['X-Query-Count'], '3')
+        self.assertIn('person_detail: 3 queries', logs.output[0])
+
+
+@override_settings(METRICS=True, METRICS_TOKEN='secret', METRICS_FLUSH_INTERVAL=0,
+                   MIDDLEWARE=['website.metrics.MetricsMiddleware'] + settings.MIDDLEWARE)
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.settings_override = override_settings(METRICS_DIR=tempfile.mkdtemp())
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        registry.pid = None
+        self.user = get_user_model().objects.create_user('user')
+        self.client.force_login(self.user)
+        self.person = Person.objects.create(fio='Иванов Иван Иванович')
+
+    def get_metrics(self, **extra):
+        return self.client.get(reverse('metrics'), **extra)
+
+    def test_requests(self):
+        self.client.get(reverse('person_detail', args=[self.person.id]))
+        self.client.get(reverse('person_detail', args=[self.person.id]))
+        self.client.get(reverse('persons'))
+
+        values, processes = collect()
+        self.assertEqual(processes, 1)
+        self.assertEqual(values[('burialdb_requests_total', ('person_detail', 'GET', '200'))], 2)
+        self.assertEqual(values[('burialdb_requests_total', ('persons', 'GET', '200'))], 1)
+        duration = values[('burialdb_request_duration_seconds', ('person_detail',))]
+        self.assertEqual(sum(duration[:-1]), 2)
+        queries = values[('burialdb_request_queries', ('person_detail',))]
+        self.assertEqual(queries[-1], 6)
+        self.assertEqual(sum(values[('burialdb_response_size_bytes', ('person_detail',))][:-1]), 2)
+        self.assertEqual(sum(values[('burialdb_template_render_seconds', ('persons',))][:-1]), 1)
+
+    def test_processes(self):
+        self.client.get(reverse('person_detail', args=[self.person.id]))
+        registry.flush(force=True)
+        # another worker process
+        with open(os.path.join(settings.METRICS_DIR, '1.json'), 'w') as f:
+            json.dump([['burialdb_requests_total', ['person_detail', 'GET', '200'], 3],
+                       ['burialdb_request_queries', ['person_detail'], [0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 5]]], f)
+
+        values, processes = collect()
+        self.assertEqual(processes, 2)
+        self.assertEqual(values[('burialdb_requests_total', ('person_detail', 'GET', '200'))], 4)
+        self.assertEqual(values[('burialdb_request_queries', ('person_detail',))], [0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 8])
+
+
+    @skipUnless(os.name == 'posix', 'Finished processes are only archived on POSIX')
+    def test_finished_processes(self):
+        self.client.get(reverse('person_detail', args=[self.person.id]))
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        finished_path = os.path.join(settings.METRICS_DIR, '%s.json' % process.pid)
+        with open(finished_path, 'w') as f:
+            json.dump([['burialdb_requests_total', ['person_detail', 'GET', '200'], 3]], f)
+
+        for _ in range(2):
+            values, processes = collect()
+            self.assertEqual(processes, 1)
+            self.assertEqual(values[('burialdb_requests_total', ('person_detail', 'GET', '200'))], 4)
+        self.assertFalse(os.path.exists(finished_path))
+
+    def test_unknown_method(self):
+        self.client.generic('FOO', reverse('person_detail', args=[self.person.id]))
+        values, _ = collect()
+        self.assertEqual([labels for name, labels in values if name == 'burialdb_requests_total'],
+                         [('person_detail', 'other', '405')])
+
+    def test_render(self):
+        values = {
+            ('burialdb_requests_total', ('persons', 'GET', '200')): 3,
+            ('burialdb_request_queries', ('pers"ons',)): [1, 0, 1, 0, 0, 0, 0, 0, 0, 1, 304],
+        }
+        text = render_metrics(values, 2)
+        self.assertIn('burialdb_metrics_processes 2\n', text)
+        self.assertIn('# TYPE burialdb_request_queries histogram\n', text)
+        self.assertIn('burialdb_requests_total{view="persons",method="GET",status="200"} 3\n', text)
+        self.assertIn('burialdb_request_queries_bucket{view="pers\\"ons",le="2"} 1\n', text)
+        self.assertIn('burialdb_request_queries_bucket{view="pers\\"ons",le="5"} 2\n', text)
+        self.assertIn('burialdb_request_queries_bucket{view="pers\\"ons",le="+Inf"} 3\n', text)
+        self.assertIn('burialdb_request_queries_sum{view="pers\\"ons"} 304\n', text)
+        self.assertIn('burialdb_request_queries_count{view="pers\\"ons"} 3\n', text)
+
+    def test_endpoint(self):
+        self.client.get(reverse('person_detail', args=[self.person.id]))
+        self.assertEqual(self.get_metrics().status_code, 403)
+        self.assertEqual(self.get_metrics(HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        response = self.get_metrics(HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('burialdb_requests_total{view="person_detail",method="GET",status="200"} 1',
+                      response.content.decode())
+
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.get_metrics().status_code, 200)
+        with override_settings(METRICS=False):
+            self.assertEqual(self.get_metrics().status_code, 404)
+
+
+class CountTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        Person.objects.create(fio='Иванов')
+
+    def test_cached_count(self):
+        queryset = Person.objects.filter(active_import=None)
+        self.assertEqual(str(get_count(queryset, 'test')), '1')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_count(queryset, 'test').value, 1)
+
+        with run_commit_callbacks():
+            Person.objects.create(fio='Петров')
+        self.assertEqual(get_count(queryset, 'test').value, 2)
+        with run_commit_callbacks():
+            Person.objects.filter(fio='Петров').update(active_import=Import.objects.create(file='test.csv'))
+        self.assertEqual(get_count(queryset, 'test').value, 1)
+        with run_commit_callbacks():
+            Person.objects.all().delete()
+        self.assertEqual(get_count(queryset, 'test').value, 0)
+
+    def test_version_bumped_on_commit(self):
+        commit_callbacks()
+        version = DataVersion.get(DataVersion.PERSONS)
+        with run_commit_callbacks():
+            Person.objects.create(fio='Петров')
+            Person.objects.create(fio='Сидоров')
+            self.assertEqual(DataVersion.get(DataVersion.PERSONS), version)
+        self.assertEqual(DataVersion.get(DataVersion.PERSONS), version + 1)
+
+        with run_commit_callbacks():
+            try:
+                with transaction.atomic():
+                    Person.objects.create(fio='Кузнецов')
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            # The bump of the rolled back savepoint is gone, a later change bumps again
+            Person.objects.filter(fio='Петров').update(fio='Петров Петр')
+        self.assertEqual(DataVersion.get(DataVersion.PERSONS), version + 2)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Planner estimates are PostgreSQL only')
+    def test_estimated_count(self):
+        with override_settings(COUNT_ESTIMATE_THRESHOLD=0):
+            count = get_count(Person.objects.filter(fio__ucontains='Иван'), 'test')
+        self.assertTrue(count.estimated)
+        self.assertTrue(str(count).startswith('~'))
+
+
+class StatsTestCase(TestCase):
+    def setUp(self):
+        self.first = Cemetery.objects.create(name='Первый')
+        self.second = Cemetery.objects.create(name='Второй')
+        self.hospital = Hospital.objects.create(name='Госпиталь')
+
+    def get_counts(self, model=CemeteryStats):
+        return sorted(model.objects.values_list(
+            'cemetery_id' if model is CemeteryStats else 'hospital_id', 'state', 'status', 'count'),
+            key=lambda row: (row[0], -1 if row[1] is None else row[1], row[2]))
+
+    def assertStats(self, expected, model=CemeteryStats):
+        self.assertEqual(self.get_counts(model), expected)
+        refresh_all_stats()
+        self.assertEqual(self.get_counts(model), expected)
+
+    def test_person_save_and_delete(self):
+        person = Person.objects.create(fio='Иванов', cemetery=self.first, cemetery_actual=self.first)
+        Person.objects.create(fio='Петров', cemetery=self.first, cemetery_actual=self.second,
+                              state=Person.KILLED, hospital_actual=self.hospital)
+        self.assertStats([(self.first.pk, None, Person.PARTIAL, 1), (self.first.pk, Person.KILLED, Person.PARTIAL, 1),
+                          (self.second.pk, Person.KILLED, Person.PARTIAL, 1)])
+        self.assertStats([(self.hospital.pk, Person.KILLED, Person.PARTIAL, 1)], model=HospitalStats)
+
+        person = Person.objects.get(pk=person.pk)
+        person.state = Person.MIA
+        person.save()
+        self.assertStats([(self.first.pk, Person.MIA, Person.PARTIAL, 1), (self.first.pk, Person.KILLED, Person.PARTIAL, 1),
+                          (self.second.pk, Person.KILLED, Person.PARTIAL, 1)])
+
+        person.delete()
+        self.assertStats([(self.first.pk, Person.KILLED, Person.PARTIAL, 1), (self.second.pk, Person.KILLED, Person.PARTIAL, 1)])
+
+    def test_person_change_is_incremental(self):
+        person = Person.objects.create(fio='Иванов', cemetery=self.first, hospital_actual=self.hospital)
+        person = Person.objects.get(pk=person.pk)
+        person.cemetery_actual = self.second
+        with CaptureQueriesContext(connection) as queries:
+            person.save()
+            person.delete()
+        self.assertFalse([q['sql'] for q in queries.captured_queries if 'GROUP BY' in q['sql']])
+        self.assertStats([])
+        self.assertStats([], model=HospitalStats)
+
+        # Instances not loaded from the database read the old values
+        person = Person.objects.create(fio='Петров', cemetery=self.first)
+        Person(pk=person.pk, fio='Петров', cemetery=self.second).save()
+        self.assertStats([(self.second.pk, None, Person.INCOMPLETE, 1)])
+
+    def test_cemetery_and_hospital_delete(self):
+        person = Person.objects.create(fio='Иванов', cemetery=self.first, cemetery_actual=self.second,
+                                       hospital_actual=self.hospital)
+        self.second.delete()
+        self.hospital.delete()
+        person.refresh_from_db()
+        self.assertIsNone(person.cemetery_actual)
+        self.assertIsNone(person.hospital_actual)
+        self.assertEqual(person.status, person.get_status())
+        self.assertStats([(self.first.pk, None, person.status, 1)])
+
+    def test_queryset_changes(self):
+        import_object = Import.objects.create(file='test.csv')
+        Person.objects.bulk_create([Person(fio='Иванов', cemetery=self.first, active_import=import_object),
+                                    Person(fio='Петров', cemetery=self.first)])
+        self.assertStats([(self.first.pk, None, Person.INCOMPLETE, 1)])
+
+        Person.objects.filter(active_import=import_object).update(active_import=None)
+        self.assertStats([(self.first.pk, None, Person.INCOMPLETE, 2)])
+
+        Person.objects.filter(fio='Иванов').update(cemetery=self.second, fio_actual='Иванов')
+        self.assertStats([(self.first.pk, None, Person.INCOMPLETE, 1), (self.second.pk, None, Person.PARTIAL, 1)])
+
+        Person.objects.filter(fio='Петров').delete()
+        self.assertStats([(self.second.pk, None, Person.PARTIAL, 1)])
+
+    def test_cemeteries_list(self):
+        Person.objects.create(fio='Иванов', cemetery=self.first, cemetery_actual=self.second)
+        Person.objects.create(fio='Петров', cemetery=self.first, cemetery_actual=self.first)
+        self.client.force_login(get_user_model().objects.create_user('user', password='password'))
+        response = self.client.get(reverse('cemeteries'))
+        counts = {cemetery.name: cemetery.person_total_count for cemetery in response.context['cemetery_list']}
+        self.assertEqual(counts, {'Первый': 2, 'Второй': 1})
+
+    def test_hospitals_list(self):
+        other = Hospital.objects.create(name='ЭГ 1234')
+        Person.objects.create(fio='Иванов', hospital='ЭГ-1234')
+        Person.objects.create(fio='Петров', hospital='ЭГ 1234', hospital_actual=self.hospital)
+        Person.objects.create(fio='Сидоров', hospital='ЭГ 1234', hospital_actual=other)
+        Person.objects.filter(fio='Сидоров').update(hospital='ЭГ 4321')
+        self.assertStats([(self.hospital.pk, None, Person.PARTIAL, 1), (other.pk, None, Person.INCOMPLETE, 1),
+                          (other.pk, None, Person.PARTIAL, 2)], model=HospitalStats)
+
+        self.client.force_login(get_user_model().objects.create_user('user', password='password'))
+        response = self.client.get(reverse('hospitals'))
+        counts = {hospital.name: hospital.person_total_count for hospital in response.context['hospital_list']}
+        self.assertEqual(counts, {'Госпиталь': 1, 'ЭГ 1234': 3})
+        response = self.client.get(reverse('hospital_detail', args=[other.pk]))
+        self.assertEqual(response.context['total_count'], 3)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), EXPORT_DIR=tempfile.mkdtemp())
+class CemeteryExportTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('exporter')
+        self.client.force_login(self.user)
+        self.cemetery = Cemetery.objects.create(name='Мемориал')
+        Person.objects.create(fio='Иванов', state=Person.KILLED, cemetery=self.cemetery)
+        Person.objects.create(fio='Петров', notes='Строка, с "кавычками"', cemetery=self.cemetery)
+        Person.objects.create(fio='Сидоров')
+
+    def export(self, url, params):
+        response = self.client.get(url, params)
+        export = Export.objects.latest('id')
+        self.assertRedirects(response, export.get_absolute_url())
+        run_pending_jobs()
+        response = self.client.get(url, params)
+        self.assertRedirects(response, reverse('export_download', args=[export.pk]), fetch_redirect_response=False)
+        response = self.client.get(reverse('export_download', args=[export.pk]))
+        export.refresh_from_db()
+        return export, b''.join(response.streaming_content)
+
+    def test_xlsx_export(self):
+        export, content = self.export(reverse('cemetery_export', args=[self.cemetery.pk]), {'format': 'xlsx'})
+        self.assertEqual(export.rows, 2)
+        wb = load_workbook(io.BytesIO(content), read_only=True)
+        rows = list(wb.active.iter_rows(values_only=True))
+        self.assertEqual(len(rows), 3)
+        fio = Person._meta.get_field('fio').verbose_name
+        self.assertIn('Убит', rows[1])
+        self.assertEqual(rows[1][rows[0].index(fio)], 'Иванов')
+
+    def test_csv_export(self):
+        _, content = self.export(reverse('cemetery_export', args=[self.cemetery.pk]), {'format': 'csv'})
+        rows = list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+        self.assertEqual(len(rows), 3)
+        self.assertIn('Строка, с "кавычками"', rows[2])
+
+    def test_private_file(self):
+        export, _ = self.export(reverse('cemetery_export', args=[self.cemetery.pk]), {'format': 'csv'})
+        self.assertEqual(os.path.dirname(export.file.path), os.path.abspath(settings.EXPORT_DIR))
+        self.assertNotEqual(export.file.name, '%s.csv' % export.pk)
+
+        self.client.logout()
+        response = self.client.get(reverse('export_download', args=[export.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(settings.LOGIN_URL))
+
+    def test_export_reused_until_data_changes(self):
+        url = reverse('cemetery_export', args=[self.cemetery.pk])
+        export, _ = self.export(url, {'format': 'csv'})
+        path = export.file.path
+
+        response = self.client.get(url, {'format': 'csv'})
+        self.assertRedirects(response, reverse('export_download', args=[export.pk]), fetch_redirect_response=False)
+        self.assertEqual(Export.objects.count(), 1)
+
+        with run_commit_callbacks():
+            Person.objects.create(fio='Кузнецов', cemetery=self.cemetery)
+        new_export, content = self.export(url, {'format': 'csv'})
+        self.assertNotEqual(new_export.pk, export.pk)
+        self.assertEqual(new_export.rows, 3)
+        self.assertFalse(Export.objects.filter(pk=export.pk).exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_single_export_per_version(self):
+        export = enqueue_export(Export.CSV, cemetery=self.cemetery)
+        self.assertEqual(enqueue_export(Export.CSV, cemetery=self.cemetery), export)
+        self.assertNotEqual(enqueue_export(Export.XLSX, cemetery=self.cemetery), export)
+        all_persons = enqueue_export(Export.CSV)
+        self.assertEqual(enqueue_export(Export.CSV), all_persons)
+        for cemetery in (self.cemetery, None):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Export.objects.create(format=Export.CSV, cemetery=cemetery, data_version=export.data_version)
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse('cemetery_export', args=[self.cemetery.pk]), {'format': 'pdf'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_persons_search_export(self):
+        search = SearchData.objects.create(fields=json.dumps({'fio': 'Петров'}))
+        export, content = self.export(reverse('persons_export'), {'q': search.pk, 'format': 'csv'})
+        rows = list(csv.reader(io.StringIO(content.decode('utf-8-sig'))))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(export.search, search)
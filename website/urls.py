@@ -13,6 +13,10 @@ urlpatterns = [
     path('burials/<int:pk>/delete/', website_views.CemeteryDeleteView.as_view(), name='cemetery_delete'),
     path('burials/<int:pk>/export/', website_views.CemeteryExportView.as_view(), name='cemetery_export'),
     path('persons/', website_views.PersonsView.as_view(), name='persons'),
+    path('persons/export/', website_views.PersonsExportView.as_view(), name='persons_export'),
+    path('exports/<int:pk>/', website_views.ExportView.as_view(), name='export_view'),
+    path('exports/<int:pk>/progress/', website_views.ExportProgressView.as_view(), name='export_progress'),
+    path('exports/<int:pk>/download/', website_views.ExportDownloadView.as_view(), name='export_download'),
     path('persons/create/', website_views.PersonCreateView.as_view(), name='person_create'),
     path('persons/import/', website_views.ImportsListView.as_view(), name='import_list'),
     path('persons/import/create/', website_views.ImportCreateView.as_view(), name='person_import'),
@@ -21,12 +25,16 @@ urlpatterns = [
     path('persons/import/<int:pk>/delete/', website_views.ImportDeleteView.as_view(), name='import_delete'),
     path('persons/import/<int:pk>/do_cancel/', website_views.ImportDoView.as_view(), name='import_do_cancel'),
     path('persons/import/<int:pk>/apply_or_undo/', website_views.ImportApplyOrUndoView.as_view(), name='import_apply_or_undo'),
+    path('persons/import/<int:pk>/progress/', website_views.ImportProgressView.as_view(), name='import_progress'),
     path('persons/<int:pk>/edit/', website_views.PersonEditView.as_view(), name='person_edit'),
     path('persons/<int:pk>/delete/', website_views.PersonDeleteView.as_view(), name='person_delete'),
     path('persons/<int:pk>/', website_views.PersonDetailView.as_view(), name='person_detail'),
+    path('regions/', website_views.RegionsView.as_view(), name='regions'),
+    path('regions/<int:pk>/persons/', website_views.RegionPersonsView.as_view(), name='region_persons'),
     path('hospitals/', website_views.HospitalsView.as_view(), name='hospitals'),
     path('hospitals/create/', website_views.HospitalCreateView.as_view(), name='hospital_create'),
     path('hospitals/<int:pk>/', website_views.HospitalDetailView.as_view(), name='hospital_detail'),
     path('hospitals/<int:pk>/edit/', website_views.HospitalEditView.as_view(), name='hospital_edit'),
     path('hospitals/<int:pk>/delete/', website_views.HospitalDeleteView.as_view(), name='hospital_delete'),
+    path('metrics/', website_views.MetricsView.as_view(), name='metrics'),
 ]
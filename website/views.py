@@ -1,14 +1,17 @@
 from collections import OrderedDict
 import json
 import base64
-import hashlib
-import urllib
+import hmac
 
 from django.contrib.auth.decorators import login_required
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
 from django.core import paginator
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models import Q, Count, F
-from django.http import HttpResponseRedirect, JsonResponse, HttpResponse
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+from django.http import HttpResponseRedirect, JsonResponse, HttpResponse, Http404, FileResponse
 from django.shortcuts import get_object_or_404
 from django.template import loader
 from django.urls import reverse_lazy, reverse
@@ -20,17 +23,26 @@ from django.views.generic.detail import BaseDetailView
 from django.views.generic.edit import FormMixin, FormView
 from django.views.generic.list import MultipleObjectMixin
 
+from website.counts import ListCount, get_count
 from website.forms import PersonCreateEditForm, ImportCreateForm, ImportEditForm, ImportDoForm, HospitalCreateEditForm, \
     CemeteryCreateEditForm, PersonSearchForm
-from website.importer import ImporterFactory
-from website.models import Person, Cemetery, Hospital, Import, SearchData
+from website.importer import ImporterFactory, ParseCache, XLSX_MIMETYPE
+from website.jobs import enqueue_import, enqueue_export
+from website.metrics import METRICS_CONTENT_TYPE, collect, render_metrics
+from website.models import Person, Cemetery, Hospital, Import, SearchData, Export, DataVersion, Place
+from website.pagination import KeysetPage, IdListPage, InvalidCursor
+from website.search import search_persons, get_search_result_ids, save_search, get_range_search_fields
 
 PAGINATE_BY = 50
 
+DUPLICATES_SHOW_MAX = 100
+
 
 class CommonViewMixin(ContextMixin):
     page_title = 'Untitled'
     navbar = None
+    # Maximal number of SQL queries of a request including the session and user, see website.querystats
+    query_budget = None
 
     def get_page_title(self):
         return self.page_title
@@ -83,35 +95,77 @@ class BaseListView(CommonPaginatedViewMixin, ListView):
     pass
 
 
-class DetailWithListView(CommonPaginatedViewMixin, DetailView):
-    list_model = None
+class KeysetPaginationMixin:
+    """
+    Paginates person lists with cursors on (screen_name, id) instead of OFFSET. Infinite scroll requests
+    the next page with the cursor returned in the previous response.
+    """
+    cursor_paginate_by = PAGINATE_BY
+    rows_template_name = 'website/snippets/person_list_rows.html'
+    show_cemetery = False
 
     def get_list_queryset(self):
-        return self.list_model.objects.all()
+        raise NotImplementedError
+
+    def get_page(self):
+        return KeysetPage(self.get_list_queryset(), self.request.GET.get('cursor'), self.cursor_paginate_by)
+
+    def get_page_context(self):
+        try:
+            page = self.get_page()
+        except InvalidCursor:
+            raise Http404('Неверный курсор')
+        return {
+            'person_list': page.object_list,
+            'start_item_number': page.start_index,
+            'next_cursor': page.next_cursor,
+            'show_cemetery': self.show_cemetery,
+        }
+
+    def render_page_to_json(self):
+        context = self.get_page_context()
+        content = loader.render_to_string(self.rows_template_name, context, self.request)
+        return JsonResponse({"content": content, "next_cursor": context['next_cursor']})
+
+
+class KeysetListView(KeysetPaginationMixin, CommonViewMixin, ListView):
+    def get_list_queryset(self):
+        return self.get_queryset()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context.update(self.get_page_context())
+        return context
+
+    def get(self, request, *args, **kwargs):
+        if request.is_ajax():
+            return self.render_page_to_json()
+        return super().get(request, *args, **kwargs)
 
-        queryset = self.get_list_queryset()
-        objects_paginator, page, objects_list, has_other_pages = self.paginate_queryset(queryset, PAGINATE_BY)
 
-        newcontext = {}
-        newcontext['object'] = self.object
-        context_object_name = self.get_context_object_name(self.object)
-        if context_object_name:
-            newcontext[context_object_name] = self.object
-        newcontext['page_obj'] = page
-        newcontext['paginator'] = objects_paginator
-        newcontext['is_paginated'] = True if objects_paginator.num_pages > 1 else False
-        newcontext['list_obj'] = objects_list
+class DetailWithListView(KeysetPaginationMixin, CommonViewMixin, DetailView):
+    list_model = None
 
-        context.update(newcontext)
+    def get_list_queryset(self):
+        return self.list_model.objects.all()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(self.get_page_context())
         return context
 
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        if request.is_ajax():
+            return self.render_page_to_json()
+        context = self.get_context_data(object=self.object)
+        return self.render_to_response(context)
+
 
 class CommonCreateEditView(CommonViewMixin, CreateView):
     template_name = 'website/common_create_edit.html'
     form_class = None
+    query_budget = 3
 
 
 class CommonDeleteView(CommonViewMixin, DeleteView):
@@ -119,10 +173,11 @@ class CommonDeleteView(CommonViewMixin, DeleteView):
     success_url = None
     navbar = None
     template_name = 'website/common_confirm_delete.html'
+    query_budget = 3
     additional_text = None
 
     def get_page_title(self):
-        return 'Удаление ' + super().get_object().name()
+        return 'Удаление ' + self.object.name()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -139,14 +194,11 @@ class CemeteriesListView(BaseListView):
     context_object_name = 'cemetery_list'
     page_title = 'Мемориалы'
     navbar = 'burials'
+    query_budget = 4
 
     def get_queryset(self):
         q = super().get_queryset()
-        q = q.annotate(
-            person_count=Count('person_cemetery'),
-            person_actual_count=Count('person_cemetery_actual'),
-            person_total_count=F('person_count') + F('person_actual_count')
-        )
+        q = q.annotate(person_total_count=Coalesce(Sum('stats__count'), 0))
         return q
 
     def get(self, request, *args, **kwargs):
@@ -165,32 +217,27 @@ class CemeteryDetailView(DetailWithListView):
     list_model = Person
     context_object_name = 'cemetery'
     navbar = 'burials'
+    query_budget = 5
 
     def get_page_title(self):
-        return 'Мемориал ' + super().get_object().name
+        return 'Мемориал ' + self.object.name
 
     def get_list_queryset(self):
-        obj = super().get_object()
-        return Person.objects.filter(Q(active_import=None) & (Q(cemetery=obj) | Q(cemetery_actual=obj))).order_by('screen_name')
+        obj = self.object
+        return Person.objects.filter(Q(active_import=None) & (Q(cemetery=obj) | Q(cemetery_actual=obj))).order_by('screen_name', 'id')
+
+    def get_status_counts(self):
+        counts = dict(self.object.stats.values_list('status').annotate(count=Sum('count')))
+        css_classes = {Person.INCOMPLETE: 'danger', Person.PARTIAL: 'warning', Person.COMPLETE: 'success'}
+        return [{'name': name, 'count': counts.get(status, 0), 'css_class': css_classes[status]}
+                for status, name in Person.STATUSES]
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['total_count'] = self.get_list_queryset().count
-        context['start_item_number'] = ((context['page_obj'].number - 1) * PAGINATE_BY) + 1
+        context['status_counts'] = self.get_status_counts()
+        context['total_count'] = sum(status['count'] for status in context['status_counts'])
         return context
 
-    def get(self, request, *args, **kwargs):
-        self.object = self.get_object()
-        self.object_list = self.get_list_queryset()
-        if request.is_ajax():
-            context = self.get_context_data(object=self.object)
-            context['person_list'] = context['list_obj']
-            content = loader.render_to_string('website/snippets/person_list_rows.html', context, request)
-            return JsonResponse({"content": content})
-        else:
-            return super().get(request, args, kwargs)
-
-
 
 class CemeteryCreateView(CommonCreateEditView):
     model = Cemetery
@@ -206,47 +253,31 @@ class CemeteryEditView(CommonCreateEditView, UpdateView):
     page_title = 'Редактирование мемориала'
 
     def get_page_title(self):
-        return 'Редактирование мемориала ' + super().get_object().name
+        return 'Редактирование мемориала ' + self.object.name
+
+
+class ExportRequestMixin:
+    """
+    Queues an export of the requested format and redirects to it, or straight to the file if it is up to date
+    """
+    def get_format(self):
+        format = self.request.GET.get('format', Export.XLSX)
+        if format not in dict(Export.FORMATS):
+            raise Http404('Неизвестный формат')
+        return format
+
+    def redirect_to_export(self, obj):
+        if obj.is_ready():
+            return HttpResponseRedirect(reverse('export_download', kwargs={'pk': obj.pk}))
+        return HttpResponseRedirect(obj.get_absolute_url())
 
 
-class CemeteryExportView(DetailView):
+class CemeteryExportView(ExportRequestMixin, CommonViewMixin, BaseDetailView):
     model = Cemetery
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
-        persons = Person.objects.filter(cemetery=self.object)
-
-        def cond(f):
-           return f.attname in ('id', 'active_import_id', 'cemetery_id', 'cemetery_actual_id') \
-                  or f.attname.endswith('_actual')
-        fields = [f.attname for f in Person._meta.fields if not cond(f)]
-        captions = [f.verbose_name for f in Person._meta.fields if not cond(f)]
-
-        from openpyxl import Workbook
-        wb = Workbook()
-        ws = wb.active
-
-        ws.append(captions)
-
-        for person in persons:
-            row = []
-            for f in fields:
-                val = getattr(person, f)
-                if f == 'state':
-                    val = person.screen_state()
-                row.append(val)
-            ws.append(row)
-
-        wb.save('/tmp/export.xlsx')
-        encoded_filename = urllib.parse.quote(self.object.name, encoding='utf-8')
-
-        with open('/tmp/export.xlsx', 'rb') as f:
-            response = HttpResponse(
-                        f.read(),
-                        content_type=wb.mime_type
-                    )
-            response['Content-Disposition'] = 'attachment; filename*=UTF8\'\'%s.xlsx' % encoded_filename
-        return response
+        return self.redirect_to_export(enqueue_export(self.get_format(), cemetery=self.object))
 
 
 class CemeteryDeleteView(CommonDeleteView):
@@ -256,7 +287,7 @@ class CemeteryDeleteView(CommonDeleteView):
     additional_text = 'При удалении мемориала, люди добавленные в него не удалятся!'
 
     def get_page_title(self):
-        return 'Удаление мемориала ' + super().get_object().name
+        return 'Удаление мемориала ' + self.object.name
 
 
 class HospitalsView(BaseListView):
@@ -264,12 +295,11 @@ class HospitalsView(BaseListView):
     context_object_name = 'hospital_list'
     page_title = 'Госпитали'
     navbar = 'hospitals'
+    query_budget = 4
 
     def get_queryset(self):
         q = super().get_queryset()
-        q = q.annotate(
-            person_total_count=Count('person_hospital_actual')
-        )
+        q = q.annotate(person_total_count=Coalesce(Sum('stats__count'), 0))
         return q
 
     def get(self, request, *args, **kwargs):
@@ -288,31 +318,20 @@ class HospitalDetailView(DetailWithListView):
     list_model = Person
     context_object_name = 'hospital'
     navbar = 'hospitals'
+    query_budget = 5
 
     def get_page_title(self):
-        return 'Госпиталь ' + super().get_object().name
+        return 'Госпиталь ' + self.object.name
 
     def get_list_queryset(self):
-        obj = super().get_object()
-        return Person.objects.filter(Q(hospital=obj) | Q(hospital_actual=obj)).order_by('screen_name')
+        obj = self.object
+        return Person.objects.filter(Q(active_import=None) & (Q(hospital_linked=obj) | Q(hospital_actual=obj))).order_by('screen_name', 'id')
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['total_count'] = self.get_list_queryset().count
-        context['start_item_number'] = ((context['page_obj'].number - 1) * PAGINATE_BY) + 1
+        context['total_count'] = self.object.stats.aggregate(count=Sum('count'))['count'] or 0
         return context
 
-    def get(self, request, *args, **kwargs):
-        self.object = self.get_object()
-        self.object_list = self.get_list_queryset()
-        if request.is_ajax():
-            context = self.get_context_data(object=self.object)
-            context['person_list'] = context['list_obj']
-            content = loader.render_to_string('website/snippets/person_list_rows.html', context, request)
-            return JsonResponse({"content": content})
-        else:
-            return super().get(request, args, kwargs)
-
 
 class HospitalCreateView(CommonCreateEditView):
     model = Hospital
@@ -328,7 +347,7 @@ class HospitalEditView(CommonCreateEditView, UpdateView):
     page_title = 'Редактирование госпиталя'
 
     def get_page_title(self):
-        return 'Редактирование госпиталя ' + super().get_object().name
+        return 'Редактирование госпиталя ' + self.object.name
 
 
 class HospitalDeleteView(CommonDeleteView):
@@ -338,42 +357,87 @@ class HospitalDeleteView(CommonDeleteView):
     additional_text = 'При удалении госпиталя, люди добавленные в него не удалятся!'
 
     def get_page_title(self):
-        return 'Удаление госпиталя ' + super().get_object().name
+        return 'Удаление госпиталя ' + self.object.name
+
+
+class RegionsView(CommonViewMixin, ListView):
+    model = Place
+    context_object_name = 'place_list'
+    template_name = 'website/place_list.html'
+    page_title = 'Регионы'
+    navbar = 'regions'
+    query_budget = 6
+
+    # Person fields counted by region, as (field, context name) pairs
+    count_fields = [('birth_region', 'born_count'), ('conscription_region', 'conscripted_count')]
+
+    def get_counts(self):
+        cache_key = 'regions:%s' % DataVersion.get(DataVersion.PERSONS)
+        counts = cache.get(cache_key)
+        if counts is None:
+            persons = Person.objects.filter(active_import=None).order_by()
+            counts = {}
+            for field, _ in self.count_fields:
+                rows = persons.exclude(**{field: None}).values_list(field).annotate(count=Count('id'))
+                counts[field] = dict(rows)
+            cache.set(cache_key, counts, settings.COUNT_CACHE_TIMEOUT)
+        return counts
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        context = super().get_context_data(**kwargs)
+        counts = self.get_counts()
+        for place in context['place_list']:
+            for field, name in self.count_fields:
+                setattr(place, name, counts[field].get(place.pk, 0))
+        return context
 
 
-class PersonsView(FormMixin, BaseListView):
+class RegionPersonsView(CommonViewMixin, View):
+    def get(self, request, *args, **kwargs):
+        place = get_object_or_404(Place, pk=kwargs['pk'])
+        search_id = save_search({'advanced_search': 0, 'region': str(place.pk)})
+        return HttpResponseRedirect('%s?q=%s' % (reverse('persons'), search_id))
+
+
+class PersonsView(FormMixin, KeysetListView):
     model = Person
-    context_object_name = 'person_list'
     navbar = 'persons'
     page_title = 'Люди'
     form_class = PersonSearchForm
+    query_budget = 9
     http_method_names = ['get', 'post']
+    show_cemetery = True
     search = None
+    result_ids = None
+    result_ids_loaded = False
 
     def get_search(self):
         if 'q' in self.request.GET:
             if not self.search:
                 self.search = get_object_or_404(SearchData, id=self.request.GET['q'])
+                if not self.request.is_ajax():
+                    # Opening a saved search link keeps it from eviction
+                    SearchData.touch(self.search.id)
         return self.search
 
+    def get_result_ids(self):
+        if not self.result_ids_loaded:
+            search = self.get_search()
+            self.result_ids = get_search_result_ids(self.get_queryset(), search) if search else None
+            self.result_ids_loaded = True
+        return self.result_ids
+
+    def get_page(self):
+        # Pages of a cached search result are fetched by primary key without running the search again
+        ids = self.get_result_ids()
+        if ids is not None:
+            return IdListPage(Person.objects.all(), ids, self.request.GET.get('cursor'), self.cursor_paginate_by)
+        return super().get_page()
+
     def get_queryset(self):
-        form = self.form_class(self.request.GET)
-        q = Person.objects.filter(active_import=None).order_by('screen_name')
+        q = Person.objects.filter(active_import=None).order_by('screen_name', 'id')
         if 'q' in self.request.GET:
-            search = self.get_search()
-            fields = json.loads(search.fields)
-
-            for k, v in Person.get_search_mapping().items():
-                if k in fields:
-                    val = fields[k]
-                    filter = Q()
-                    for field in v:
-                        if field == 'state' and val == '-1':
-                            args = {'state__isnull': True}
-                        else:
-                            args = {'%s%s' % (field, Person._search_filters_mapping[k]): val}
-                        filter |= Q(**args)
-                    q = q.filter(filter)
+            q = search_persons(q, json.loads(self.get_search().fields))
         return q
 
     def get_context_data(self, *, object_list=None, **kwargs):
@@ -381,10 +445,12 @@ class PersonsView(FormMixin, BaseListView):
         if search:
             self.initial = json.loads(search.fields)
         context = super().get_context_data(**kwargs)
-        context['have_imports'] = Import.objects.count() > 0
-        context['show_cemetery'] = True
-        context['total_count'] = self.get_queryset().count
-        context['start_item_number'] = ((context['page_obj'].number - 1) * PAGINATE_BY) + 1
+        context['have_imports'] = Import.objects.exists()
+        ids = self.get_result_ids()
+        if ids is not None:
+            context['total_count'] = ListCount(len(ids))
+        else:
+            context['total_count'] = get_count(self.get_queryset(), 'persons:%s' % (search.id if search else 'all'))
         return context
 
     def post(self, request, *args, **kwargs):
@@ -395,36 +461,75 @@ class PersonsView(FormMixin, BaseListView):
         fields = {
             'advanced_search': form.cleaned_data['advanced_search'],
         }
+        if form.cleaned_data['quick']:
+            fields['quick'] = form.cleaned_data['quick']
+        if form.cleaned_data['fio_sounds_like']:
+            fields['fio_sounds_like'] = True
         for k, _ in Person.get_search_mapping().items():
             if form.cleaned_data[k]:
                 val = form.cleaned_data[k]
                 fields[k] = val
+        for k in get_range_search_fields():
+            if form.cleaned_data[k]:
+                fields[k] = form.cleaned_data[k]
 
-        fields = json.dumps(fields)
-        hash = hashlib.sha1()
-        hash.update(fields.encode('utf-8'))
-        hash = hash.digest()
-        try:
-            search = SearchData.objects.get(hash=hash)
-        except SearchData.DoesNotExist as e:
-            search = None
-        if not search:
-            search = SearchData.objects.create(hash=hash, fields=fields)
-        return HttpResponseRedirect('%s?q=%s' % (reverse_lazy('persons'), search.id))
+        return HttpResponseRedirect('%s?q=%s' % (reverse_lazy('persons'), save_search(fields)))
 
 
+class PersonsExportView(ExportRequestMixin, CommonViewMixin, View):
+    def get(self, request, *args, **kwargs):
+        search = None
+        if 'q' in request.GET:
+            search = get_object_or_404(SearchData, id=request.GET['q'])
+        return self.redirect_to_export(enqueue_export(self.get_format(), search=search))
+
+
+class ExportView(CommonViewMixin, DetailView):
+    model = Export
+    context_object_name = 'export'
+    template_name = 'website/export_detail.html'
+    navbar = 'persons'
+
+    def get_page_title(self):
+        return 'Экспорт %s' % self.object
+
+
+class ExportProgressView(View):
+    http_method_names = ['get']
+
+    def get(self, request, pk):
+        obj = get_object_or_404(Export, id=pk)
+        return JsonResponse(obj.get_progress())
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super(ExportProgressView, self).dispatch(*args, **kwargs)
+
+
+class ExportDownloadView(CommonViewMixin, BaseDetailView):
+    model = Export
+
+    def get(self, request, *args, **kwargs):
+        obj = self.get_object()
+        if not obj.is_ready():
+            return HttpResponseRedirect(obj.get_absolute_url())
+        content_type = XLSX_MIMETYPE if obj.format == Export.XLSX else 'text/csv; charset=utf-8'
+        return FileResponse(open(obj.file.path, 'rb'), as_attachment=True, filename=obj.get_filename(),
+                            content_type=content_type)
+
 
 class PersonDetailView(CommonViewMixin, DetailView):
     model = Person
     context_object_name = 'person'
     navbar = 'persons'
+    query_budget = 3
 
     def get_page_title(self):
-        return super().get_object().name()
+        return self.object.name()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        person = super().get_object()
+        person = self.object
         person_card_pair_values = []
         for f, a_f in Person.get_pair_card_fields():
             caption = Person._meta.get_field(f).verbose_name
@@ -442,15 +547,17 @@ class PersonCreateView(CommonCreateEditView):
     form_class = PersonCreateEditForm
     navbar = 'persons'
     page_title = 'Добавление нового человека'
+    query_budget = 4
 
 
 class PersonEditView(CommonCreateEditView, UpdateView):
     model = Person
     form_class = PersonCreateEditForm
     navbar = 'persons'
+    query_budget = 5
 
     def get_page_title(self):
-        return 'Редактирование человека ' + super().get_object().name()
+        return 'Редактирование человека ' + self.object.name()
 
 
 class PersonDeleteView(CommonDeleteView):
@@ -459,7 +566,7 @@ class PersonDeleteView(CommonDeleteView):
     navbar = 'persons'
 
     def get_page_title(self):
-        return 'Удаление человека ' + super().get_object().name()
+        return 'Удаление человека ' + self.object.name()
 
 
 class ImportsListView(BaseListView):
@@ -467,6 +574,7 @@ class ImportsListView(BaseListView):
     context_object_name = 'import_list'
     page_title = 'Незавершенные импорты'
     navbar = 'persons'
+    query_budget = 4
 
 
 class ImportCreateView(CommonCreateEditView):
@@ -482,7 +590,12 @@ class ImportEditView(CommonCreateEditView, UpdateView):
     navbar = 'persons'
 
     def get_page_title(self):
-        return 'Редактирование импорта ' + super().get_object().name
+        return 'Редактирование импорта ' + self.object.name
+
+    def form_valid(self, form):
+        if set(form.changed_data) & {'header', 'numbering', 'delimiter', 'quotechar', 'encoding'}:
+            ParseCache.clear(self.object)
+        return super().form_valid(form)
 
 
 class ImportDeleteView(CommonDeleteView):
@@ -491,7 +604,7 @@ class ImportDeleteView(CommonDeleteView):
     navbar = 'persons'
 
     def get_page_title(self):
-        return 'Удаление импорта ' + super().get_object().name
+        return 'Удаление импорта ' + self.object.name
 
 
 class ImportView(CommonViewMixin, UpdateView):
@@ -505,33 +618,37 @@ class ImportView(CommonViewMixin, UpdateView):
     def get_context_data(self, **kwargs):
         show_all = True if 'show_all' in self.request.GET else False
         context = super().get_context_data(**kwargs)
-        obj = super().get_object()
+        obj = self.object
         numbering = obj.numbering
         show_max = 5
         data_header = 0
         data_cols = 0
+        data_len = 0
         data = []
         error = None
 
-        try:
-            importer = ImporterFactory(obj).get_importer()
-            data_header, data, data_cols = importer.import_data()
-        except Exception as e:
-            error = str(e)
+        if not obj.data_added and not obj.is_in_progress():
+            try:
+                importer = ImporterFactory(obj).get_importer()
+                data_header, data, data_cols, data_len = importer.scan(None if show_all else show_max)
+            except Exception as e:
+                error = str(e)
 
         data_mapping = OrderedDict()
         for field in Person.get_mapped_fields():
             data_mapping[field] = Person._meta.get_field(field).verbose_name
-        data_len = len(data)
-        show_max = data_len if show_all else show_max
+        show_max = data_len if show_all else min(show_max, data_len)
         context['data_mapping'] = data_mapping
         context['numbering'] = range(numbering)
         context['data_cols'] = range(data_cols)
         context['import_header'] = data_header
-        context['import_data'] = data[:show_max]
-        context['data_len'] = len(data)
+        context['import_data'] = data
+        context['data_len'] = data_len
         context['data_show_len'] = show_max
         context['added_persons'] = Person.objects.filter(active_import=obj)
+        duplicate_candidates = obj.duplicate_candidates.select_related('person', 'duplicate')
+        context['duplicate_candidates'] = duplicate_candidates[:DUPLICATES_SHOW_MAX]
+        context['duplicate_candidates_count'] = duplicate_candidates.count()
         context['error'] = error
 
         return context
@@ -540,52 +657,32 @@ class ImportView(CommonViewMixin, UpdateView):
 class ImportDoView(FormMixin, BaseDetailView):
     model = Import
     form_class = ImportDoForm
-    csv_data = None
-    data_cols = 0
+    data_cols = None
     http_method_names = ['post']
 
     def import_data(self):
-        obj = self.get_object()
+        obj = self.object
         form = self.get_form()
         data_mapping = {}
-        persons = []
-        if form.is_valid():
+        if form.is_valid() and not obj.data_added and not obj.is_in_progress():
             for i in range(self.data_cols):
                 field_name = form.cleaned_data['column_%s' % i]
                 if field_name:
                     if field_name not in data_mapping:
                         data_mapping[field_name] = i
-            for row in self.csv_data:
-                person = Person()
-                person.cemetery = obj.cemetery
-                for field, col in data_mapping.items():
-                    val = row[1][col]
-                    if field == 'state':
-                        try:
-                            val = int(val)
-                            if val not in [i[0] for i in Person.STATES]:
-                                val = None
-                        except:
-                            val = None
-                    person.__setattr__(field, Person.translate_mapped_field_value(field, val, obj))
-                    person.active_import = obj
-                persons.append(person)
-
-        Person.objects.bulk_create(persons)
-        obj.data_added = True
-        obj.save()
+            enqueue_import(obj, data_mapping)
 
         return HttpResponseRedirect(obj.get_absolute_url())
 
     def post(self, request, pk):
-        with transaction.atomic():
-            return self.import_data()
+        self.object = self.get_object()
+        return self.import_data()
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
-        if self.csv_data is None:
-            importer = ImporterFactory(self.get_object()).get_importer()
-            _, self.csv_data, self.data_cols = importer.import_data()
+        if self.data_cols is None:
+            importer = ImporterFactory(self.object).get_importer()
+            _, _, self.data_cols, _ = importer.scan(0)
         kwargs['columns_count'] = self.data_cols
         return kwargs
 
@@ -598,20 +695,54 @@ class ImportApplyOrUndoView(View):
     http_method_names = ['post']
 
     def post(self, request, pk):
-        obj = get_object_or_404(Import, id=pk)
         action = request.POST['action']
-        if action == 'undo':
-            with transaction.atomic():
+        with transaction.atomic():
+            # The lock keeps workers from claiming the import meanwhile
+            obj = get_object_or_404(Import.objects.select_for_update(), id=pk)
+            if obj.is_in_progress():
+                return HttpResponseRedirect(obj.get_absolute_url())
+            if action == 'undo':
                 Person.objects.filter(active_import=obj).delete()
                 obj.data_added = False
+                obj.status = Import.NEW
+                obj.rows_processed = 0
                 obj.save()
-            return HttpResponseRedirect(obj.get_absolute_url())
-        elif action == 'apply':
-            obj.delete()
-            return HttpResponseRedirect(reverse_lazy('person_import'))
+                return HttpResponseRedirect(obj.get_absolute_url())
+            elif action == 'apply':
+                obj.delete()
+                return HttpResponseRedirect(reverse_lazy('person_import'))
 
         return HttpResponseRedirect(obj.get_absolute_url())
 
     @method_decorator(login_required)
     def dispatch(self, *args, **kwargs):
         return super(ImportApplyOrUndoView, self).dispatch(*args, **kwargs)
+
+
+class ImportProgressView(View):
+    http_method_names = ['get']
+
+    def get(self, request, pk):
+        obj = get_object_or_404(Import, id=pk)
+        return JsonResponse(obj.get_progress())
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super(ImportProgressView, self).dispatch(*args, **kwargs)
+
+
+class MetricsView(View):
+    http_method_names = ['get']
+
+    def get(self, request):
+        if not settings.METRICS:
+            raise Http404
+        if not request.user.is_staff and not self.has_token(request):
+            raise PermissionDenied
+        return HttpResponse(render_metrics(*collect()), content_type=METRICS_CONTENT_TYPE)
+
+    @staticmethod
+    def has_token(request):
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(settings.METRICS_TOKEN) and header.startswith('Bearer ') and \
+            hmac.compare_digest(header[len('Bearer '):], settings.METRICS_TOKEN)